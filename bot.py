@@ -4,13 +4,26 @@
 # ...existing code...
 import logging
 import asyncio
+import base64
 import json
 import os
 import random
+import hashlib
+import heapq
 import re
-from typing import Dict, List, Optional
+import secrets
+import sqlite3
+import tempfile
+from contextlib import contextmanager
+from typing import AsyncGenerator, Dict, List, Optional
 from datetime import datetime, timedelta
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from itertools import islice
+import sys
 import time
+from array import array
 from pathlib import Path
 
 from aiogram import Bot, Dispatcher, types, F
@@ -24,8 +37,10 @@ from aiogram.types import (
     InlineKeyboardMarkup,
     InlineKeyboardButton,
     FSInputFile,
+    InputFile,
     CallbackQuery,
 )
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
 from aiogram.utils.keyboard import InlineKeyboardBuilder, ReplyKeyboardBuilder
 
 import aiohttp
@@ -42,11 +57,78 @@ logger = logging.getLogger(__name__)
 storage = MemoryStorage()
 dp = Dispatcher(storage=storage)
 
-# recent_sent_files: user_id -> file_unique_id (used to suppress duplicates)
-# recent_sent_files: user_id -> (file_unique_id, timestamp)
-recent_sent_files: Dict[int, tuple] = {}
-# recent_sending: user_id -> bool (lock to prevent concurrent duplicate sends)
-recent_sending: Dict[int, bool] = {}
+
+class KeyedLocks:
+    """Блокировки по ключу (например, по id пользователя) без ожидания.
+    Запись хранится, только пока блокировка занята; блокировка, удерживаемая дольше ttl,
+    считается зависшей и снимается при следующей попытке её взять. try_acquire выдаёт
+    токен владельца: release с чужим токеном не снимает блокировку, взятую после истечения ttl.
+    """
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        # ключ -> (момент (monotonic), после которого блокировка считается зависшей, токен владельца)
+        self._held: Dict = {}
+
+    def __len__(self):
+        return len(self._held)
+
+    def locked(self, key) -> bool:
+        held = self._held.get(key)
+        return held is not None and held[0] > time.monotonic()
+
+    def try_acquire(self, key) -> Optional[object]:
+        """Взять блокировку; токен для release или None, если она уже занята"""
+        if self.locked(key):
+            return None
+        if key in self._held:
+            logger.warning(f"Снята зависшая блокировка {key}")
+        token = object()
+        self._held[key] = (time.monotonic() + self.ttl, token)
+        return token
+
+    def release(self, key, token):
+        held = self._held.get(key)
+        if held is not None and held[1] is token:
+            del self._held[key]
+
+
+class ExpiringCache:
+    """Словарь с ограниченным размером и временем жизни записей (вытесняются самые старые)"""
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries: "OrderedDict" = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def set(self, key, value):
+        self._entries.pop(key, None)
+        self._entries[key] = (time.monotonic() + self.ttl, value)
+        now = time.monotonic()
+        # устаревшие записи лежат в начале, потому что ttl у всех одинаковый
+        while self._entries and (len(self._entries) > self.maxsize or next(iter(self._entries.values()))[0] <= now):
+            self._entries.popitem(last=False)
+
+    def get(self, key, default=None):
+        entry = self._entries.get(key)
+        if entry is None:
+            return default
+        if entry[0] <= time.monotonic():
+            del self._entries[key]
+            return default
+        return entry[1]
+
+    def __contains__(self, key):
+        return self.get(key, self) is not self
+
+
+# Блокировка на пользователя: один запрос файла за раз
+delivery_locks = KeyedLocks(Config.DELIVERY_LOCK_TTL)
+# user_id -> file_unique_id недавно отправленного файла (подавление дублей)
+recent_deliveries = ExpiringCache(Config.DELIVERY_DEDUP_MAX_USERS, Config.DELIVERY_DEDUP_WINDOW)
 
 # Состояния FSM
 class SearchStates(StatesGroup):
@@ -132,10 +214,20 @@ def validate_datetime(datetime_str: str) -> bool:
     except ValueError:
         return False
 
+@lru_cache(maxsize=1024)
+def parse_end_datetime(end_datetime_str: str) -> Optional[float]:
+    """Дата окончания розыгрыша (ДД.ММ.ГГГГ ЧЧ:ММ) как timestamp; None, если формат неверный.
+    Результат кешируется: одни и те же строки разбираются один раз.
+    """
+    try:
+        return datetime.strptime(end_datetime_str, "%d.%m.%Y %H:%M").timestamp()
+    except (TypeError, ValueError):
+        return None
+
 def format_time_remaining(end_datetime_str: str) -> str:
     """Форматирование оставшегося времени до окончания розыгрыша"""
     try:
-        end_datetime = datetime.strptime(end_datetime_str, "%d.%m.%Y %H:%M")
+        end_datetime = datetime.fromtimestamp(parse_end_datetime(end_datetime_str))
         now = datetime.now()
         
         if now >= end_datetime:
@@ -156,33 +248,1086 @@ def format_time_remaining(end_datetime_str: str) -> str:
     except:
         return "⏰ Время не указано"
 
+# ================== ХРАНИЛИЩЕ ==================
+
+# Коллекции базы и атрибуты Config с путями к их JSON-файлам
+COLLECTION_FILES = {
+    'channels': 'CHANNELS_FILE',
+    'apps': 'APPS_FILE',
+    'suggestions': 'SUGGESTIONS_FILE',
+    'giveaways': 'GIVEAWAYS_FILE',
+    'jobs': 'JOBS_FILE',
+    'users': 'USERS_FILE',
+}
+
+
+class ParticipantList:
+    """Участники розыгрыша в компактном виде: id пользователей и время вступления (epoch)
+    в двух array('q') плюс множество id для проверки участия. Имена участников берутся
+    из реестра пользователей. На диске — {'ids': ..., 'joined': ...}: массивы int64
+    little-endian в base64. Старый формат (список словарей) тоже читается; имена из него
+    временно лежат в legacy_profiles, пока Database не перенесёт их в реестр.
+    """
+
+    __slots__ = ('ids', 'joined', '_members', 'legacy_profiles')
+
+    def __init__(self, ids=(), joined=()):
+        self.ids = array('q', ids)
+        self.joined = array('q', joined)
+        self._members = set(self.ids)
+        self.legacy_profiles: Optional[Dict[int, Dict]] = None
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __iter__(self):
+        return iter(self.ids)
+
+    def __contains__(self, user_id) -> bool:
+        return user_id in self._members
+
+    def add(self, user_id: int, joined: int = None) -> bool:
+        """Добавить участника; False, если он уже участвует"""
+        if user_id is None or user_id in self._members:
+            return False
+        self.ids.append(user_id)
+        self.joined.append(int(time.time()) if joined is None else joined)
+        self._members.add(user_id)
+        return True
+
+    def records(self):
+        """Пары (id пользователя, время вступления)"""
+        return zip(self.ids, self.joined)
+
+    @staticmethod
+    def _encode(values: array) -> str:
+        if sys.byteorder != 'little':
+            values = array('q', values)
+            values.byteswap()
+        return base64.b64encode(values.tobytes()).decode('ascii')
+
+    @staticmethod
+    def _decode(text: str) -> array:
+        values = array('q')
+        values.frombytes(base64.b64decode(text or ''))
+        if sys.byteorder != 'little':
+            values.byteswap()
+        return values
+
+    def to_json(self) -> Dict:
+        return {'ids': self._encode(self.ids), 'joined': self._encode(self.joined)}
+
+    @staticmethod
+    def joined_ts(participant: Dict) -> int:
+        """Время вступления из записи участника ('joined' или старое поле 'joined_date')"""
+        if participant.get('joined') is not None:
+            return int(participant['joined'])
+        try:
+            return int(datetime.fromisoformat(participant.get('joined_date') or '').timestamp())
+        except ValueError:
+            return 0
+
+    @classmethod
+    def coerce(cls, value) -> 'ParticipantList':
+        """ParticipantList из сохранённого значения: компактного, старого списка словарей или None"""
+        if isinstance(value, cls):
+            return value
+        participants = cls()
+        if isinstance(value, dict):
+            participants.ids = cls._decode(value.get('ids'))
+            participants.joined = cls._decode(value.get('joined'))
+            if len(participants.joined) != len(participants.ids):
+                participants.joined = array('q', participants.joined[:len(participants.ids)])
+                participants.joined.extend([0] * (len(participants.ids) - len(participants.joined)))
+            participants._members = set(participants.ids)
+            return participants
+        for p in value or []:
+            if not participants.add(p.get('id'), cls.joined_ts(p)):
+                continue
+            if p.get('username') or p.get('first_name'):
+                if participants.legacy_profiles is None:
+                    participants.legacy_profiles = {}
+                participants.legacy_profiles[p['id']] = p
+        return participants
+
+
+def giveaway_journal_dir() -> str:
+    """Папка журналов участий — рядом с файлом розыгрышей"""
+    return os.path.join(os.path.dirname(Config.GIVEAWAYS_FILE), 'giveaway_journal')
+
+
+class GiveawayJournal:
+    """Журнал участий в розыгрышах: файл JSON Lines на каждый розыгрыш (<папка>/<id>.jsonl).
+    Участие — одна дописанная строка, fsync выполняется пачками (sync). Перед записью снимка
+    giveaways.json журналы переименовываются в *.jsonl.old (rotate) и удаляются после успешной
+    записи (discard_rotated). При загрузке оба вида файлов проигрываются поверх снимка.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self._files: Dict[int, object] = {}
+        self._unsynced = set()
+        # строк дописано с последнего снимка
+        self.lines = 0
+
+    def _path(self, gid: int) -> str:
+        return os.path.join(self.directory, f"{gid}.jsonl")
+
+    def append(self, gid: int, participant: Dict):
+        f = self._files.get(gid)
+        if f is None:
+            os.makedirs(self.directory, exist_ok=True)
+            f = self._files[gid] = open(self._path(gid), 'a', encoding='utf-8')
+        f.write(json.dumps(participant, ensure_ascii=False) + '\n')
+        self._unsynced.add(gid)
+        self.lines += 1
+
+    @property
+    def unsynced(self) -> int:
+        return len(self._unsynced)
+
+    def sync(self):
+        """Сбросить дописанные строки на диск (flush + fsync)"""
+        unsynced, self._unsynced = self._unsynced, set()
+        for gid in unsynced:
+            f = self._files.get(gid)
+            if f is not None:
+                f.flush()
+                os.fsync(f.fileno())
+
+    def _close_files(self):
+        files, self._files = self._files, {}
+        for f in files.values():
+            f.close()
+
+    def _journal_files(self):
+        if not os.path.isdir(self.directory):
+            return []
+        return sorted(n for n in os.listdir(self.directory) if n.endswith('.jsonl') or n.endswith('.jsonl.old'))
+
+    def rotate(self):
+        """Отложить текущие журналы: их строки войдут в снимок, который сейчас будет записан"""
+        self._close_files()
+        self._unsynced = set()
+        self.lines = 0
+        for name in self._journal_files():
+            if not name.endswith('.jsonl'):
+                continue
+            path = os.path.join(self.directory, name)
+            rotated = path + '.old'
+            if os.path.exists(rotated):
+                # прошлый снимок не записался — дописываем к ещё не учтённым строкам
+                with open(path, 'r', encoding='utf-8') as src, open(rotated, 'a', encoding='utf-8') as dst:
+                    dst.write(src.read())
+                os.remove(path)
+            else:
+                os.replace(path, rotated)
+
+    def discard_rotated(self):
+        """Снимок записан — отложенные журналы больше не нужны"""
+        for name in self._journal_files():
+            if name.endswith('.old'):
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except OSError:
+                    pass
+
+    def remove(self, gid: int):
+        f = self._files.pop(gid, None)
+        if f is not None:
+            f.close()
+        self._unsynced.discard(gid)
+        for path in (self._path(gid), self._path(gid) + '.old'):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def replay(self, giveaways: List[Dict]) -> int:
+        """Добавить в розыгрыши участников из журналов; возвращает число восстановленных участий"""
+        by_id = {g.get('id'): g for g in giveaways}
+        replayed = 0
+        # сначала *.jsonl.old, затем свежие *.jsonl того же розыгрыша
+        for name in sorted(self._journal_files(), key=lambda n: (n.split('.')[0], not n.endswith('.old'))):
+            try:
+                giveaway = by_id.get(int(name.split('.')[0]))
+            except ValueError:
+                continue
+            if giveaway is None:
+                continue
+            participants = giveaway['participants'] = ParticipantList.coerce(giveaway.get('participants'))
+            with open(os.path.join(self.directory, name), 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        participant = json.loads(line)
+                    except ValueError:
+                        # недописанная последняя строка после сбоя
+                        continue
+                    if participants.add(participant.get('id'), ParticipantList.joined_ts(participant)):
+                        replayed += 1
+        return replayed
+
+    def close(self):
+        self.sync()
+        self._close_files()
+
+
+class JsonStorage:
+    """Хранилище в JSON-файлах data/*.json.
+    Любое изменение переписывает файл коллекции целиком; при deferred=True запись
+    откладывается до flush (см. фоновую запись в Database). Участия в розыгрышах
+    дописываются в GiveawayJournal и попадают в giveaways.json со следующим снимком.
+    """
+    name = 'json'
+
+    def __init__(self):
+        self.deferred = False
+        self._collections: Dict[str, List[Dict]] = {}
+        self._dirty = set()
+        self.journal: Optional[GiveawayJournal] = None
+
+    def _file(self, collection: str) -> str:
+        return getattr(Config, COLLECTION_FILES[collection])
+
+    def load(self, collection: str) -> List[Dict]:
+        records = Config.load_json_file(self._file(collection), [])
+        self._collections[collection] = records
+        if collection == 'giveaways':
+            self.journal = GiveawayJournal(giveaway_journal_dir())
+            replayed = self.journal.replay(records)
+            if replayed:
+                logger.info(f"Из журнала участий восстановлено записей: {replayed}")
+        return records
+
+    def _write(self, collection: str) -> bool:
+        if collection == 'giveaways' and self.journal:
+            self.journal.rotate()
+        ok = Config.save_json_file(self._file(collection), self._collections[collection])
+        if ok and collection == 'giveaways' and self.journal:
+            self.journal.discard_rotated()
+        return ok
+
+    def _mark(self, collection: str):
+        if not self.deferred:
+            self._write(collection)
+            return
+        self._dirty.add(collection)
+
+    def upsert(self, collection: str, record: Dict):
+        self._mark(collection)
+
+    def upsert_many(self, collection: str, records: List[Dict]):
+        self._mark(collection)
+
+    def delete(self, collection: str, key: int):
+        if collection == 'giveaways' and self.journal:
+            self.journal.remove(key)
+        self._mark(collection)
+
+    def replace_all(self, collection: str, records: List[Dict]):
+        self._collections[collection] = records
+        self._mark(collection)
+
+    def add_participant(self, giveaway: Dict, participant: Dict):
+        self.journal.append(giveaway.get('id'), participant)
+        if not self.deferred or self.journal.unsynced >= Config.GIVEAWAY_JOURNAL_FSYNC_BATCH:
+            self.journal.sync()
+        if self.journal.lines >= Config.GIVEAWAY_JOURNAL_COMPACT_LINES:
+            # журнал разросся — переносим его в снимок giveaways.json
+            self._mark('giveaways')
+
+    def has_pending(self) -> bool:
+        return bool(self._dirty) or bool(self.journal and self.journal.unsynced)
+
+    def flush(self):
+        """Синхронно записать все изменённые коллекции"""
+        if self.journal:
+            self.journal.sync()
+        dirty, self._dirty = self._dirty, set()
+        for collection in dirty:
+            if not self._write(collection):
+                self._dirty.add(collection)
+
+    async def flush_async(self):
+        """Записать изменённые коллекции: сериализация в цикле событий, запись файла в потоке"""
+        loop = asyncio.get_running_loop()
+        if self.journal and self.journal.unsynced:
+            await loop.run_in_executor(None, self.journal.sync)
+        pending, self._dirty = self._dirty, set()
+        try:
+            while pending:
+                collection = next(iter(pending))
+                filename = self._file(collection)
+                try:
+                    # Снимок делаем синхронно, чтобы обработчики не меняли данные во время сериализации
+                    if collection == 'giveaways' and self.journal:
+                        self.journal.rotate()
+                    text = Config.dump_json(self._collections[collection])
+                    ok = await loop.run_in_executor(None, Config.write_text_atomic, filename, text)
+                except Exception as e:
+                    logger.error(f"Ошибка отложенной записи {filename}: {e}")
+                    ok = False
+                pending.discard(collection)
+                if not ok:
+                    self._dirty.add(collection)
+                elif collection == 'giveaways' and self.journal:
+                    self.journal.discard_rotated()
+        finally:
+            # при отмене (остановка фоновой записи) незаписанные коллекции остаются «грязными»
+            self._dirty |= pending
+
+    def close(self):
+        self.flush()
+        if self.journal:
+            self.journal.close()
+
+
+class SqliteStorage:
+    """Хранилище в SQLite (режим WAL).
+    Записи с id лежат в отдельных таблицах с индексами по полям фильтрации,
+    участники розыгрышей — в своей таблице, поэтому изменение затрагивает только свои строки.
+    """
+    name = 'sqlite'
+
+    # Коллекции с ключом id и индексируемые колонки для каждой
+    KEYED_COLUMNS = {
+        'apps': ('genre', 'size_category'),
+        'suggestions': ('status',),
+        'giveaways': ('ended',),
+        'users': (),
+    }
+    # Коллекции без id: хранятся по позиции в списке
+    ORDERED = ('channels', 'jobs')
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+        CREATE TABLE IF NOT EXISTS apps (id INTEGER PRIMARY KEY, genre TEXT, size_category TEXT, data TEXT NOT NULL);
+        CREATE INDEX IF NOT EXISTS idx_apps_genre ON apps (genre);
+        CREATE INDEX IF NOT EXISTS idx_apps_size ON apps (size_category);
+        CREATE TABLE IF NOT EXISTS suggestions (id INTEGER PRIMARY KEY, status TEXT, data TEXT NOT NULL);
+        CREATE INDEX IF NOT EXISTS idx_suggestions_status ON suggestions (status);
+        CREATE TABLE IF NOT EXISTS giveaways (id INTEGER PRIMARY KEY, ended INTEGER, data TEXT NOT NULL);
+        CREATE INDEX IF NOT EXISTS idx_giveaways_ended ON giveaways (ended);
+        CREATE TABLE IF NOT EXISTS giveaway_participants (
+            giveaway_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            username TEXT,
+            first_name TEXT,
+            joined_date TEXT,
+            PRIMARY KEY (giveaway_id, user_id)
+        );
+        CREATE TABLE IF NOT EXISTS users (id INTEGER PRIMARY KEY, data TEXT NOT NULL);
+        CREATE TABLE IF NOT EXISTS channels (position INTEGER PRIMARY KEY, data TEXT NOT NULL);
+        CREATE TABLE IF NOT EXISTS jobs (position INTEGER PRIMARY KEY, data TEXT NOT NULL);
+    """
+
+    def __init__(self, path: str = None):
+        self.path = path or Config.SQLITE_FILE
+        dirpath = os.path.dirname(self.path)
+        if dirpath:
+            os.makedirs(dirpath, exist_ok=True)
+        self.deferred = False
+        self._uncommitted = False
+        # Соединением пользуется только поток записи: запросы и COMMIT (fsync WAL) выполняются в нём
+        # по очереди, цикл событий лишь готовит строки и ставит их в очередь
+        self._thread = ThreadPoolExecutor(max_workers=1, thread_name_prefix='sqlite')
+        self.conn = self._call(self._connect)
+        if not self._call(self._get_meta, 'json_imported'):
+            self.import_json()
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.executescript(self.SCHEMA)
+        conn.commit()
+        return conn
+
+    def _call(self, fn, *args):
+        """Выполнить fn в потоке записи и дождаться результата"""
+        return self._thread.submit(fn, *args).result()
+
+    def _get_meta(self, key: str) -> Optional[str]:
+        row = self.conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def _run(self, statements: List[tuple], commit: bool):
+        """(Поток записи) выполнить запросы (sql, параметры, executemany?) и при необходимости зафиксировать"""
+        for sql, params, many in statements:
+            if many:
+                self.conn.executemany(sql, params)
+            else:
+                self.conn.execute(sql, params)
+        if commit:
+            self.conn.commit()
+
+    @staticmethod
+    def _log_failure(future):
+        if not future.cancelled() and future.exception() is not None:
+            logger.error(f"Ошибка записи в SQLite: {future.exception()}")
+
+    def _apply(self, statements: List[tuple]):
+        """Поставить запросы в очередь потока записи; без отложенной записи — дождаться коммита"""
+        if self.deferred:
+            self._uncommitted = True
+            self._thread.submit(self._run, statements, False).add_done_callback(self._log_failure)
+        else:
+            self._call(self._run, statements, True)
+
+    @staticmethod
+    def _dumps(record: Dict) -> str:
+        return json.dumps(record, ensure_ascii=False)
+
+    def _keyed_row(self, collection: str, record: Dict) -> tuple:
+        """Запрос записи по id; строка сериализуется сразу, пока обработчики не изменили запись"""
+        columns = self.KEYED_COLUMNS[collection]
+        data = record
+        if collection == 'giveaways':
+            # участники хранятся построчно в giveaway_participants
+            data = {k: v for k, v in record.items() if k != 'participants'}
+        values = [record.get('id')]
+        for column in columns:
+            value = record.get(column)
+            values.append(int(value) if isinstance(value, bool) else value)
+        values.append(self._dumps(data))
+        names = ", ".join(("id",) + columns + ("data",))
+        marks = ", ".join("?" * len(values))
+        return f"INSERT OR REPLACE INTO {collection} ({names}) VALUES ({marks})", values, False
+
+    @staticmethod
+    def _participant_rows(giveaway_id: int, participants) -> tuple:
+        participants = ParticipantList.coerce(participants)
+        profiles = participants.legacy_profiles or {}
+        return (
+            "INSERT OR IGNORE INTO giveaway_participants (giveaway_id, user_id, username, first_name, joined_date) "
+            "VALUES (?, ?, ?, ?, ?)",
+            [(giveaway_id, uid, profiles.get(uid, {}).get('username'), profiles.get(uid, {}).get('first_name'),
+              datetime.fromtimestamp(joined).strftime("%Y-%m-%d %H:%M:%S"))
+             for uid, joined in participants.records()],
+            True
+        )
+
+    def _collection_rows(self, collection: str, records: List[Dict]) -> List[tuple]:
+        """Запросы полной перезаписи коллекции"""
+        statements = [(f"DELETE FROM {collection}", (), False)]
+        if collection in self.ORDERED:
+            statements.append((f"INSERT INTO {collection} (position, data) VALUES (?, ?)",
+                               [(i, self._dumps(record)) for i, record in enumerate(records)], True))
+            return statements
+        if collection == 'giveaways':
+            statements.append(("DELETE FROM giveaway_participants", (), False))
+        for record in records:
+            statements.append(self._keyed_row(collection, record))
+            if collection == 'giveaways':
+                statements.append(self._participant_rows(record.get('id'), record.get('participants', [])))
+        return statements
+
+    def load(self, collection: str) -> List[Dict]:
+        return self._call(self._load, collection)
+
+    def _load(self, collection: str) -> List[Dict]:
+        if collection in self.ORDERED:
+            rows = self.conn.execute(f"SELECT data FROM {collection} ORDER BY position").fetchall()
+            return [json.loads(row[0]) for row in rows]
+
+        records = [json.loads(row[0]) for row in
+                   self.conn.execute(f"SELECT data FROM {collection} ORDER BY id").fetchall()]
+        if collection == 'giveaways':
+            participants: Dict[int, ParticipantList] = {}
+            rows = self.conn.execute(
+                "SELECT giveaway_id, user_id, username, first_name, joined_date "
+                "FROM giveaway_participants ORDER BY rowid"
+            )
+            for gid, uid, username, first_name, joined_date in rows:
+                plist = participants.get(gid)
+                if plist is None:
+                    plist = participants[gid] = ParticipantList()
+                plist.add(uid, ParticipantList.joined_ts({'joined_date': joined_date}))
+                if username or first_name:
+                    # строки, импортированные из старого формата, ещё хранят имена
+                    if plist.legacy_profiles is None:
+                        plist.legacy_profiles = {}
+                    plist.legacy_profiles[uid] = {'username': username, 'first_name': first_name}
+            for giveaway in records:
+                giveaway['participants'] = participants.get(giveaway.get('id')) or ParticipantList()
+        return records
+
+    def upsert(self, collection: str, record: Dict):
+        self._apply([self._keyed_row(collection, record)])
+
+    def upsert_many(self, collection: str, records: List[Dict]):
+        """Записать несколько записей одним коммитом (участники розыгрышей не переписываются)"""
+        self._apply([self._keyed_row(collection, record) for record in records])
+
+    def delete(self, collection: str, key: int):
+        statements = [(f"DELETE FROM {collection} WHERE id = ?", (key,), False)]
+        if collection == 'giveaways':
+            statements.append(("DELETE FROM giveaway_participants WHERE giveaway_id = ?", (key,), False))
+        self._apply(statements)
+
+    def replace_all(self, collection: str, records: List[Dict]):
+        """Полная перезапись коллекции (для небольших списков без id и импорта)"""
+        self._apply(self._collection_rows(collection, records))
+
+    def add_participant(self, giveaway: Dict, participant: Dict):
+        self._apply([self._participant_rows(giveaway.get('id'), [participant])])
+
+    def import_json(self):
+        """Одноразовый импорт существующих data/*.json в SQLite"""
+        counts = {}
+        statements = []
+        for collection, attr in COLLECTION_FILES.items():
+            records = Config.load_json_file(getattr(Config, attr), [])
+            if collection == 'giveaways':
+                # участия, ещё не перенесённые из журнала в giveaways.json
+                GiveawayJournal(giveaway_journal_dir()).replay(records)
+            statements.extend(self._collection_rows(collection, records))
+            counts[collection] = len(records)
+        statements.append(("INSERT OR REPLACE INTO meta (key, value) VALUES ('json_imported', ?)",
+                           (datetime.now().strftime("%Y-%m-%d %H:%M:%S"),), False))
+        self._call(self._run, statements, True)
+        logger.info(f"Импорт JSON в SQLite ({self.path}) завершён: {counts}")
+
+    def has_pending(self) -> bool:
+        return self._uncommitted
+
+    def flush(self):
+        if self._uncommitted:
+            self._uncommitted = False
+            self._call(self.conn.commit)
+
+    async def flush_async(self):
+        """Зафиксировать транзакцию в потоке записи, не блокируя цикл событий (fsync WAL)"""
+        if not self._uncommitted:
+            return
+        # изменения, поставленные в очередь во время коммита, снова выставят флаг и попадут в следующий
+        self._uncommitted = False
+        try:
+            await asyncio.wrap_future(self._thread.submit(self.conn.commit))
+        except BaseException:
+            self._uncommitted = True
+            raise
+
+    def close(self):
+        self.flush()
+        self._call(self.conn.close)
+        self._thread.shutdown()
+
+
+def create_storage():
+    """Создать хранилище согласно Config.STORAGE_BACKEND"""
+    if Config.STORAGE_BACKEND == 'sqlite':
+        return SqliteStorage()
+    return JsonStorage()
+
+
+# ================== ПОИСКОВЫЙ ИНДЕКС ==================
+
+class SearchIndex:
+    """Инвертированный индекс каталога по названию и описанию приложений.
+    Слова приводятся к нижнему регистру (casefold, ё -> е); для поиска по части слова
+    словарь индексируется по триграммам, поэтому запрос не перебирает все приложения.
+    """
+    FIELD_NAME = 1
+    FIELD_DESCRIPTION = 2
+
+    # Веса совпадений: точное слово > начало слова > часть слова; название важнее описания
+    WEIGHTS = {
+        (FIELD_NAME, 'exact'): 30, (FIELD_NAME, 'prefix'): 20, (FIELD_NAME, 'substring'): 10,
+        (FIELD_DESCRIPTION, 'exact'): 6, (FIELD_DESCRIPTION, 'prefix'): 4, (FIELD_DESCRIPTION, 'substring'): 2,
+    }
+
+    _word_re = re.compile(r'\w+')
+
+    # Транслитерация кириллицы в латиницу для нечёткого поиска («майнкрафт» ~ «minecraft»)
+    TRANSLIT = str.maketrans({
+        'а': 'a', 'б': 'b', 'в': 'v', 'г': 'g', 'д': 'd', 'е': 'e', 'ж': 'zh', 'з': 'z',
+        'и': 'i', 'й': 'i', 'к': 'k', 'л': 'l', 'м': 'm', 'н': 'n', 'о': 'o', 'п': 'p',
+        'р': 'r', 'с': 's', 'т': 't', 'у': 'u', 'ф': 'f', 'х': 'h', 'ц': 'ts', 'ч': 'ch',
+        'ш': 'sh', 'щ': 'sch', 'ъ': '', 'ы': 'i', 'ь': '', 'э': 'e', 'ю': 'iu', 'я': 'ia',
+    })
+    # Латинские сочетания, которые в русской записи звучат одинаково
+    _latin_folds = (('ph', 'f'), ('ck', 'k'), ('c', 'k'), ('q', 'k'), ('x', 'ks'), ('w', 'v'), ('y', 'i'), ('j', 'i'))
+
+    def __init__(self):
+        # слово -> {id приложения: битовая маска полей, где оно встречается}
+        self._postings: Dict[str, Dict[int, int]] = {}
+        # триграмма -> слова словаря, которые её содержат
+        self._trigrams: Dict[str, set] = {}
+        # id -> (слова названия через пробел, слова документа)
+        self._docs: Dict[int, tuple] = {}
+        # Нечёткий поиск: транслитерированная форма -> исходные слова и триграммы этих форм
+        self._folded: Dict[str, set] = {}
+        self._folded_trigrams: Dict[str, set] = {}
+
+    @staticmethod
+    def normalize(text: str) -> str:
+        return (text or '').casefold().replace('ё', 'е')
+
+    @classmethod
+    def tokenize(cls, text: str) -> List[str]:
+        return cls._word_re.findall(cls.normalize(text))
+
+    @staticmethod
+    def trigrams(word: str) -> set:
+        return {word[i:i + 3] for i in range(len(word) - 2)}
+
+    @classmethod
+    def fold(cls, word: str) -> str:
+        """Транслитерированная и упрощённая форма слова для нечёткого сравнения"""
+        word = word.translate(cls.TRANSLIT)
+        for src, dst in cls._latin_folds:
+            word = word.replace(src, dst)
+        return word
+
+    @classmethod
+    def padded_trigrams(cls, word: str) -> set:
+        # края слова учитываются, поэтому у коротких слов тоже есть триграммы
+        return cls.trigrams(f"^{word}$")
+
+    @staticmethod
+    def edit_distance(a: str, b: str, limit: int) -> int:
+        """Расстояние Левенштейна с отсечкой: при превышении limit возвращает limit + 1"""
+        if abs(len(a) - len(b)) > limit:
+            return limit + 1
+        previous = list(range(len(b) + 1))
+        for i, ca in enumerate(a, 1):
+            current = [i]
+            for j, cb in enumerate(b, 1):
+                current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (ca != cb)))
+            if min(current) > limit:
+                return limit + 1
+            previous = current
+        return min(previous[-1], limit + 1)
+
+    @staticmethod
+    def max_typos(word: str) -> int:
+        """Допустимое число опечаток в зависимости от длины слова"""
+        if len(word) <= 4:
+            return 1
+        if len(word) <= 8:
+            return 2
+        return 3
+
+    def __len__(self):
+        return len(self._docs)
+
+    def rebuild(self, apps: List[Dict]):
+        self._postings.clear()
+        self._trigrams.clear()
+        self._docs.clear()
+        self._folded.clear()
+        self._folded_trigrams.clear()
+        for app in apps:
+            self.add(app)
+
+    def add(self, app: Dict):
+        app_id = app.get('id')
+        if app_id in self._docs:
+            self.remove(app_id)
+        fields = {}
+        for word in self.tokenize(app.get('name', '')):
+            fields[word] = fields.get(word, 0) | self.FIELD_NAME
+        for word in self.tokenize(app.get('description', '')):
+            fields[word] = fields.get(word, 0) | self.FIELD_DESCRIPTION
+        for word, mask in fields.items():
+            postings = self._postings.get(word)
+            if postings is None:
+                postings = self._postings[word] = {}
+                for gram in self.trigrams(word):
+                    self._trigrams.setdefault(gram, set()).add(word)
+                folded = self.fold(word)
+                if folded not in self._folded:
+                    self._folded[folded] = set()
+                    for gram in self.padded_trigrams(folded):
+                        self._folded_trigrams.setdefault(gram, set()).add(folded)
+                self._folded[folded].add(word)
+            postings[app_id] = mask
+        self._docs[app_id] = (' '.join(self.tokenize(app.get('name', ''))), tuple(fields))
+
+    def remove(self, app_id: int):
+        doc = self._docs.pop(app_id, None)
+        if doc is None:
+            return
+        for word in doc[1]:
+            postings = self._postings.get(word)
+            if postings is None:
+                continue
+            postings.pop(app_id, None)
+            if not postings:
+                # слово больше нигде не встречается — убираем его из словаря
+                del self._postings[word]
+                for gram in self.trigrams(word):
+                    words = self._trigrams.get(gram)
+                    if words is not None:
+                        words.discard(word)
+                        if not words:
+                            del self._trigrams[gram]
+                folded = self.fold(word)
+                originals = self._folded.get(folded)
+                if originals is not None:
+                    originals.discard(word)
+                    if not originals:
+                        del self._folded[folded]
+                        for gram in self.padded_trigrams(folded):
+                            forms = self._folded_trigrams.get(gram)
+                            if forms is not None:
+                                forms.discard(folded)
+                                if not forms:
+                                    del self._folded_trigrams[gram]
+
+    def update(self, app: Dict):
+        self.add(app)
+
+    def _matching_words(self, term: str) -> List[str]:
+        """Слова словаря, содержащие term"""
+        if len(term) < 3:
+            # коротких запросов триграммами не покрыть — перебираем словарь (он меньше каталога)
+            candidates = [w for w in self._postings if term in w]
+        else:
+            grams = sorted(self.trigrams(term), key=lambda g: len(self._trigrams.get(g, ())))
+            candidates = None
+            for gram in grams:
+                words = self._trigrams.get(gram)
+                if not words:
+                    return []
+                candidates = set(words) if candidates is None else candidates & words
+                if not candidates:
+                    return []
+            candidates = [w for w in candidates if term in w]
+        return candidates
+
+    def search(self, query: str, limit: Optional[int] = None) -> List[int]:
+        """id приложений, подходящих под все слова запроса, по убыванию релевантности"""
+        terms = self.tokenize(query)
+        if not terms:
+            return []
+        scores: Optional[Dict[int, int]] = None
+        for term in dict.fromkeys(terms):
+            term_scores: Dict[int, int] = {}
+            for word in self._matching_words(term):
+                kind = 'exact' if word == term else 'prefix' if word.startswith(term) else 'substring'
+                for app_id, mask in self._postings[word].items():
+                    best = 0
+                    for field in (self.FIELD_NAME, self.FIELD_DESCRIPTION):
+                        if mask & field:
+                            best = max(best, self.WEIGHTS[(field, kind)])
+                    if best > term_scores.get(app_id, 0):
+                        term_scores[app_id] = best
+            if scores is None:
+                scores = term_scores
+            else:
+                scores = {app_id: score + term_scores[app_id]
+                          for app_id, score in scores.items() if app_id in term_scores}
+            if not scores:
+                return []
+
+        # Совпадение всей фразы с названием поднимает результат наверх
+        phrase = ' '.join(terms)
+        for app_id in scores:
+            name = self._docs[app_id][0]
+            if name == phrase:
+                scores[app_id] += 100
+            elif name.startswith(phrase):
+                scores[app_id] += 50
+            elif phrase in name:
+                scores[app_id] += 25
+
+        ranked = sorted(scores, key=lambda app_id: (-scores[app_id], self._docs[app_id][0], app_id))
+        return ranked[:limit] if limit else ranked
+
+    def _fuzzy_words(self, term: str, max_candidates: int, max_visits: int) -> Dict[str, int]:
+        """Слова словаря, похожие на term: слово -> число опечаток.
+        Сначала отбираются формы с наибольшим числом общих триграмм (не больше max_candidates),
+        и только для них считается расстояние Левенштейна. Триграммы обходятся от редких
+        к частым; частые пропускаются, когда просмотрено уже max_visits форм.
+        """
+        folded = self.fold(term)
+        overlap: Dict[str, int] = {}
+        visited = 0
+        for forms in sorted((self._folded_trigrams.get(gram, ()) for gram in self.padded_trigrams(folded)), key=len):
+            if overlap and visited + len(forms) > max_visits:
+                break
+            visited += len(forms)
+            for form in forms:
+                overlap[form] = overlap.get(form, 0) + 1
+        candidates = heapq.nlargest(max_candidates, overlap, key=overlap.__getitem__)
+
+        limit = self.max_typos(folded)
+        result: Dict[str, int] = {}
+        for form in candidates:
+            distance = self.edit_distance(folded, form, limit)
+            if distance > limit:
+                continue
+            for word in self._folded[form]:
+                if distance < result.get(word, limit + 1):
+                    result[word] = distance
+        return result
+
+    def search_fuzzy(self, query: str, limit: Optional[int] = None, max_candidates: int = 200,
+                     max_visits: int = 5000) -> List[int]:
+        """Нечёткий поиск с учётом опечаток и транслитерации.
+        Объём работы на слово запроса ограничен: max_candidates слов для расстояния Левенштейна
+        и max_visits просмотренных элементов индекса (записи приложений берутся от ближайших слов).
+        """
+        terms = self.tokenize(query)
+        if not terms:
+            return []
+        scores: Optional[Dict[int, int]] = None
+        for term in dict.fromkeys(terms):
+            term_limit = self.max_typos(self.fold(term))
+            term_scores: Dict[int, int] = {}
+            words = self._fuzzy_words(term, max_candidates, max_visits)
+            visited = 0
+            for word in sorted(words, key=words.__getitem__):
+                if visited >= max_visits:
+                    break
+                postings = self._postings[word]
+                visited += len(postings)
+                closeness = term_limit + 1 - words[word]
+                for app_id, mask in postings.items():
+                    weight = 10 if mask & self.FIELD_NAME else 3
+                    term_scores[app_id] = max(term_scores.get(app_id, 0), weight * closeness)
+            if scores is None:
+                scores = term_scores
+            else:
+                scores = {app_id: score + term_scores[app_id]
+                          for app_id, score in scores.items() if app_id in term_scores}
+            if not scores:
+                return []
+
+        key = lambda app_id: (-scores[app_id], self._docs[app_id][0], app_id)
+        return heapq.nsmallest(limit, scores, key=key) if limit else sorted(scores, key=key)
+
+
 # База данных в памяти
 class Database:
-    def __init__(self):
-        self.channels = Config.load_json_file(Config.CHANNELS_FILE, [])
-        self.apps = Config.load_json_file(Config.APPS_FILE, [])
-        self.suggestions = Config.load_json_file(Config.SUGGESTIONS_FILE, [])
-        self.giveaways = Config.load_json_file(Config.GIVEAWAYS_FILE, [])
-        self.users = Config.load_json_file(Config.USERS_FILE, [])
-        self.jobs = Config.load_json_file(Config.JOBS_FILE, [])
-    
+    def __init__(self, storage=None):
+        # Рабочий набор данных держим в памяти, хранилище отвечает только за запись изменений
+        self.storage = storage or create_storage()
+
+        # Пользователи, у которых обновился только last_seen/имя: пишутся пачкой, не на каждое сообщение
+        self._seen_users = set()
+        self._seen_flushed_at = time.monotonic()
+
+        # Отложенная запись: счётчик изменений с последнего сброса.
+        # Заводится до load(): перенос данных старого формата при загрузке уже пишет в хранилище
+        self._pending_writes = 0
+        self._flush_event: Optional[asyncio.Event] = None
+        self._writer_task: Optional[asyncio.Task] = None
+
+        self.load()
+
+    def load(self):
+        """(Пере)загрузка всех коллекций из хранилища и перестроение индексов"""
+        self.channels = self.storage.load('channels')
+        self.apps = self.storage.load('apps')
+        self.suggestions = self.storage.load('suggestions')
+        self.giveaways = self.storage.load('giveaways')
+        self.users = self.storage.load('users')
+        self.jobs = self.storage.load('jobs')
+        self._rebuild_indexes()
+
+    def _rebuild_indexes(self):
+        """Индексы id -> запись (те же объекты, что лежат в списках)"""
+        self._users_by_id: Dict[int, Dict] = {u.get('id'): u for u in self.users}
+        # id недоступных боту пользователей (исключаются из розыгрышей)
+        self._inactive_users: set = {u.get('id') for u in self.users if u.get('inactive')}
+        self._apps_by_id: Dict[int, Dict] = {a.get('id'): a for a in self.apps}
+        self._suggestions_by_id: Dict[int, Dict] = {s.get('id'): s for s in self.suggestions}
+        self._giveaways_by_id: Dict[int, Dict] = {g.get('id'): g for g in self.giveaways}
+        # Последний выданный id по коллекциям (для добавления без прохода по всем id)
+        self._last_ids: Dict[str, int] = {
+            collection: max((key for key in index if isinstance(key, int)), default=0)
+            for collection, index in (('apps', self._apps_by_id), ('suggestions', self._suggestions_by_id),
+                                      ('giveaways', self._giveaways_by_id))
+        }
+        self.search_index = SearchIndex()
+        self.search_index.rebuild(self.apps)
+        # Вторичные индексы для кнопок жанров и размеров: значение -> id приложений (в порядке добавления)
+        self._apps_by_genre: Dict[str, Dict[int, None]] = {}
+        self._apps_by_size: Dict[str, Dict[int, None]] = {}
+        for app in self.apps:
+            self._bucket_add(app)
+        # Участники — ParticipantList (старый формат со словарями переводится при загрузке)
+        legacy_users: List[Dict] = []
+        for g in self.giveaways:
+            participants = g['participants'] = ParticipantList.coerce(g.get('participants'))
+            legacy_users.extend(self._adopt_legacy_profiles(participants))
+        if legacy_users:
+            self._upsert_many('users', legacy_users)
+        # Незавершённые и завершённые розыгрыши по id; дата окончания разбирается один раз
+        self._open_giveaways: Dict[int, Dict] = {}
+        self._ended_giveaways: Dict[int, Dict] = {}
+        for g in self.giveaways:
+            self._set_deadline(g)
+            self._classify_giveaway(g)
+
+    def _adopt_legacy_profiles(self, participants: ParticipantList) -> List[Dict]:
+        """Перенести имена участников из старого формата в реестр пользователей; вернуть новых"""
+        profiles, participants.legacy_profiles = participants.legacy_profiles, None
+        added = []
+        if not profiles:
+            return added
+        for uid, joined in participants.records():
+            profile = profiles.get(uid)
+            if profile is None or uid in self._users_by_id:
+                continue
+            joined = datetime.fromtimestamp(joined).strftime("%Y-%m-%d %H:%M:%S")
+            u = {
+                'id': uid,
+                'username': profile.get('username') or f'user_{uid}',
+                'first_name': profile.get('first_name') or 'Пользователь',
+                'added_date': joined,
+                'last_seen': joined
+            }
+            self.users.append(u)
+            self._users_by_id[uid] = u
+            added.append(u)
+        return added
+
+    @staticmethod
+    def _set_deadline(giveaway: Dict):
+        """Записать в розыгрыш end_ts — дату окончания в виде timestamp (None, если дата некорректна)"""
+        giveaway['end_ts'] = parse_end_datetime(giveaway.get('end_datetime', ''))
+
+    def _classify_giveaway(self, giveaway: Dict):
+        gid = giveaway.get('id')
+        if giveaway.get('ended', False):
+            self._open_giveaways.pop(gid, None)
+            self._ended_giveaways[gid] = giveaway
+        else:
+            self._ended_giveaways.pop(gid, None)
+            self._open_giveaways[gid] = giveaway
+
+    def _bucket_add(self, app: Dict):
+        app_id = app.get('id')
+        self._apps_by_genre.setdefault((app.get('genre') or '').lower(), {})[app_id] = None
+        self._apps_by_size.setdefault(app.get('size_category') or '', {})[app_id] = None
+
+    def _bucket_remove(self, app: Dict):
+        app_id = app.get('id')
+        for buckets, key in ((self._apps_by_genre, (app.get('genre') or '').lower()),
+                             (self._apps_by_size, app.get('size_category') or '')):
+            bucket = buckets.get(key)
+            if bucket is not None:
+                bucket.pop(app_id, None)
+                if not bucket:
+                    del buckets[key]
+
+    def _next_id(self, collection: str) -> int:
+        """Следующий id коллекции: счётчик растёт и после удалений, поэтому id не повторяются"""
+        self._last_ids[collection] += 1
+        return self._last_ids[collection]
+
+    @staticmethod
+    def _remove_record(records: List[Dict], record: Dict):
+        """Убрать из списка именно этот объект (не равный ему по содержимому).
+        Проход по списку (O(n)) оставлен намеренно: удаление — редкое действие администратора,
+        а списки хранят порядок добавления для каталога и файлов коллекций.
+        """
+        for i, item in enumerate(records):
+            if item is record:
+                records.pop(i)
+                return
+
+    # ---------- отложенная запись (write-behind) ----------
+
+    def _note_write(self):
+        """Учесть изменение; при накоплении пачки будим фоновую запись раньше интервала"""
+        self._pending_writes += 1
+        if self._flush_event is not None and self._pending_writes >= Config.DB_FLUSH_BATCH_SIZE:
+            self._flush_event.set()
+
+    def _upsert(self, collection: str, record: Dict):
+        self.storage.upsert(collection, record)
+        self._note_write()
+
+    def _delete(self, collection: str, key: int):
+        self.storage.delete(collection, key)
+        self._note_write()
+
+    def _upsert_many(self, collection: str, records: List[Dict]):
+        self.storage.upsert_many(collection, records)
+        self._note_write()
+
+    def _replace_all(self, collection: str):
+        self.storage.replace_all(collection, getattr(self, collection))
+        self._note_write()
+
+    def _fold_seen_users(self):
+        """Передать накопленные обновления last_seen в хранилище"""
+        self._seen_flushed_at = time.monotonic()
+        seen, self._seen_users = self._seen_users, set()
+        users = [self._users_by_id[uid] for uid in seen if uid in self._users_by_id]
+        if users:
+            # одна запись users.json (один коммит SQLite) на всю пачку
+            self.storage.upsert_many('users', users)
+
+    def flush(self):
+        """Синхронно записать все накопленные изменения"""
+        self._fold_seen_users()
+        self._pending_writes = 0
+        self.storage.flush()
+
+    async def _writer_loop(self):
+        """Фоновая задача: сбрасывает изменения по интервалу или по размеру пачки"""
+        while True:
+            try:
+                await asyncio.wait_for(self._flush_event.wait(), timeout=Config.DB_FLUSH_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_event.clear()
+            if time.monotonic() - self._seen_flushed_at >= Config.USERS_SEEN_FLUSH_INTERVAL:
+                self._fold_seen_users()
+            if self.storage.has_pending():
+                self._pending_writes = 0
+                try:
+                    await self.storage.flush_async()
+                except Exception as e:
+                    logger.error(f"Ошибка фоновой записи базы: {e}")
+
+    def start_writer(self):
+        """Запустить фоновую запись (вызывается из main при работающем цикле событий)"""
+        if self._writer_task is None:
+            self.storage.deferred = True
+            self._flush_event = asyncio.Event()
+            self._writer_task = asyncio.create_task(self._writer_loop())
+
+    async def stop_writer(self):
+        """Остановить фоновую запись и сбросить на диск всё, что осталось"""
+        task, self._writer_task = self._writer_task, None
+        if task is not None:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        self.flush()
+        self.storage.deferred = False
+
+    def close(self):
+        """Записать изменения и закрыть хранилище"""
+        self._fold_seen_users()
+        self.storage.close()
+
     def save_channels(self):
-        Config.save_json_file(Config.CHANNELS_FILE, self.channels)
+        self._replace_all('channels')
     
     def save_apps(self):
-        Config.save_json_file(Config.APPS_FILE, self.apps)
+        self._upsert_many('apps', self.apps)
     
     def save_suggestions(self):
-        Config.save_json_file(Config.SUGGESTIONS_FILE, self.suggestions)
+        self._upsert_many('suggestions', self.suggestions)
     
     def save_giveaways(self):
-        Config.save_json_file(Config.GIVEAWAYS_FILE, self.giveaways)
+        self._upsert_many('giveaways', self.giveaways)
     
     def save_jobs(self):
-        Config.save_json_file(Config.JOBS_FILE, self.jobs)
+        self._replace_all('jobs')
 
     def save_users(self):
-        Config.save_json_file(Config.USERS_FILE, self.users)
+        self._upsert_many('users', self.users)
     
     def add_app(self, app_data: Dict) -> bool:
         """Добавление приложения"""
@@ -191,11 +1336,14 @@ class Database:
             if not app_data.get('name'):
                 return False
             
-            app_data['id'] = len(self.apps) + 1
+            app_data['id'] = self._next_id('apps')
             app_data['added_date'] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
             
             self.apps.append(app_data)
-            self.save_apps()
+            self._apps_by_id[app_data['id']] = app_data
+            self.search_index.add(app_data)
+            self._bucket_add(app_data)
+            self._upsert('apps', app_data)
             return True
         except Exception as e:
             logger.error(f"Ошибка добавления приложения: {e}")
@@ -203,22 +1351,31 @@ class Database:
     
     def update_app(self, app_id: int, field: str, value: str) -> bool:
         """Обновление приложения"""
-        for app in self.apps:
-            if app.get('id') == app_id:
-                app[field] = value
-                app['modified_date'] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                self.save_apps()
-                return True
-        return False
+        app = self._apps_by_id.get(app_id)
+        if app is None:
+            return False
+        if field in ('genre', 'size_category'):
+            self._bucket_remove(app)
+            app[field] = value
+            self._bucket_add(app)
+        else:
+            app[field] = value
+        app['modified_date'] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        if field in ('name', 'description'):
+            self.search_index.update(app)
+        self._upsert('apps', app)
+        return True
     
     def delete_app(self, app_id: int) -> bool:
         """Удаление приложения"""
-        for i, app in enumerate(self.apps):
-            if app.get('id') == app_id:
-                self.apps.pop(i)
-                self.save_apps()
-                return True
-        return False
+        app = self._apps_by_id.pop(app_id, None)
+        if app is None:
+            return False
+        self._remove_record(self.apps, app)
+        self.search_index.remove(app_id)
+        self._bucket_remove(app)
+        self._delete('apps', app_id)
+        return True
     
     def add_channel(self, channel_data: Dict) -> bool:
         """Добавление канала"""
@@ -226,27 +1383,66 @@ class Database:
         self.save_channels()
         return True
 
+    def update_channel(self, channel_index: int, field: str, value: str) -> bool:
+        """Изменение поля канала по индексу"""
+        if 0 <= channel_index < len(self.channels):
+            self.channels[channel_index][field] = value
+            self.save_channels()
+            return True
+        return False
+
     def add_user(self, user_id: int, username: str = "", first_name: str = "") -> bool:
         """Добавление/обновление пользователя в реестр пользователей"""
-        for u in self.users:
-            if u.get('id') == user_id:
-                # обновим данные и дату последнего взаимодействия
-                u['username'] = username or u.get('username', '')
-                u['first_name'] = first_name or u.get('first_name', '')
-                u['last_seen'] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                self.save_users()
-                return True
-
-        # иначе добавляем нового
-        self.users.append({
+        now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        u = self._users_by_id.get(user_id)
+        if u is not None:
+            # обновим данные и дату последнего взаимодействия; на диск попадёт при периодическом сбросе
+            u['username'] = username or u.get('username', '')
+            u['first_name'] = first_name or u.get('first_name', '')
+            u['last_seen'] = now
+            if u.pop('inactive', None):
+                # пользователь снова пишет боту — возвращаем его в рассылки
+                u.pop('inactive_reason', None)
+                u.pop('inactive_since', None)
+                self._inactive_users.discard(user_id)
+                self._upsert('users', u)
+            else:
+                self._seen_users.add(user_id)
+            return True
+
+        # иначе добавляем нового — это изменение сохраняем как обычную запись
+        u = {
             'id': user_id,
             'username': username or f'user_{user_id}',
             'first_name': first_name or 'Пользователь',
-            'added_date': datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-            'last_seen': datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        })
-        self.save_users()
+            'added_date': now,
+            'last_seen': now
+        }
+        self.users.append(u)
+        self._users_by_id[user_id] = u
+        self._upsert('users', u)
+        return True
+
+    def get_user(self, user_id: int) -> Dict:
+        """Получение пользователя по ID"""
+        return self._users_by_id.get(user_id, {})
+
+    def mark_user_inactive(self, user_id: int, reason: str) -> bool:
+        """Пометить пользователя недоступным (заблокировал бота, удалён) — он пропускается в рассылках"""
+        u = self._users_by_id.get(user_id)
+        if u is None or u.get('inactive'):
+            return False
+        u['inactive'] = True
+        u['inactive_reason'] = reason
+        u['inactive_since'] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        self._inactive_users.add(user_id)
+        self._upsert('users', u)
+        logger.info(f"Пользователь {user_id} исключён из рассылок: {reason}")
         return True
+
+    def get_broadcast_audience(self) -> List[int]:
+        """id пользователей, которым можно отправлять рассылки"""
+        return [u['id'] for u in self.users if u.get('id') and not u.get('inactive')]
     
     def delete_channel(self, channel_index: int) -> bool:
         """Удаление канала по индексу"""
@@ -258,140 +1454,181 @@ class Database:
     
     def add_suggestion(self, suggestion_data: Dict) -> bool:
         """Добавление предложения"""
-        suggestion_data['id'] = len(self.suggestions) + 1
+        suggestion_data['id'] = self._next_id('suggestions')
         suggestion_data['date'] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         suggestion_data['status'] = 'pending'
         self.suggestions.append(suggestion_data)
-        self.save_suggestions()
+        self._suggestions_by_id[suggestion_data['id']] = suggestion_data
+        self._upsert('suggestions', suggestion_data)
         return True
     
     def update_suggestion_status(self, suggestion_id: int, status: str) -> bool:
         """Обновление статуса предложения"""
-        for suggestion in self.suggestions:
-            if suggestion.get('id') == suggestion_id:
-                suggestion['status'] = status
-                self.save_suggestions()
-                return True
-        return False
+        suggestion = self._suggestions_by_id.get(suggestion_id)
+        if suggestion is None:
+            return False
+        suggestion['status'] = status
+        self._upsert('suggestions', suggestion)
+        return True
 
     def set_suggestion_rejection(self, suggestion_id: int, reason: str) -> bool:
         """Отметить предложение как отклонённое и сохранить причину"""
-        for suggestion in self.suggestions:
-            if suggestion.get('id') == suggestion_id:
-                suggestion['status'] = 'rejected'
-                suggestion['rejection_reason'] = reason
-                suggestion['modified_date'] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                self.save_suggestions()
-                return True
-        return False
+        suggestion = self._suggestions_by_id.get(suggestion_id)
+        if suggestion is None:
+            return False
+        suggestion['status'] = 'rejected'
+        suggestion['rejection_reason'] = reason
+        suggestion['modified_date'] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        self._upsert('suggestions', suggestion)
+        return True
+
+    def delete_suggestion(self, suggestion_id: int) -> bool:
+        """Удаление предложения"""
+        suggestion = self._suggestions_by_id.pop(suggestion_id, None)
+        if suggestion is None:
+            return False
+        self._remove_record(self.suggestions, suggestion)
+        self._delete('suggestions', suggestion_id)
+        return True
 
     def get_suggestion_by_id(self, suggestion_id: int) -> Dict:
         """Получение предложения по ID"""
-        for suggestion in self.suggestions:
-            if suggestion.get('id') == suggestion_id:
-                return suggestion
-        return {}
+        return self._suggestions_by_id.get(suggestion_id, {})
     
     def add_giveaway(self, giveaway_data: Dict) -> bool:
         """Добавление розыгрыша"""
-        giveaway_data['id'] = len(self.giveaways) + 1
+        giveaway_data['id'] = self._next_id('giveaways')
         giveaway_data['created_date'] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        giveaway_data['participants'] = []
+        giveaway_data['participants'] = ParticipantList()
+        giveaway_data.setdefault('winners_count', Config.GIVEAWAY_DEFAULT_WINNERS)
         giveaway_data['ended'] = False
+        self._set_deadline(giveaway_data)
         self.giveaways.append(giveaway_data)
-        self.save_giveaways()
+        self._giveaways_by_id[giveaway_data['id']] = giveaway_data
+        self._classify_giveaway(giveaway_data)
+        self._upsert('giveaways', giveaway_data)
         return True
     
     def update_giveaway(self, giveaway_id: int, field: str, value) -> bool:
         """Обновление розыгрыша"""
-        for giveaway in self.giveaways:
-            if giveaway.get('id') == giveaway_id:
-                giveaway[field] = value
-                giveaway['modified_date'] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                self.save_giveaways()
-                return True
-        return False
+        giveaway = self._giveaways_by_id.get(giveaway_id)
+        if giveaway is None:
+            return False
+        giveaway[field] = value
+        giveaway['modified_date'] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        if field == 'end_datetime':
+            self._set_deadline(giveaway)
+        elif field == 'ended':
+            self._classify_giveaway(giveaway)
+        self._upsert('giveaways', giveaway)
+        return True
     
     def delete_giveaway(self, giveaway_id: int) -> bool:
         """Удаление розыгрыша"""
-        for i, giveaway in enumerate(self.giveaways):
-            if giveaway.get('id') == giveaway_id:
-                self.giveaways.pop(i)
-                self.save_giveaways()
-                return True
-        return False
+        giveaway = self._giveaways_by_id.pop(giveaway_id, None)
+        if giveaway is None:
+            return False
+        self._remove_record(self.giveaways, giveaway)
+        self._open_giveaways.pop(giveaway_id, None)
+        self._ended_giveaways.pop(giveaway_id, None)
+        self._delete('giveaways', giveaway_id)
+        return True
     
     def get_giveaway_by_id(self, giveaway_id: int) -> Dict:
         """Получение розыгрыша по ID"""
-        for giveaway in self.giveaways:
-            if giveaway.get('id') == giveaway_id:
-                return giveaway
-        return {}
-    
-    def end_giveaway(self, giveaway_id: int, winner_id: int = None, winner_username: str = None) -> bool:
-        """Завершение розыгрыша с выбором победителя"""
-        for giveaway in self.giveaways:
-            if giveaway.get('id') == giveaway_id:
-                giveaway['ended'] = True
-                giveaway['end_date_actual'] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                
-                if winner_id and winner_username:
-                    giveaway['winner'] = {
-                        'id': winner_id,
-                        'username': winner_username
-                    }
-                
-                self.save_giveaways()
-                return True
-        return False
+        return self._giveaways_by_id.get(giveaway_id, {})
+    
+    def end_giveaway(self, giveaway_id: int, winner_id: int = None, winner_username: str = None,
+                     winners: List[int] = None) -> bool:
+        """Завершение розыгрыша с выбором победителя (или нескольких — winners)"""
+        giveaway = self._giveaways_by_id.get(giveaway_id)
+        if giveaway is None:
+            return False
+        giveaway['ended'] = True
+        giveaway['end_date_actual'] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        self._classify_giveaway(giveaway)
+        
+        if winners:
+            giveaway['winners'] = [{'id': uid, 'username': self.get_participant_name(uid)} for uid in winners]
+            # первый победитель — в прежнем поле winner для совместимости
+            giveaway['winner'] = giveaway['winners'][0]
+        elif winner_id and winner_username:
+            giveaway['winner'] = {
+                'id': winner_id,
+                'username': winner_username
+            }
+        
+        self._upsert('giveaways', giveaway)
+        return True
     
     def add_participant(self, giveaway_id: int, user_id: int, username: str, first_name: str) -> bool:
         """Добавление участника в розыгрыш"""
-        for giveaway in self.giveaways:
-            if giveaway.get('id') == giveaway_id:
-                # Проверяем, не участвует ли уже пользователь
-                if any(participant.get('id') == user_id for participant in giveaway.get('participants', [])):
-                    return False
-                
-                giveaway['participants'].append({
-                    'id': user_id,
-                    'username': username,
-                    'first_name': first_name,
-                    'joined_date': datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                })
-                self.save_giveaways()
-                return True
-        return False
+        giveaway = self._giveaways_by_id.get(giveaway_id)
+        if giveaway is None:
+            return False
+        participants = giveaway['participants']
+        joined = int(time.time())
+        # Проверяем, не участвует ли уже пользователь
+        if not participants.add(user_id, joined):
+            return False
+        # имя участника хранится в реестре пользователей
+        self.add_user(user_id, username, first_name)
+        self.storage.add_participant(giveaway, {'id': user_id, 'joined': joined})
+        self._note_write()
+        return True
     
     def is_participant(self, giveaway_id: int, user_id: int) -> bool:
         """Проверка, участвует ли пользователь в розыгрыше"""
-        for giveaway in self.giveaways:
-            if giveaway.get('id') == giveaway_id:
-                for participant in giveaway.get('participants', []):
-                    if participant.get('id') == user_id:
-                        return True
-        return False
+        return user_id in self._giveaways_by_id.get(giveaway_id, {}).get('participants', ())
+
+    def get_participant_count(self, giveaway_id: int) -> int:
+        """Количество участников розыгрыша"""
+        return len(self._giveaways_by_id.get(giveaway_id, {}).get('participants', ()))
+
+    def get_draw_exclusions(self) -> set:
+        """id пользователей, которые не могут выиграть (недоступные боту); множество не копируется"""
+        return self._inactive_users
+
+    def get_participant_name(self, user_id: int) -> str:
+        """Имя участника для сообщений: username или имя из реестра пользователей"""
+        user = self._users_by_id.get(user_id, {})
+        return user.get('username') or user.get('first_name') or str(user_id)
     
     def search_by_name(self, name: str) -> List[Dict]:
-        """Поиск по названию"""
-        name_lower = name.lower()
-        return [app for app in self.apps if name_lower in app.get('name', '').lower()]
+        """Поиск по названию и описанию (по убыванию релевантности)"""
+        return [self._apps_by_id[app_id] for app_id in self.search_index.search(name)]
+
+    def search_fuzzy(self, name: str) -> List[Dict]:
+        """Поиск с опечатками и транслитерацией (когда точный поиск ничего не нашёл)"""
+        app_ids = self.search_index.search_fuzzy(
+            name, limit=Config.FUZZY_MAX_RESULTS, max_candidates=Config.FUZZY_MAX_CANDIDATES,
+            max_visits=Config.FUZZY_MAX_VISITS
+        )
+        return [self._apps_by_id[app_id] for app_id in app_ids]
     
-    def search_by_genre(self, genre: str) -> List[Dict]:
-        """Поиск по жанру"""
-        genre_lower = genre.lower()
-        return [app for app in self.apps if app.get('genre', '').lower() == genre_lower]
+    def search_by_genre(self, genre: str, offset: int = 0, limit: Optional[int] = None) -> List[Dict]:
+        """Поиск по жанру (offset/limit — срез для постраничного вывода)"""
+        bucket = self._apps_by_genre.get(genre.lower(), ())
+        stop = offset + limit if limit is not None else None
+        return [self._apps_by_id[app_id] for app_id in islice(bucket, offset, stop)]
     
-    def search_by_size(self, size_category: str) -> List[Dict]:
-        """Поиск по размеру"""
-        return [app for app in self.apps if app.get('size_category', '') == size_category]
+    def search_by_size(self, size_category: str, offset: int = 0, limit: Optional[int] = None) -> List[Dict]:
+        """Поиск по размеру (offset/limit — срез для постраничного вывода)"""
+        bucket = self._apps_by_size.get(size_category, ())
+        stop = offset + limit if limit is not None else None
+        return [self._apps_by_id[app_id] for app_id in islice(bucket, offset, stop)]
+
+    def count_by_genre(self, genre: str) -> int:
+        """Количество приложений жанра"""
+        return len(self._apps_by_genre.get(genre.lower(), ()))
+
+    def count_by_size(self, size_category: str) -> int:
+        """Количество приложений категории размера"""
+        return len(self._apps_by_size.get(size_category, ()))
     
     def get_app_by_id(self, app_id: int) -> Dict:
         """Получение приложения по ID"""
-        for app in self.apps:
-            if app.get('id') == app_id:
-                return app
-        return {}
+        return self._apps_by_id.get(app_id, {})
     
     def get_random_app(self) -> Dict:
         """Получение случайного приложения"""
@@ -433,36 +1670,24 @@ class Database:
             'total_pages': total_pages
         }
     
+    @staticmethod
+    def is_giveaway_expired(giveaway: Dict, now: float = None) -> bool:
+        """Время розыгрыша вышло (розыгрыш с некорректной датой считается активным)"""
+        end_ts = giveaway.get('end_ts')
+        return end_ts is not None and (now or time.time()) >= end_ts
+
     def get_active_giveaways(self) -> List[Dict]:
         """Получение активных розыгрышей"""
-        active_giveaways = []
-        for giveaway in self.giveaways:
-            if not giveaway.get('ended', False):
-                try:
-                    end_datetime = datetime.strptime(giveaway.get('end_datetime', ''), "%d.%m.%Y %H:%M")
-                    if datetime.now() < end_datetime:
-                        active_giveaways.append(giveaway)
-                except:
-                    # Если дата некорректная, считаем розыгрыш активным
-                    active_giveaways.append(giveaway)
-        return active_giveaways
+        now = time.time()
+        return [g for g in self._open_giveaways.values() if not self.is_giveaway_expired(g, now)]
     
     def get_ended_giveaways(self) -> List[Dict]:
-        """Получение завершенных розыгрышей"""
-        ended_giveaways = []
-        for giveaway in self.giveaways:
-            if giveaway.get('ended', False):
-                ended_giveaways.append(giveaway)
-            else:
-                try:
-                    end_datetime = datetime.strptime(giveaway.get('end_datetime', ''), "%d.%m.%Y %H:%M")
-                    if datetime.now() >= end_datetime:
-                        giveaway['ended'] = True
-                        ended_giveaways.append(giveaway)
-                        self.save_giveaways()
-                except:
-                    pass
-        return ended_giveaways
+        """Получение завершенных розыгрышей (включая те, у которых время вышло, но итоги ещё не подведены)"""
+        now = time.time()
+        expired = [g for g in self._open_giveaways.values() if self.is_giveaway_expired(g, now)]
+        if not expired:
+            return list(self._ended_giveaways.values())
+        return sorted(list(self._ended_giveaways.values()) + expired, key=lambda g: g.get('id') or 0)
     
     def get_pending_suggestions(self) -> List[Dict]:
         """Получение ожидающих предложений"""
@@ -494,6 +1719,8 @@ class Database:
         
         return {
             'apps_count': len(self.apps),
+            'users_count': len(self.users),
+            'inactive_users': sum(1 for u in self.users if u.get('inactive')),
             'channels_count': len(self.channels),
             'suggestions_count': len(self.suggestions),
             'pending_suggestions': pending_suggestions,
@@ -502,7 +1729,1477 @@ class Database:
             'ended_giveaways': len(ended_giveaways)
         }
 
-db = Database()
+db = Database()
+
+# ================== ДОСТАВКА ФАЙЛОВ ==================
+
+class DeferredJsonSave:
+    """Отложенное сохранение JSON-файла: изменения отмечаются через _mark_dirty, файл пишется
+    в потоке через save_delay секунд после первого изменения (одна запись на пачку изменений)
+    и при остановке. Наследник задаёт save_file, save_delay и _snapshot().
+    """
+    save_file = ''
+    save_delay = 0.0
+    _dirty = False
+    _save_task: Optional[asyncio.Task] = None
+
+    def _snapshot(self) -> List[Dict]:
+        raise NotImplementedError
+
+    def _save(self):
+        self._dirty = False
+        Config.save_json_file(self.save_file, self._snapshot())
+
+    def _mark_dirty(self):
+        """Отметить изменение; запись на диск — отложенная, одна на пачку изменений"""
+        self._dirty = True
+        if self._save_task is None:
+            try:
+                self._save_task = asyncio.get_running_loop().create_task(self._save_later())
+            except RuntimeError:
+                # вне цикла событий (утилиты, тесты) — пишем сразу
+                self._save()
+
+    async def _save_later(self):
+        try:
+            await asyncio.sleep(self.save_delay)
+            if self._dirty:
+                self._dirty = False
+                text = Config.dump_json(self._snapshot())
+                if not await asyncio.get_running_loop().run_in_executor(
+                        None, Config.write_text_atomic, self.save_file, text):
+                    self._dirty = True
+        finally:
+            self._save_task = None
+
+    async def stop(self):
+        """Отменить отложенную запись и сохранить файл, если были изменения"""
+        task = self._save_task
+        if task is not None:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        if self._dirty:
+            self._save()
+
+
+class FileIdCache(DeferredJsonSave):
+    """Постоянный кеш Telegram file_id отправленных файлов приложений.
+    Ключ — id приложения и sha256 содержимого: пока файл не менялся, он отправляется
+    по file_id без повторной загрузки. Хеш пересчитывается, только если изменились размер или mtime.
+    Файл data/file_ids.json пишется отложенно (FILE_IDS_SAVE_DELAY) в потоке.
+    """
+
+    def __init__(self, filename: str):
+        self.filename = self.save_file = filename
+        self.save_delay = Config.FILE_IDS_SAVE_DELAY
+        # app_id -> {'app_id', 'sha256', 'file_id', 'path', 'size', 'mtime_ns'} (актуальная версия файла)
+        self._entries: Dict[int, Dict] = {e.get('app_id'): e for e in Config.load_json_file(filename, [])}
+        # путь -> (размер, mtime_ns, sha256): чтобы не хешировать неизменившийся файл повторно
+        self._hashes: Dict[str, tuple] = {
+            e['path']: (e.get('size'), e.get('mtime_ns'), e.get('sha256'))
+            for e in self._entries.values() if e.get('path')
+        }
+
+    def _snapshot(self) -> List[Dict]:
+        return list(self._entries.values())
+
+    @staticmethod
+    def _hash_file(path: str) -> str:
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    async def digest(self, path: str) -> str:
+        """sha256 файла; большие файлы хешируются в потоке, чтобы не блокировать цикл событий"""
+        st = os.stat(path)
+        known = self._hashes.get(path)
+        if known and known[0] == st.st_size and known[1] == st.st_mtime_ns:
+            return known[2]
+        loop = asyncio.get_running_loop()
+        sha = await loop.run_in_executor(None, self._hash_file, path)
+        self._hashes[path] = (st.st_size, st.st_mtime_ns, sha)
+        return sha
+
+    @staticmethod
+    def url_version(url: str) -> str:
+        """Версия файла, отправленного по URL: Telegram скачал его сам, поэтому хеша нет"""
+        return 'url:' + hashlib.sha256(url.encode('utf-8')).hexdigest()
+
+    def get(self, app_id: int, sha: str) -> Optional[str]:
+        entry = self._entries.get(app_id)
+        if entry and entry.get('sha256') == sha:
+            return entry.get('file_id')
+        return None
+
+    def put(self, app_id: int, sha: str, file_id: str, path: str = None):
+        entry = {'app_id': app_id, 'sha256': sha, 'file_id': file_id}
+        known = self._hashes.get(path) if path else None
+        if known and known[2] == sha:
+            entry.update(path=path, size=known[0], mtime_ns=known[1])
+        self._entries[app_id] = entry
+        self._mark_dirty()
+
+    def forget(self, app_id: int, sha: str = None):
+        """Убрать file_id приложения (конкретной версии или любой)"""
+        entry = self._entries.get(app_id)
+        if entry and (sha is None or entry.get('sha256') == sha):
+            del self._entries[app_id]
+            self._mark_dirty()
+
+
+file_id_cache = FileIdCache(Config.FILE_IDS_FILE)
+
+
+# Общий HTTP-клиент для внешних загрузок: создаётся в main() и закрывается при остановке,
+# чтобы соединения (TCP/TLS) переиспользовались между скачиваниями
+http_session: Optional[aiohttp.ClientSession] = None
+
+
+def create_http_session() -> aiohttp.ClientSession:
+    """HTTP-клиент с ограничением соединений, кешем DNS, таймаутами и keep-alive"""
+    connector = aiohttp.TCPConnector(
+        limit=Config.HTTP_MAX_CONNECTIONS,
+        limit_per_host=Config.HTTP_MAX_CONNECTIONS_PER_HOST,
+        ttl_dns_cache=Config.HTTP_DNS_CACHE_TTL,
+        keepalive_timeout=Config.HTTP_KEEPALIVE_TIMEOUT,
+    )
+    # Общего лимита на запрос нет (файлы бывают большими), ограничиваем подключение и паузы в чтении
+    timeout = aiohttp.ClientTimeout(total=None, connect=Config.HTTP_CONNECT_TIMEOUT, sock_read=Config.HTTP_READ_TIMEOUT)
+    return aiohttp.ClientSession(connector=connector, timeout=timeout)
+
+
+def get_http_session() -> aiohttp.ClientSession:
+    """Общий HTTP-клиент (создаётся при первом обращении, если main его ещё не создал)"""
+    global http_session
+    if http_session is None or http_session.closed:
+        http_session = create_http_session()
+    return http_session
+
+
+async def close_http_session():
+    global http_session
+    session, http_session = http_session, None
+    if session is not None and not session.closed:
+        await session.close()
+
+
+class DownloadError(Exception):
+    """Внешний файл не удалось скачать (HTTP-статус ответа)"""
+
+    def __init__(self, status: int):
+        super().__init__(f"HTTP {status}")
+        self.status = status
+
+
+def filename_from_response(resp, url: str, app_id: int = None) -> str:
+    """Имя файла из Content-Disposition, иначе из пути URL"""
+    filename = None
+    try:
+        cd = resp.headers.get('content-disposition')
+        if cd:
+            m = re.search(r"filename\*?=([^;]+)", cd)
+            if m:
+                fn = m.group(1).strip()
+                if fn.lower().startswith("utf-") or "'" in fn:
+                    # возможно формат filename*=utf-8''name
+                    parts = fn.split("''")
+                    if len(parts) > 1:
+                        fn = parts[-1]
+                filename = fn.strip('"')
+    except Exception:
+        filename = None
+
+    if not filename:
+        filename = os.path.basename(urlparse(url).path) or f"app_{app_id}{os.path.splitext(url)[1] or ''}"
+    return filename
+
+
+class RelayInputFile(InputFile):
+    """Файл для загрузки в Telegram, который читается прямо из ответа aiohttp.
+    Буфер ограничен: следующий кусок читается из сети, только когда предыдущий ушёл в Telegram.
+    Прочитанные куски дописываются в sink (файл кеша), по ходу считается sha256.
+    """
+
+    def __init__(self, resp, filename: str, sink=None, prefix: bytes = b''):
+        super().__init__(filename=filename, chunk_size=Config.RELAY_CHUNK_SIZE)
+        self.resp = resp
+        self.sink = sink
+        self.prefix = prefix
+        self.sha = hashlib.sha256()
+        self.completed = False
+
+    def _consume(self, chunk: bytes):
+        self.sha.update(chunk)
+        if self.sink is not None:
+            self.sink.write(chunk)
+
+    async def read(self, bot) -> AsyncGenerator[bytes, None]:
+        if self.prefix:
+            self._consume(self.prefix)
+            yield self.prefix
+        async for chunk in self.resp.content.iter_chunked(self.chunk_size):
+            self._consume(chunk)
+            yield chunk
+        self.completed = True
+
+
+class DownloadCache(DeferredJsonSave):
+    """Дисковый кеш файлов, скачанных по file_link.
+    Запись считается свежей DOWNLOAD_CACHE_FRESH_SECONDS, потом перепроверяется условным
+    запросом (ETag / Last-Modified). Общий размер ограничен, вытесняются давно не использованные
+    файлы. Одновременные запросы одного URL ждут одно скачивание. Порядок использования
+    хранится в памяти, index.json записывается в потоке через DOWNLOAD_CACHE_SAVE_DELAY
+    секунд после изменения (и при остановке).
+    """
+
+    def __init__(self, directory: str, max_bytes: int, fresh_for: float):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.fresh_for = fresh_for
+        self.index_file = self.save_file = os.path.join(directory, 'index.json')
+        self.save_delay = Config.DOWNLOAD_CACHE_SAVE_DELAY
+        os.makedirs(directory, exist_ok=True)
+        # url -> запись; порядок — от давно использованных к недавним
+        self._entries: "OrderedDict[str, Dict]" = OrderedDict()
+        for entry in sorted(Config.load_json_file(self.index_file, []), key=lambda e: e.get('used_at', 0)):
+            if os.path.exists(entry.get('path', '')):
+                self._entries[entry['url']] = entry
+        self._inflight: Dict[str, asyncio.Future] = {}
+        # пути файлов, которые сейчас отправляются (их нельзя вытеснять)
+        self._in_use: Dict[str, int] = {}
+
+    def _snapshot(self) -> List[Dict]:
+        return list(self._entries.values())
+
+    def _path_for(self, url: str) -> str:
+        ext = os.path.splitext(urlparse(url).path)[1][:10]
+        return os.path.join(self.directory, hashlib.sha1(url.encode('utf-8')).hexdigest() + ext)
+
+    def peek(self, url: str) -> Optional[Dict]:
+        """Свежая запись кеша без обращения к сети (None, если её нет или пора перепроверить)"""
+        entry = self._entries.get(url)
+        if entry and time.time() - entry.get('checked_at', 0) < self.fresh_for and os.path.exists(entry['path']):
+            return entry
+        return None
+
+    def known(self, url: str) -> Optional[Dict]:
+        """Запись кеша независимо от свежести (None, если файла нет)"""
+        entry = self._entries.get(url)
+        return entry if entry and os.path.exists(entry['path']) else None
+
+    def total_size(self) -> int:
+        return sum(e.get('size', 0) for e in self._entries.values())
+
+    async def fetch(self, url: str, app_id: int = None) -> Dict:
+        """Запись кеша с путём к актуальной копии файла (скачивает или перепроверяет при необходимости)"""
+        task = self._inflight.get(url)
+        if task is None:
+            task = asyncio.ensure_future(self._fetch(url, app_id))
+            self._inflight[url] = task
+            task.add_done_callback(lambda _: self._inflight.pop(url, None))
+        # shield: отмена одного ожидающего не прерывает общее скачивание
+        return await asyncio.shield(task)
+
+    def _stale_entry(self, url: str):
+        """(запись, заголовки условного запроса) для записи, которую пора перепроверить"""
+        entry = self._entries.get(url)
+        if entry and not os.path.exists(entry['path']):
+            entry = None
+        headers = {}
+        if entry:
+            if entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
+            if entry.get('last_modified'):
+                headers['If-Modified-Since'] = entry['last_modified']
+        return entry, headers
+
+    async def _fetch(self, url: str, app_id: int = None) -> Dict:
+        entry = self.peek(url)
+        if entry:
+            return self._touch(url, entry)
+        entry, headers = self._stale_entry(url)
+
+        async with get_http_session().get(url, headers=headers) as resp:
+            if resp.status == 304 and entry:
+                entry['checked_at'] = time.time()
+                return self._touch(url, entry)
+            if resp.status != 200:
+                raise DownloadError(resp.status)
+
+            fd, part_path = tempfile.mkstemp(dir=self.directory, prefix='part_')
+            try:
+                sha = hashlib.sha256()
+                with os.fdopen(fd, 'wb') as f:
+                    async for chunk in resp.content.iter_chunked(Config.RELAY_CHUNK_SIZE):
+                        sha.update(chunk)
+                        f.write(chunk)
+                return self._commit(url, part_path, resp, filename_from_response(resp, url, app_id), sha.hexdigest())
+            finally:
+                self._discard(part_path)
+
+    async def relay(self, url: str, app_id: int, send):
+        """Скачать url и одновременно загрузить в Telegram через send(document), без промежуточного файла.
+        Тело ответа параллельно пишется в кеш, так что следующие запросы возьмут его с диска.
+        Если размер неизвестен и тело больше RELAY_MEMORY_LIMIT, файл сначала скачивается целиком.
+        Возвращает (сообщение, запись кеша).
+        """
+        if url in self._inflight or self.peek(url):
+            entry = await self.fetch(url, app_id)
+            return await self._send_cached(entry, send), entry
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        # ошибку забирают ожидающие; если их нет — не пишем «exception was never retrieved»
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        self._inflight[url] = future
+        part_path = None
+        try:
+            entry, headers = self._stale_entry(url)
+            async with get_http_session().get(url, headers=headers) as resp:
+                if resp.status == 304 and entry:
+                    entry['checked_at'] = time.time()
+                    self._touch(url, entry)
+                    future.set_result(entry)
+                    return await self._send_cached(entry, send), entry
+                if resp.status != 200:
+                    raise DownloadError(resp.status)
+
+                filename = filename_from_response(resp, url, app_id)
+                fd, part_path = tempfile.mkstemp(dir=self.directory, prefix='part_')
+                with os.fdopen(fd, 'wb') as sink:
+                    prefix = b''
+                    if resp.content_length is None:
+                        # размер неизвестен: читаем в память не больше лимита
+                        buffer = bytearray()
+                        while len(buffer) <= Config.RELAY_MEMORY_LIMIT:
+                            chunk = await resp.content.read(Config.RELAY_CHUNK_SIZE)
+                            if not chunk:
+                                break
+                            buffer.extend(chunk)
+                        prefix = bytes(buffer)
+
+                    document = RelayInputFile(resp, filename, sink, prefix)
+                    if resp.content_length is None and len(prefix) > Config.RELAY_MEMORY_LIMIT:
+                        # большой файл неизвестного размера — докачиваем во временный файл и грузим с диска
+                        async for _ in document.read(None):
+                            pass
+                        msg = None
+                    else:
+                        msg = await send(document)
+
+                if not document.completed:
+                    raise DownloadError(resp.status)
+                entry = self._commit(url, part_path, resp, filename, document.sha.hexdigest())
+                future.set_result(entry)
+            if msg is None:
+                msg = await self._send_cached(entry, send)
+            return msg, entry
+        except BaseException as e:
+            if not future.done():
+                future.set_exception(e if isinstance(e, Exception) else DownloadError(0))
+            raise
+        finally:
+            self._inflight.pop(url, None)
+            if part_path:
+                self._discard(part_path)
+
+    async def _send_cached(self, entry: Dict, send):
+        with self.pinned(entry):
+            return await send(FSInputFile(entry['path'], filename=entry['filename']))
+
+    @staticmethod
+    def _discard(path: str):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def _commit(self, url: str, part_path: str, resp, filename: str, sha: str) -> Dict:
+        """Перенести скачанный файл в кеш и записать его в индекс"""
+        path = self._path_for(url)
+        os.replace(part_path, path)
+        entry = {
+            'url': url,
+            'path': path,
+            'filename': filename,
+            'size': os.path.getsize(path),
+            'sha256': sha,
+            'etag': resp.headers.get('ETag'),
+            'last_modified': resp.headers.get('Last-Modified'),
+            'checked_at': time.time(),
+        }
+        self._entries.pop(url, None)
+        self._touch(url, entry)
+        self._evict(keep=url)
+        return entry
+
+    def _touch(self, url: str, entry: Dict) -> Dict:
+        entry['used_at'] = time.time()
+        self._entries[url] = entry
+        self._entries.move_to_end(url)
+        self._mark_dirty()
+        return entry
+
+    def _evict(self, keep: str = None):
+        """Удалить давно не использованные файлы, пока кеш больше лимита"""
+        total = self.total_size()
+        for url in list(self._entries):
+            if total <= self.max_bytes:
+                break
+            entry = self._entries[url]
+            if url == keep or self._in_use.get(entry['path']):
+                continue
+            try:
+                os.remove(entry['path'])
+            except OSError:
+                pass
+            total -= entry.get('size', 0)
+            del self._entries[url]
+            logger.info(f"Файл вытеснен из кеша загрузок: {url}")
+        self._mark_dirty()
+
+    @contextmanager
+    def pinned(self, entry: Dict):
+        """Запрет вытеснения файла на время его отправки"""
+        path = entry['path']
+        self._in_use[path] = self._in_use.get(path, 0) + 1
+        try:
+            yield entry
+        finally:
+            self._in_use[path] -= 1
+            if not self._in_use[path]:
+                del self._in_use[path]
+
+
+download_cache = DownloadCache(Config.DOWNLOAD_CACHE_DIR, Config.DOWNLOAD_CACHE_MAX_BYTES, Config.DOWNLOAD_CACHE_FRESH_SECONDS)
+
+
+class DeliveryQueueFull(Exception):
+    """Очередь доставки заполнена"""
+
+
+class DeliveryQueue:
+    """Общая ограниченная очередь отправки файлов.
+    Задачи выполняют DELIVERY_WORKERS воркеров; пользователи обслуживаются по кругу,
+    поэтому один пользователь не может занять все воркеры.
+    """
+
+    def __init__(self, workers: int, max_size: int):
+        self.workers = workers
+        self.max_size = max_size
+        # user_id -> очередь задач (enqueued_at, job); порядок ключей — порядок обслуживания
+        self._queues: "OrderedDict[int, deque]" = OrderedDict()
+        self._size = 0
+        self._busy = 0
+        self._ready: Optional[asyncio.Semaphore] = None
+        self._tasks: List[asyncio.Task] = []
+        # метрики
+        self.processed = 0
+        self.failed = 0
+        self._wait_total = 0.0
+        self.max_wait = 0.0
+
+    def __len__(self):
+        return self._size
+
+    def position(self, user_id: int) -> int:
+        """Место последней задачи пользователя в очереди (1 — следующая) при обслуживании по кругу"""
+        own = len(self._queues.get(user_id, ()))
+        if not own:
+            return 0
+        return sum(min(len(q), own) if uid != user_id else own for uid, q in self._queues.items())
+
+    def submit(self, user_id: int, job) -> int:
+        """Поставить задачу (функцию без аргументов, возвращающую корутину); возвращает место в очереди"""
+        if self._size >= self.max_size:
+            raise DeliveryQueueFull()
+        self._queues.setdefault(user_id, deque()).append((time.monotonic(), job))
+        self._size += 1
+        if self._ready is not None:
+            self._ready.release()
+        return self.position(user_id)
+
+    def idle_workers(self) -> int:
+        return max(len(self._tasks) - self._busy, 0)
+
+    def _next_job(self):
+        user_id, queue = next(iter(self._queues.items()))
+        item = queue.popleft()
+        del self._queues[user_id]
+        if queue:
+            # у пользователя есть ещё задачи — он встаёт в конец круга
+            self._queues[user_id] = queue
+        self._size -= 1
+        return item
+
+    async def _worker(self):
+        while True:
+            await self._ready.acquire()
+            enqueued_at, job = self._next_job()
+            waited = time.monotonic() - enqueued_at
+            self._wait_total += waited
+            self.max_wait = max(self.max_wait, waited)
+            self._busy += 1
+            try:
+                await job()
+                self.processed += 1
+            except Exception as e:
+                self.failed += 1
+                logger.error(f"Ошибка задачи доставки: {e}")
+            finally:
+                self._busy -= 1
+
+    def start(self):
+        if self._tasks:
+            return
+        self._ready = asyncio.Semaphore(self._size)
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        tasks, self._tasks = self._tasks, []
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._ready = None
+
+    def metrics(self) -> Dict:
+        started = self.processed + self.failed + self._busy
+        return {
+            'depth': self._size,
+            'busy': self._busy,
+            'workers': len(self._tasks),
+            'processed': self.processed,
+            'failed': self.failed,
+            'avg_wait': self._wait_total / started if started else 0.0,
+            'max_wait': self.max_wait,
+        }
+
+
+delivery_queue = DeliveryQueue(Config.DELIVERY_WORKERS, Config.DELIVERY_QUEUE_MAX)
+
+
+async def notify_user(callback: types.CallbackQuery, text: str):
+    """Сообщение пользователю из фоновой доставки (callback к этому моменту уже отвечен)"""
+    try:
+        await callback.bot.send_message(callback.from_user.id, text)
+    except Exception:
+        try:
+            await callback.message.answer(text)
+        except Exception as e:
+            logger.warning(f"Не удалось уведомить пользователя {callback.from_user.id}: {e}")
+
+
+async def enqueue_delivery(callback: types.CallbackQuery, job):
+    """Поставить отправку файла в очередь и сообщить пользователю его место"""
+    uid = callback.from_user.id
+    # Блокировка: предотвращаем параллельные/повторные запросы от одного пользователя
+    token = delivery_locks.try_acquire(uid)
+    if token is None:
+        await callback.answer("⏳ Ваш предыдущий запрос всё ещё обрабатывается.", show_alert=True)
+        return
+
+    async def run():
+        try:
+            await job()
+        finally:
+            delivery_locks.release(uid, token)
+
+    try:
+        position = delivery_queue.submit(uid, run)
+    except DeliveryQueueFull:
+        delivery_locks.release(uid, token)
+        await callback.answer("⚠️ Сейчас слишком много запросов на файлы. Попробуйте через минуту.", show_alert=True)
+        return
+    if position <= delivery_queue.idle_workers():
+        await callback.answer("📤 Отправляем файл...")
+    else:
+        await callback.answer(f"⏳ Вы №{position} в очереди на отправку файла.", show_alert=True)
+
+
+def local_file_candidates(app: Dict, app_id: int = None) -> List[str]:
+    """Возможные пути локального файла приложения: file_path, file_name и стандартные имена по id"""
+    candidates = []
+    if app.get('file_path'):
+        candidates.append(app.get('file_path'))
+    if app.get('file_name'):
+        candidates.append(os.path.join('files', app.get('file_name')))
+    if app_id:
+        candidates.append(os.path.join('files', str(app_id)))
+        candidates.append(os.path.join('files', f"{app_id}.apk"))
+        candidates.append(os.path.join('files', f"{app_id}.zip"))
+    return candidates
+
+
+class FileLocationIndex:
+    """Индекс локальных файлов приложений: app_id -> {'path', 'size', 'mtime_ns'}.
+    Строится сканированием каталога при запуске, обновляется при добавлении, изменении
+    и удалении приложений и фоновой проверкой каталога, поэтому клавиатуры и отправка
+    файлов не обращаются к диску.
+    """
+
+    def __init__(self, directory: str, exclude: List[str] = ()):
+        self.directory = os.path.normpath(directory)
+        self.exclude = {os.path.normpath(p) for p in exclude}
+        # путь -> (размер, mtime_ns) для всех файлов каталога
+        self._files: Dict[str, tuple] = {}
+        self._locations: Dict[int, Dict] = {}
+        self._apps: Dict[int, Dict] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    def _scan(self) -> Dict[str, tuple]:
+        files = {}
+        for root, dirs, names in os.walk(self.directory):
+            dirs[:] = [d for d in dirs if os.path.join(root, d) not in self.exclude]
+            for name in names:
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                files[path] = (st.st_size, st.st_mtime_ns)
+        return files
+
+    def _stat(self, path: str) -> Optional[tuple]:
+        path = os.path.normpath(path)
+        if path.startswith(self.directory + os.sep):
+            return self._files.get(path)
+        # файл вне каталога (file_path с абсолютным путём) — проверяем напрямую
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return (st.st_size, st.st_mtime_ns) if os.path.isfile(path) else None
+
+    def update(self, app: Dict):
+        """Пересчитать расположение файла приложения"""
+        app_id = app.get('id')
+        if not app_id:
+            return
+        self._apps[app_id] = app
+        for path in local_file_candidates(app, app_id):
+            found = self._stat(path) if path else None
+            if found:
+                self._locations[app_id] = {'path': os.path.normpath(path), 'size': found[0], 'mtime_ns': found[1]}
+                return
+        self._locations.pop(app_id, None)
+
+    def forget(self, app_id: int):
+        self._apps.pop(app_id, None)
+        self._locations.pop(app_id, None)
+
+    def rebuild(self, apps: List[Dict], files: Dict[str, tuple] = None):
+        """Заново просканировать каталог (или взять готовый снимок) и разложить приложения"""
+        self._files = self._scan() if files is None else files
+        self._apps = {}
+        self._locations = {}
+        for app in apps:
+            self.update(app)
+
+    def get(self, app_id: int) -> Optional[Dict]:
+        return self._locations.get(app_id)
+
+    def path(self, app_id: int) -> Optional[str]:
+        location = self._locations.get(app_id)
+        return location['path'] if location else None
+
+    async def _watch(self, interval: float):
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                files = await loop.run_in_executor(None, self._scan)
+                if files != self._files:
+                    logger.info("Содержимое каталога файлов изменилось, обновляем индекс")
+                    self.rebuild(list(self._apps.values()), files)
+            except Exception as e:
+                logger.error(f"Ошибка проверки каталога файлов: {e}")
+
+    def start(self, interval: float):
+        if self._task is None:
+            self._task = asyncio.create_task(self._watch(interval))
+
+    async def stop(self):
+        task, self._task = self._task, None
+        if task is not None:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+
+
+file_locations = FileLocationIndex('files', [Config.DOWNLOAD_CACHE_DIR, os.path.join('files', 'tmp')])
+
+
+def parse_tme_link(link: str):
+    """(chat_id, message_id) сообщения по ссылке t.me/<канал>/<id> или t.me/c/<id>/<msg>, иначе (None, None)"""
+    try:
+        parts = urlparse(link).path.strip('/').split('/')
+        if parts[0] == 'c' and len(parts) >= 3:
+            return int(f"-100{parts[1]}"), int(parts[2])
+        if len(parts) >= 2:
+            return f"@{parts[0].lstrip('@')}", int(parts[1])
+    except (ValueError, IndexError):
+        pass
+    return None, None
+
+
+def is_tme_link(link: str) -> bool:
+    return bool(link) and ('t.me' in link or 'telegram.me' in link)
+
+
+class DeliveryContext:
+    """Данные одной доставки файла: приложение, получатель и результат"""
+
+    def __init__(self, callback: types.CallbackQuery, app_id: int, app: Dict):
+        self.callback = callback
+        self.bot = callback.bot
+        self.app_id = app_id
+        self.app = app
+        self.user_id = callback.from_user.id
+        # файл отправляем в ЛС; если бот не может писать пользователю — в чат с кнопкой
+        self.chat_id = callback.from_user.id
+        self.file_link = app.get('file_link') or ''
+        # при наличии file_link локальный файл не используется
+        self.local_path = None if self.file_link else file_locations.path(app_id)
+        self.error: Optional[Exception] = None
+
+    async def send_document(self, document):
+        return await self.bot.send_document(self.chat_id, document)
+
+
+class DeliveryStrategy:
+    """Способ доставки файла. Стратегии пробуются по возрастанию cost, пока одна не сработает"""
+    name = ''
+    title = ''
+    cost = 0
+
+    def applicable(self, ctx: DeliveryContext) -> bool:
+        raise NotImplementedError
+
+    async def deliver(self, ctx: DeliveryContext):
+        """Отправленное сообщение (или MessageId), либо None, если способ не подошёл"""
+        raise NotImplementedError
+
+
+class FileIdStrategy(DeliveryStrategy):
+    """Повторная отправка по сохранённому file_id — без загрузки"""
+    name = 'file_id'
+    title = 'file_id из кеша'
+    cost = 0
+
+    @staticmethod
+    def _remote(ctx: DeliveryContext) -> bool:
+        return ctx.file_link.startswith('http') and not is_tme_link(ctx.file_link)
+
+    def applicable(self, ctx: DeliveryContext) -> bool:
+        return ctx.local_path is not None or self._remote(ctx)
+
+    async def _version(self, ctx: DeliveryContext) -> Optional[str]:
+        """Версия файла, по которой ищется file_id (None — file_id заведомо нет)"""
+        if ctx.local_path:
+            return await file_id_cache.digest(ctx.local_path)
+        entry = download_cache.known(ctx.file_link)
+        if entry is None or not entry.get('sha256'):
+            # файл не скачивался: возможно, его уже отправляли по URL
+            return FileIdCache.url_version(ctx.file_link)
+        if not file_id_cache.get(ctx.app_id, entry['sha256']):
+            return None
+        if download_cache.peek(ctx.file_link) is None:
+            # запись устарела: условный запрос; при 304 хеш (и file_id) остаются прежними
+            entry = await download_cache.fetch(ctx.file_link, ctx.app_id)
+        return entry.get('sha256')
+
+    async def deliver(self, ctx: DeliveryContext):
+        sha = await self._version(ctx)
+        file_id = file_id_cache.get(ctx.app_id, sha) if sha else None
+        if not file_id:
+            return None
+        try:
+            return await ctx.send_document(file_id)
+        except TelegramBadRequest as e:
+            logger.info(f"file_id для приложения {ctx.app_id} не принят Telegram: {e}")
+            file_id_cache.forget(ctx.app_id, sha)
+            return None
+
+
+class CopyStrategy(DeliveryStrategy):
+    """Копирование сообщения с файлом из канала по ссылке t.me на стороне Telegram"""
+    name = 'copy'
+    title = 'копия из канала'
+    cost = 1
+
+    def applicable(self, ctx: DeliveryContext) -> bool:
+        return is_tme_link(ctx.file_link)
+
+    async def deliver(self, ctx: DeliveryContext):
+        from_chat_id, msg_id = parse_tme_link(ctx.file_link)
+        if not from_chat_id or not msg_id:
+            return None
+        try:
+            return await ctx.bot.copy_message(ctx.chat_id, from_chat_id, msg_id, caption='')
+        except TelegramForbiddenError:
+            raise
+        except Exception as e:
+            logger.info(f"copy_message по file_link не сработал: {e}, попробуем forward_message")
+        return await ctx.bot.forward_message(ctx.chat_id, from_chat_id, msg_id)
+
+
+class SendByUrlStrategy(DeliveryStrategy):
+    """Отправка по прямой ссылке: Telegram скачивает файл сам.
+    sendDocument по URL Telegram принимает только для GIF, PDF и ZIP; ссылки,
+    которые он отклонил, какое-то время не пробуем (сразу скачиваем сами).
+    """
+    name = 'url'
+    title = 'отправка по URL'
+    cost = 2
+    EXTENSIONS = ('.gif', '.pdf', '.zip')
+
+    def __init__(self):
+        # url -> True: Telegram не смог отправить файл по этой ссылке
+        self._rejected = ExpiringCache(Config.DELIVERY_DEDUP_MAX_USERS, Config.DELIVERY_URL_RETRY_AFTER)
+
+    def applicable(self, ctx: DeliveryContext) -> bool:
+        link = ctx.file_link
+        if not link.startswith('http') or is_tme_link(link) or link in self._rejected:
+            return False
+        return os.path.splitext(urlparse(link).path)[1].lower() in self.EXTENSIONS
+
+    async def deliver(self, ctx: DeliveryContext):
+        try:
+            msg = await ctx.send_document(ctx.file_link)
+        except TelegramBadRequest:
+            self._rejected.set(ctx.file_link, True)
+            raise
+        document = getattr(msg, 'document', None)
+        if document:
+            file_id_cache.put(ctx.app_id, FileIdCache.url_version(ctx.file_link), document.file_id)
+        return msg
+
+
+class DownloadUploadStrategy(DeliveryStrategy):
+    """Потоковая передача файла из file_link в Telegram (с сохранением в кеш загрузок)"""
+    name = 'download'
+    title = 'скачивание и загрузка'
+    cost = 3
+
+    def applicable(self, ctx: DeliveryContext) -> bool:
+        return ctx.file_link.startswith('http') and not is_tme_link(ctx.file_link)
+
+    async def deliver(self, ctx: DeliveryContext):
+        msg, entry = await download_cache.relay(ctx.file_link, ctx.app_id, ctx.send_document)
+        document = getattr(msg, 'document', None)
+        if document and entry.get('sha256'):
+            file_id_cache.put(ctx.app_id, entry['sha256'], document.file_id)
+        return msg
+
+
+class LocalUploadStrategy(DeliveryStrategy):
+    """Загрузка локального файла из папки files/"""
+    name = 'local'
+    title = 'локальный файл'
+    cost = 4
+
+    def applicable(self, ctx: DeliveryContext) -> bool:
+        return ctx.local_path is not None
+
+    async def deliver(self, ctx: DeliveryContext):
+        return await send_cached_document(ctx.send_document, ctx.app_id, ctx.local_path)
+
+
+class DeliveryPipeline:
+    """Доставка файла приложения: стратегии пробуются от самой дешёвой,
+    по каждой собираются число попыток, успехов и время выполнения.
+    """
+
+    def __init__(self, strategies: List[DeliveryStrategy]):
+        self.strategies = sorted(strategies, key=lambda strategy: strategy.cost)
+        self.stats: Dict[str, Dict] = {
+            strategy.name: {'attempts': 0, 'success': 0, 'seconds': 0.0} for strategy in self.strategies
+        }
+
+    async def _attempt(self, strategy: DeliveryStrategy, ctx: DeliveryContext):
+        stats = self.stats[strategy.name]
+        stats['attempts'] += 1
+        started = time.monotonic()
+        try:
+            result = await strategy.deliver(ctx)
+        finally:
+            stats['seconds'] += time.monotonic() - started
+        if result is not None:
+            stats['success'] += 1
+        return result
+
+    async def deliver(self, ctx: DeliveryContext):
+        """Результат первой сработавшей стратегии или None (последняя ошибка — в ctx.error)"""
+        for strategy in self.strategies:
+            if not strategy.applicable(ctx):
+                continue
+            try:
+                try:
+                    result = await self._attempt(strategy, ctx)
+                except TelegramForbiddenError:
+                    # бот не может написать пользователю в ЛС — отправляем в чат, где нажата кнопка
+                    fallback_chat = ctx.callback.message.chat.id if ctx.callback.message else None
+                    if fallback_chat is None or fallback_chat == ctx.chat_id:
+                        raise
+                    ctx.chat_id = fallback_chat
+                    result = await self._attempt(strategy, ctx)
+            except Exception as e:
+                logger.info(f"Доставка '{strategy.name}' для приложения {ctx.app_id} не удалась: {e}")
+                ctx.error = e
+                continue
+            if result is not None:
+                logger.info(f"ACTION: app {ctx.app_id} delivered to {ctx.chat_id} via {strategy.name}")
+                return result
+        return None
+
+    def metrics(self) -> List[Dict]:
+        return [
+            {
+                'name': strategy.name,
+                'title': strategy.title,
+                'attempts': self.stats[strategy.name]['attempts'],
+                'success': self.stats[strategy.name]['success'],
+                'avg_seconds': (self.stats[strategy.name]['seconds'] / self.stats[strategy.name]['attempts']
+                                if self.stats[strategy.name]['attempts'] else 0.0),
+            }
+            for strategy in self.strategies
+        ]
+
+
+delivery_pipeline = DeliveryPipeline([
+    FileIdStrategy(),
+    CopyStrategy(),
+    SendByUrlStrategy(),
+    DownloadUploadStrategy(),
+    LocalUploadStrategy(),
+])
+
+
+def _remember_delivery(user_id: int, msg):
+    """Запомнить отправленный файл, чтобы подавить повторную отправку в ближайшие секунды"""
+    file_unique_id = None
+    for attr in ('document', 'video', 'audio', 'animation'):
+        media = getattr(msg, attr, None)
+        if media is not None:
+            file_unique_id = media.file_unique_id
+            break
+    if file_unique_id is None and isinstance(getattr(msg, 'photo', None), list) and msg.photo:
+        file_unique_id = msg.photo[-1].file_unique_id
+    recent_deliveries.set(user_id, file_unique_id)
+
+
+async def send_cached_document(send, app_id: int, path: str, filename: str = None):
+    """Отправить локальный файл приложения через send(document) (bot.send_document с chat_id
+    или message.answer_document). Сначала пробуем file_id из кеша, иначе загружаем файл
+    и запоминаем полученный file_id.
+    """
+    sha = await file_id_cache.digest(path)
+    cached_id = file_id_cache.get(app_id, sha)
+    if cached_id:
+        try:
+            return await send(cached_id)
+        except TelegramBadRequest as e:
+            # file_id больше не действителен — забываем и загружаем заново
+            logger.info(f"file_id для приложения {app_id} не принят Telegram: {e}")
+            file_id_cache.forget(app_id, sha)
+    msg = await send(FSInputFile(path, filename=filename))
+    document = getattr(msg, 'document', None)
+    if document:
+        file_id_cache.put(app_id, sha, document.file_id, path)
+    return msg
+
+# ================== РАССЫЛКИ ==================
+
+class TokenBucket:
+    """Ограничитель частоты запросов: не больше rate в секунду, всплеск до capacity.
+    pause() приостанавливает всех ожидающих (ответ Telegram RetryAfter).
+    """
+
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def pause(self, seconds: float):
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self.tokens = 0
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            if now < self._paused_until:
+                await asyncio.sleep(self._paused_until - now)
+                continue
+            self._refill(now)
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+# Причины, по которым пользователю больше нельзя писать
+UNREACHABLE_REASONS = ('blocked', 'deactivated', 'not_found')
+
+
+def classify_send_error(error: Exception) -> str:
+    """Причина неудачной отправки: blocked, deactivated, not_found или transient (можно повторить позже)"""
+    text = str(error).lower()
+    if isinstance(error, TelegramForbiddenError):
+        if 'deactivated' in text:
+            return 'deactivated'
+        return 'blocked'
+    if isinstance(error, TelegramBadRequest) and ('chat not found' in text or 'user not found' in text):
+        return 'not_found'
+    return 'transient'
+
+
+class BroadcastManager:
+    """Очередь рассылок с сохранением прогресса в data/broadcasts.json.
+    Сообщения отправляют несколько воркеров через общий TokenBucket (лимит Telegram —
+    около 30 сообщений в секунду на бота; каждому пользователю уходит одно сообщение,
+    поэтому лимит на чат соблюдается сам собой). Список получателей пишется один раз
+    в отдельный файл, а в broadcasts.json раз в BROADCAST_CHECKPOINT_INTERVAL секунд
+    сохраняются только позиция и счётчики; после перезапуска рассылка продолжается
+    с сохранённого места. Администратору показывается обновляемое сообщение с прогрессом.
+    """
+
+    MAX_ATTEMPTS = 3
+
+    def __init__(self, filename: str, rate: float, workers: int, checkpoint_interval: float):
+        self.filename = filename
+        self.bucket = TokenBucket(rate)
+        self.workers = workers
+        self.checkpoint_interval = checkpoint_interval
+        self.jobs: List[Dict] = Config.load_json_file(filename, [])
+        # id рассылки -> получатели (загружаются из файла при продолжении)
+        self._audiences: Dict[int, List[int]] = {}
+        for job in self.jobs:
+            if 'audience' in job:
+                # старый формат: получатели лежали прямо в broadcasts.json
+                audience = job.pop('audience')
+                if job.get('status') == 'running':
+                    self._audiences[job['id']] = audience
+                    Config.save_json_file(self._audience_file(job['id']), audience)
+        self.bot = None
+        self._task: Optional[asyncio.Task] = None
+        self._wake: Optional[asyncio.Event] = None
+        self._last_checkpoint = 0.0
+        self._saving = False
+
+    def _save(self):
+        Config.save_json_file(self.filename, self.jobs)
+
+    async def _save_async(self):
+        """Сохранить состояние рассылок: снимок в цикле событий, запись файла в потоке"""
+        self._saving = True
+        try:
+            text = Config.dump_json(self.jobs)
+            await asyncio.get_running_loop().run_in_executor(None, Config.write_text_atomic, self.filename, text)
+        finally:
+            self._saving = False
+
+    def _audience_file(self, job_id: int) -> str:
+        return f"{os.path.splitext(self.filename)[0]}_{job_id}_audience.json"
+
+    def _audience(self, job: Dict) -> List[int]:
+        audience = self._audiences.get(job['id'])
+        if audience is None:
+            path = self._audience_file(job['id'])
+            if not os.path.exists(path):
+                raise FileNotFoundError(path)
+            audience = self._audiences[job['id']] = Config.load_json_file(path, [])
+        return audience
+
+    def create(self, text: str, audience: List[int], admin_chat_id: int = None, parse_mode: str = 'HTML') -> Dict:
+        """Поставить рассылку в очередь"""
+        job = {
+            'id': max((j['id'] for j in self.jobs), default=0) + 1,
+            'text': text,
+            'parse_mode': parse_mode,
+            'total': len(audience),
+            # все получатели с индексом меньше cursor уже обработаны
+            'cursor': 0,
+            'sent': 0,
+            'failed': 0,
+            'status': 'running',
+            'admin_chat_id': admin_chat_id,
+            'progress_message_id': None,
+            'created_at': datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        }
+        self._audiences[job['id']] = list(audience)
+        Config.save_json_file(self._audience_file(job['id']), self._audiences[job['id']])
+        self.jobs.append(job)
+        self._save()
+        if self._wake is not None:
+            self._wake.set()
+        return job
+
+    def pending(self) -> List[Dict]:
+        return [j for j in self.jobs if j.get('status') == 'running']
+
+    async def _send(self, job: Dict, uid: int) -> str:
+        """Отправить сообщение рассылки; результат — 'sent', 'skipped' или причина из classify_send_error"""
+        if db.get_user(uid).get('inactive'):
+            return 'skipped'
+        for _ in range(self.MAX_ATTEMPTS):
+            await self.bucket.acquire()
+            try:
+                await self.bot.send_message(uid, job['text'], parse_mode=job.get('parse_mode'))
+                return 'sent'
+            except TelegramRetryAfter as e:
+                logger.warning(f"Рассылка {job['id']}: лимит Telegram, пауза {e.retry_after} с")
+                self.bucket.pause(e.retry_after)
+            except Exception as e:
+                reason = classify_send_error(e)
+                if reason in UNREACHABLE_REASONS:
+                    # пользователь недоступен навсегда — исключаем его из следующих рассылок
+                    db.mark_user_inactive(uid, reason)
+                else:
+                    logger.warning(f"Не удалось отправить рассылку пользователю {uid}: {e}")
+                return reason
+        return 'transient'
+
+    async def _report(self, job: Dict):
+        """Создать или обновить сообщение администратору с прогрессом рассылки"""
+        chat_id = job.get('admin_chat_id')
+        if not chat_id:
+            return
+        done = job['status'] == 'done'
+        text = (
+            f"{'✅ Рассылка завершена' if done else '📨 Идёт рассылка'} #{job['id']}\n\n"
+            f"Обработано: {job['cursor']} из {job['total']}\n"
+            f"Доставлено: {job['sent']}\n"
+            f"Не доставлено: {job['failed']}"
+            f" (из них заблокировали бота или удалены: {job.get('pruned', 0)})"
+        )
+        try:
+            if job.get('progress_message_id'):
+                await self.bot.edit_message_text(text, chat_id=chat_id, message_id=job['progress_message_id'])
+            else:
+                msg = await self.bot.send_message(chat_id, text)
+                job['progress_message_id'] = msg.message_id
+        except TelegramBadRequest as e:
+            if 'not modified' not in str(e):
+                logger.warning(f"Не удалось обновить прогресс рассылки {job['id']}: {e}")
+        except Exception as e:
+            logger.warning(f"Не удалось обновить прогресс рассылки {job['id']}: {e}")
+
+    async def _checkpoint(self, job: Dict, force: bool = False):
+        now = time.monotonic()
+        if force or (now - self._last_checkpoint >= self.checkpoint_interval and not self._saving):
+            self._last_checkpoint = now
+            await self._report(job)
+            await self._save_async()
+
+    async def run_job(self, job: Dict):
+        """Отправить рассылку, начиная с сохранённой позиции"""
+        audience = self._audience(job)
+        # индекс -> результат отправки для получателей, обработанных не по порядку
+        results: Dict[int, str] = {}
+        next_index = job['cursor']
+
+        async def worker():
+            nonlocal next_index
+            while next_index < len(audience):
+                index = next_index
+                next_index += 1
+                results[index] = await self._send(job, audience[index])
+                while job['cursor'] in results:
+                    outcome = results.pop(job['cursor'])
+                    if outcome == 'sent':
+                        job['sent'] += 1
+                    elif outcome in UNREACHABLE_REASONS:
+                        job['failed'] += 1
+                        job['pruned'] = job.get('pruned', 0) + 1
+                    elif outcome != 'skipped':
+                        job['failed'] += 1
+                    job['cursor'] += 1
+                await self._checkpoint(job)
+
+        try:
+            await asyncio.gather(*(worker() for _ in range(self.workers)))
+            job['status'] = 'done'
+            self._audiences.pop(job['id'], None)
+            try:
+                os.remove(self._audience_file(job['id']))
+            except OSError:
+                pass
+            job['finished_at'] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            logger.info(f"Рассылка {job['id']} завершена: отправлено={job['sent']}, не доставлено={job['failed']}")
+        finally:
+            self._save()
+        await self._checkpoint(job, force=True)
+
+    async def _loop(self):
+        while True:
+            pending = self.pending()
+            if not pending:
+                self._wake.clear()
+                await self._wake.wait()
+                continue
+            try:
+                await self.run_job(pending[0])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Ошибка рассылки {pending[0]['id']}: {e}")
+                pending[0]['status'] = 'failed'
+                self._save()
+
+    def start(self, bot):
+        """Запустить обработку очереди (незавершённые рассылки продолжаются)"""
+        self.bot = bot
+        self._wake = asyncio.Event()
+        if self._task is None:
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        task, self._task = self._task, None
+        if task is not None:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        self._save()
+
+
+broadcasts = BroadcastManager(Config.BROADCASTS_FILE, Config.BROADCAST_RATE, Config.BROADCAST_WORKERS,
+                              Config.BROADCAST_CHECKPOINT_INTERVAL)
+
+
+# ================== ЗАВЕРШЕНИЕ РОЗЫГРЫШЕЙ ==================
+
+def giveaway_deadline(giveaway: Dict) -> Optional[float]:
+    """Момент окончания розыгрыша (timestamp) или None, если дата не задана или некорректна"""
+    if 'end_ts' in giveaway:
+        return giveaway['end_ts']
+    return parse_end_datetime(giveaway.get('end_datetime', ''))
+
+
+def giveaway_needs_draw(giveaway: Dict) -> bool:
+    """Розыгрыш ещё ждёт подведения итогов (победитель не выбран и итоги не подводились вручную)"""
+    return not giveaway.get('winner') and not giveaway.get('end_date_actual')
+
+
+def draw_winners(ids, k: int, exclude=(), rng: random.Random = None) -> List[int]:
+    """K различных победителей за один проход по массиву id (reservoir sampling).
+    Пользователи из exclude (множество) пропускаются; память — O(k) независимо от числа участников.
+    """
+    rng = rng or random.Random(secrets.randbits(128))
+    reservoir: List[int] = []
+    seen = 0
+    for uid in ids:
+        if uid in exclude:
+            continue
+        seen += 1
+        if len(reservoir) < k:
+            reservoir.append(uid)
+        else:
+            j = rng.randrange(seen)
+            if j < k:
+                reservoir[j] = uid
+    # порядок в резервуаре зависит от позиции в списке — перемешиваем для мест победителей
+    rng.shuffle(reservoir)
+    return reservoir
+
+
+def append_draw_audit(audit: Dict):
+    """Дописать запись в журнал аудита розыгрышей (выполняется в потоке)"""
+    try:
+        os.makedirs(os.path.dirname(Config.DRAW_AUDIT_FILE) or '.', exist_ok=True)
+        with open(Config.DRAW_AUDIT_FILE, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(audit, ensure_ascii=False) + '\n')
+    except OSError as e:
+        logger.error(f"Не удалось записать аудит розыгрыша {audit['giveaway_id']}: {e}")
+
+
+async def run_giveaway_draw(giveaway: Dict) -> Optional[List[int]]:
+    """Провести розыгрыш: выбрать winners_count победителей, записать их в базу и входные данные
+    в журнал аудита. None — итоги уже подведены (другим вызовом), повторно не разыгрываем.
+    Зерно (128 бит) берётся из secrets и не публикуется до розыгрыша; random.Random с этим зерном,
+    а не SystemRandom, — чтобы по зерну, хешу списка id и исключённым id результат можно было проверить.
+    """
+    if not giveaway_needs_draw(giveaway):
+        return None
+    participants = ParticipantList.coerce(giveaway.get('participants'))
+    k = max(int(giveaway.get('winners_count') or 1), 1)
+    exclude = db.get_draw_exclusions()
+    seed = secrets.randbits(128)
+    winners = draw_winners(participants.ids, k, exclude, random.Random(seed))
+    if winners:
+        # победители записываются до первого await: параллельный розыгрыш увидит, что итоги подведены
+        db.end_giveaway(giveaway.get('id'), winners=winners)
+
+    ids = array('q', participants.ids)
+    if sys.byteorder != 'little':
+        ids.byteswap()
+    audit = {
+        'giveaway_id': giveaway.get('id'),
+        'time': datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        'seed': format(seed, '032x'),
+        'entrants': len(participants),
+        'entrants_sha256': hashlib.sha256(ids.tobytes()).hexdigest(),
+        'excluded': sorted(uid for uid in exclude if uid in participants),
+        'winners_count': k,
+        'winners': winners,
+    }
+    logger.info(f"Розыгрыш {audit['giveaway_id']}: seed={audit['seed']} участников={audit['entrants']} "
+                f"sha256={audit['entrants_sha256']} исключено={len(audit['excluded'])} победители={winners}")
+    await asyncio.get_running_loop().run_in_executor(None, append_draw_audit, audit)
+    return winners
+
+
+def format_winners(giveaway: Dict, default: str = 'Неизвестно') -> str:
+    """Имена победителей розыгрыша через запятую"""
+    winners = giveaway.get('winners') or ([giveaway['winner']] if giveaway.get('winner') else [])
+    names = [w.get('username') or w.get('first_name') or str(w.get('id')) for w in winners]
+    return ', '.join(names) or default
+
+
+async def finish_giveaway(bot, gid: int):
+    """Подвести итоги розыгрыша: выбрать победителей и уведомить их"""
+    giveaway = db.get_giveaway_by_id(gid)
+    if not giveaway or not giveaway_needs_draw(giveaway):
+        return
+
+    winner_ids = await run_giveaway_draw(giveaway)
+    if winner_ids is None:
+        return
+    if not winner_ids:
+        # помечаем как завершённый без победителя
+        db.end_giveaway(gid)
+        logger.info(f"Giveaway {gid} ended: no eligible participants")
+        return
+
+    # Отправляем личное сообщение каждому победителю
+    for winner_id in winner_ids:
+        try:
+            await bot.send_message(
+                winner_id,
+                f"🎉 Поздравляем! Вы выиграли в розыгрыше: <b>{giveaway.get('title')}</b>!\n\n" \
+                f"🆔 ID розыгрыша: {gid}\n\n" \
+                f"Свяжитесь с администрацией для получения приза.",
+                parse_mode='HTML'
+            )
+            logger.info(f"Notified winner {winner_id} for giveaway {gid}")
+        except Exception as e:
+            logger.error(f"Не удалось уведомить победителя {winner_id}: {e}")
+
+
+class GiveawayScheduler:
+    """Планировщик окончания розыгрышей.
+    Хранит min-heap (время окончания, id) ожидающих розыгрышей и спит ровно до ближайшего;
+    при создании, изменении и удалении розыгрыша перепланируется через schedule()/unschedule().
+    Устаревшие записи кучи не удаляются сразу, а пропускаются при извлечении.
+    """
+
+    # предел одного ожидания: защита от перевода системных часов
+    MAX_SLEEP = 3600
+
+    def __init__(self, on_due):
+        self.on_due = on_due
+        self.bot = None
+        self._heap: List[tuple] = []
+        # id -> актуальное время окончания
+        self._deadlines: Dict[int, float] = {}
+        self._wake: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def __len__(self):
+        return len(self._deadlines)
+
+    def schedule(self, giveaway: Dict):
+        """Запланировать (или перепланировать) подведение итогов розыгрыша"""
+        gid = giveaway.get('id')
+        deadline = giveaway_deadline(giveaway)
+        if not gid or deadline is None or not giveaway_needs_draw(giveaway):
+            self.unschedule(gid)
+            return
+        if self._deadlines.get(gid) == deadline:
+            return
+        self._deadlines[gid] = deadline
+        heapq.heappush(self._heap, (deadline, gid))
+        if self._wake is not None:
+            self._wake.set()
+
+    def unschedule(self, gid: int):
+        if self._deadlines.pop(gid, None) is not None and self._wake is not None:
+            self._wake.set()
+
+    def rebuild(self, giveaways: List[Dict]):
+        self._heap = []
+        self._deadlines = {}
+        for giveaway in giveaways:
+            self.schedule(giveaway)
+
+    def next_deadline(self) -> Optional[tuple]:
+        """(время окончания, id) ближайшего розыгрыша без извлечения из кучи"""
+        while self._heap:
+            deadline, gid = self._heap[0]
+            if self._deadlines.get(gid) == deadline:
+                return deadline, gid
+            heapq.heappop(self._heap)
+        return None
+
+    def pop_due(self, now: float) -> List[int]:
+        """Извлечь id всех розыгрышей, время которых наступило"""
+        due = []
+        while True:
+            nearest = self.next_deadline()
+            if nearest is None or nearest[0] > now:
+                return due
+            heapq.heappop(self._heap)
+            del self._deadlines[nearest[1]]
+            due.append(nearest[1])
+
+    async def _loop(self):
+        while True:
+            for gid in self.pop_due(time.time()):
+                try:
+                    await self.on_due(self.bot, gid)
+                except Exception as e:
+                    logger.error(f"Ошибка подведения итогов розыгрыша {gid}: {e}")
+            self._wake.clear()
+            nearest = self.next_deadline()
+            timeout = None if nearest is None else min(max(nearest[0] - time.time(), 0), self.MAX_SLEEP)
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def start(self, bot, giveaways: List[Dict]):
+        self.bot = bot
+        self._wake = asyncio.Event()
+        self.rebuild(giveaways)
+        if self._task is None:
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        task, self._task = self._task, None
+        if task is not None:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+
+
+giveaway_scheduler = GiveawayScheduler(finish_giveaway)
+
 
 # ================== КЛАВИАТУРЫ ==================
 
@@ -611,12 +3308,10 @@ async def manager_add_id_handler(message: types.Message, state: FSMContext):
         except Exception:
             await message.answer("❌ Введите корректный числовой ID пользователя.")
             return
-        admins = Config.load_admins()
-        for admin in admins:
-            if admin['id'] == user_id:
-                await message.answer("❌ Этот пользователь уже администратор или менеджер.")
-                await state.clear()
-                return
+        if Config.is_admin(user_id):
+            await message.answer("❌ Этот пользователь уже администратор или менеджер.")
+            await state.clear()
+            return
         Config.add_admin(user_id, level=Config.ADMIN_LEVELS['manager'])
         await message.answer(f"✅ Пользователь {user_id} назначен менеджером.")
     except Exception as e:
@@ -685,25 +3380,8 @@ def build_app_keyboard(app: Dict, app_id: int = None) -> Optional[InlineKeyboard
         else:
             buttons.append(InlineKeyboardButton(text="📁 Скачать файл", url=file_link))
     else:
-        # Попытка найти локальный файл по полям app
-        local_candidates = []
-        if app.get('file_path'):
-            local_candidates.append(app.get('file_path'))
-        if app.get('file_name'):
-            local_candidates.append(os.path.join('files', app.get('file_name')))
-        # несколько стандартных вариантов по id
-        if app_id:
-            local_candidates.append(os.path.join('files', str(app_id)))
-            local_candidates.append(os.path.join('files', f"{app_id}.apk"))
-            local_candidates.append(os.path.join('files', f"{app_id}.zip"))
-
-        found_local = None
-        for p in local_candidates:
-            if p and os.path.exists(p):
-                found_local = p
-                break
-
-        if found_local and app_id:
+        # Локальный файл ищем в индексе, без обращений к диску
+        if app_id and file_locations.get(app_id):
             buttons.append(InlineKeyboardButton(text="📁 Получить файл", callback_data=f"get_file:{app_id}"))
 
     if not buttons:
@@ -991,8 +3669,7 @@ async def winners_handler(message: types.Message):
         winners_text = "🏆 <b>Победители розыгрышей:</b>\n\n"
         
         for i, giveaway in enumerate(ended_giveaways[:5], 1):
-            winner = giveaway.get('winner', {})
-            winner_name = winner.get('username', winner.get('first_name', 'Неизвестно'))
+            winner_name = format_winners(giveaway)
             
             winners_text += (
                 f"{i}. 🎁 <b>{giveaway.get('title', 'Без названия')}</b>\n"
@@ -1022,38 +3699,30 @@ async def view_giveaway_details(callback: types.CallbackQuery):
         
         # Проверяем, не завершен ли розыгрыш
         if giveaway.get('ended', False):
-            winner = giveaway.get('winner', {})
-            winner_name = winner.get('username', winner.get('first_name', 'Победитель'))
+            winner_name = format_winners(giveaway, 'Победитель')
             
             await callback.message.answer(
                 f"🏁 <b>Розыгрыш завершен</b>\n\n"
                 f"🎁 <b>{giveaway.get('title', 'Без названия')}</b>\n"
                 f"🏆 <b>Приз:</b> {giveaway.get('prize', 'Не указан')}\n"
                 f"👑 <b>Победитель:</b> {winner_name}\n"
-                f"👥 <b>Участников:</b> {len(giveaway.get('participants', []))}\n\n"
+                f"👥 <b>Участников:</b> {db.get_participant_count(giveaway.get('id'))}\n\n"
                 f"Спасибо всем за участие!",
                 parse_mode='HTML'
             )
             await callback.answer()
             return
         
-        # Проверяем время окончания
-        end_datetime_str = giveaway.get('end_datetime', '')
-        try:
-            end_datetime = datetime.strptime(end_datetime_str, "%d.%m.%Y %H:%M")
-            if datetime.now() >= end_datetime:
-                # Автоматически завершаем розыгрыш
-                db.end_giveaway(giveaway_id)
-                await callback.message.answer(
-                    "🏁 <b>Розыгрыш завершен</b>\n\n"
-                    "Время участия в этом розыгрыше истекло.\n"
-                    "Результаты будут опубликованы в ближайшее время.",
-                    parse_mode='HTML'
-                )
-                await callback.answer()
-                return
-        except:
-            pass
+        # Проверяем время окончания (итоги подведёт планировщик розыгрышей)
+        if db.is_giveaway_expired(giveaway):
+            await callback.message.answer(
+                "🏁 <b>Розыгрыш завершен</b>\n\n"
+                "Время участия в этом розыгрыше истекло.\n"
+                "Результаты будут опубликованы в ближайшее время.",
+                parse_mode='HTML'
+            )
+            await callback.answer()
+            return
         
         # Формируем информацию о розыгрыше
         time_remaining = format_time_remaining(giveaway.get('end_datetime', ''))
@@ -1064,7 +3733,7 @@ async def view_giveaway_details(callback: types.CallbackQuery):
             f"🏆 <b>Приз:</b> {giveaway.get('prize', 'Не указан')}\n"
             f"📅 <b>Окончание:</b> {giveaway.get('end_datetime', 'Не указано')}\n"
             f"{time_remaining}\n"
-            f"👥 <b>Участников:</b> {len(giveaway.get('participants', []))}"
+            f"👥 <b>Участников:</b> {db.get_participant_count(giveaway.get('id'))}"
         )
         
         # Получаем меню действий
@@ -1089,7 +3758,7 @@ async def participate_in_giveaway(callback: types.CallbackQuery):
             return
         
         # Проверяем, не завершен ли розыгрыш
-        if giveaway.get('ended', False):
+        if giveaway.get('ended', False) or db.is_giveaway_expired(giveaway):
             await callback.message.answer("❌ Этот розыгрыш уже завершен.")
             await callback.answer()
             return
@@ -1113,7 +3782,7 @@ async def participate_in_giveaway(callback: types.CallbackQuery):
                 f"🏆 <b>Приз:</b> {giveaway.get('prize', 'Не указан')}\n"
                 f"📅 <b>Окончание:</b> {giveaway.get('end_datetime', 'Не указано')}\n"
                 f"{time_remaining}\n"
-                f"👥 <b>Участников:</b> {len(giveaway.get('participants', []))}\n\n"
+                f"👥 <b>Участников:</b> {db.get_participant_count(giveaway.get('id'))}\n\n"
                 f"<i>Удачи в розыгрыше! Результаты будут объявлены после окончания.</i>"
             )
             
@@ -1128,573 +3797,86 @@ async def participate_in_giveaway(callback: types.CallbackQuery):
         await callback.answer()
 
 
-@dp.callback_query(F.data.startswith("get_file:"))
-async def send_app_file(callback: types.CallbackQuery):
-    """Отправляет локальный файл приложения по нажатию кнопки.
-    Ожидается, что запись приложения может содержать `file_path` или `file_name`.
-    Также пробуем несколько стандартных вариантов в папке `files/`.
-    """
+async def deliver_app_file(callback: types.CallbackQuery, app_id: int, with_preview: bool = False):
+    """Отправка файла приложения пользователю (выполняется воркером очереди доставки)"""
     try:
-        # Блокировка: предотвращаем параллельные/повторные запросы от одного пользователя
-        uid = callback.from_user.id
-        if recent_sending.get(uid):
-            await callback.answer("⏳ Ваш предыдущий запрос всё ещё обрабатывается.", show_alert=True)
-            return
-        recent_sending[uid] = True
-
-        app_id = int(callback.data.split(":")[1])
         app = db.get_app_by_id(app_id)
         if not app:
-            await callback.answer("❌ Приложение не найдено")
+            await notify_user(callback, "❌ Приложение не найдено")
             return
-
-        candidates = []
-        if app.get('file_path'):
-            candidates.append(app.get('file_path'))
-        if app.get('file_name'):
-            candidates.append(os.path.join('files', app.get('file_name')))
-        candidates.append(os.path.join('files', str(app_id)))
-        candidates.append(os.path.join('files', f"{app_id}.apk"))
-        candidates.append(os.path.join('files', f"{app_id}.zip"))
-
-        found = None
-        for p in candidates:
-            if p and os.path.exists(p):
-                found = p
-                break
-
-        if not found:
-            await callback.answer("❌ Файл не найден на сервере.", show_alert=True)
+        ctx = DeliveryContext(callback, app_id, app)
+        if not ctx.file_link and not ctx.local_path:
+            await notify_user(callback, "❌ Файл не найден на сервере.")
             return
 
-        # Флаг: был ли уже отправлен файл в ходе обработки (чтобы предотвратить дубли)
-        already_sent = False
+        # Если недавно уже был отправлен файл — не дублируем
+        if ctx.user_id in recent_deliveries:
+            logger.info(f"Skipping send: recent file sent to user {ctx.user_id} {recent_deliveries.get(ctx.user_id)}")
+            return
 
-        # Если указан file_link на t.me — пробуем переслать сам файл из этого сообщения (приоритет)
-        file_link = app.get('file_link', '')
-        # Отключаем server-side пересылку (copy/forward) для t.me — принудительно скачиваем файл
-        if False and file_link and 't.me' in file_link:
+        if with_preview:
+            preview_text = (
+                f"🎮 <b>{app.get('name', 'Без названия')}</b>\n"
+                f"🎮 <b>Жанр:</b> {app.get('genre', 'Не указан')}\n"
+                f"📦 <b>Размер:</b> {app.get('size_category', 'Не указан')}\n\n"
+                f"📄 <b>Описание:</b>\n{app.get('description', 'Нет описания')}\n\n"
+                f"🔗 <b>Ссылка на пост:</b> {app.get('post_link', 'Не указана')}"
+            )
+            preview_kb = None
+            if app.get('post_link'):
+                preview_kb = InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="📱 Перейти к посту", url=app.get('post_link'))]])
             try:
-                parsed = urlparse(file_link)
-                parts = parsed.path.strip('/').split('/')
-                if parts:
-                    if parts[0] == 'c' and len(parts) >= 3:
-                        channel_part = parts[1]
-                        msg_id = int(parts[2])
-                        from_chat_id = int(f"-100{channel_part}")
-                    elif len(parts) >= 2:
-                        username = parts[0]
-                        msg_id = int(parts[1])
-                        from_chat_id = f"@{username.lstrip('@')}"
-                    else:
-                        from_chat_id = None
-                        msg_id = None
-
-                    if from_chat_id and msg_id:
-                        try:
-                            copied_msg = None
-                            try:
-                                copied_msg = await callback.bot.copy_message(callback.from_user.id, from_chat_id, msg_id)
-                                logger.info(f"File post (msg {msg_id}) from file_link copied to user {callback.from_user.id}")
-                                logger.info(f"ACTION: copy_message succeeded for msg={msg_id} user={callback.from_user.id}")
-                                try:
-                                    attrs = {k: bool(getattr(copied_msg, k, None)) for k in ['document','photo','video','animation','audio','voice','caption','text']}
-                                    logger.debug(f"copied_msg attrs (file_link, send_app_file): {attrs}")
-                                except Exception:
-                                    logger.debug("copied_msg has no detailed attrs (file_link, send_app_file)")
-                                if copied_msg and (getattr(copied_msg, 'document', None) or getattr(copied_msg, 'photo', None) or getattr(copied_msg, 'video', None) or getattr(copied_msg, 'animation', None) or getattr(copied_msg, 'audio', None) or getattr(copied_msg, 'voice', None)):
-                                    try:
-                                        await callback.bot.edit_message_caption(chat_id=callback.from_user.id, message_id=copied_msg.message_id, caption='')
-                                    except Exception:
-                                        pass
-                                    # Сохраним уникальный id отправленного файла (ниже записываем с timestamp)
-                                    already_sent = True
-                                    # записываем уникальный id и отметку времени
-                                    try:
-                                        if getattr(copied_msg, 'document', None):
-                                            recent_sent_files[uid] = (copied_msg.document.file_unique_id, time.time())
-                                        elif getattr(copied_msg, 'photo', None) and isinstance(copied_msg.photo, list) and copied_msg.photo:
-                                            recent_sent_files[uid] = (copied_msg.photo[-1].file_unique_id, time.time())
-                                        elif getattr(copied_msg, 'video', None):
-                                            recent_sent_files[uid] = (copied_msg.video.file_unique_id, time.time())
-                                    except Exception:
-                                        pass
-                                    await callback.answer()
-                                    recent_sending[uid] = False
-                                    return
-                            except Exception as e:
-                                logger.info(f"copy_message по file_link не сработал в send_app_file: {e}, попробуем forward_message")
-
-                            if not copied_msg:
-                                try:
-                                    forwarded_msg = await callback.bot.forward_message(callback.from_user.id, from_chat_id, msg_id)
-                                    logger.info(f"File post (msg {msg_id}) forwarded to user {callback.from_user.id}")
-                                    logger.info(f"ACTION: forward_message succeeded for msg={msg_id} user={callback.from_user.id}")
-                                    try:
-                                        attrs = {k: bool(getattr(forwarded_msg, k, None)) for k in ['document','photo','video','animation','audio','voice','caption','text']}
-                                        logger.debug(f"forwarded_msg attrs (file_link, send_app_file): {attrs}")
-                                    except Exception:
-                                        logger.debug("forwarded_msg has no detailed attrs (file_link, send_app_file)")
-                                    if forwarded_msg and (getattr(forwarded_msg, 'document', None) or getattr(forwarded_msg, 'photo', None) or getattr(forwarded_msg, 'video', None) or getattr(forwarded_msg, 'animation', None) or getattr(forwarded_msg, 'audio', None) or getattr(forwarded_msg, 'voice', None)):
-                                        try:
-                                            await callback.bot.edit_message_caption(chat_id=callback.from_user.id, message_id=forwarded_msg.message_id, caption='')
-                                        except Exception:
-                                            pass
-                                        # Сохранение с timestamp ниже
-                                        already_sent = True
-                                        try:
-                                            if getattr(forwarded_msg, 'document', None):
-                                                recent_sent_files[uid] = (forwarded_msg.document.file_unique_id, time.time())
-                                            elif getattr(forwarded_msg, 'photo', None) and isinstance(forwarded_msg.photo, list) and forwarded_msg.photo:
-                                                recent_sent_files[uid] = (forwarded_msg.photo[-1].file_unique_id, time.time())
-                                            elif getattr(forwarded_msg, 'video', None):
-                                                recent_sent_files[uid] = (forwarded_msg.video.file_unique_id, time.time())
-                                        except Exception:
-                                            pass
-                                        await callback.answer()
-                                        recent_sending[uid] = False
-                                        return
-                                except Exception as e:
-                                    logger.info(f"forward_message по file_link не сработал в send_app_file: {e}")
-                        except Exception as e:
-                            logger.debug(f"Ошибка при попытке переслать файл по file_link в send_app_file: {e}")
+                await callback.bot.send_message(ctx.user_id, preview_text, parse_mode='HTML', reply_markup=preview_kb)
             except Exception as e:
-                logger.debug(f"Не удалось распарсить file_link для пересылки в send_app_file: {e}")
-
-        
-
-        # Если указан file_link — приоритетно отправляем файл, на который он указывает.
-        # Не отправляем локальный `found`, если `file_link` присутствует.
-        file_link = app.get('file_link')
-        if file_link:
-            # Если file_link — t.me ссылка, попытки copy/forward уже были выше и не сработали.
-            # В этом случае НЕ пересылаем локальный файл, а сообщаем об ошибке пересылки.
-            if 't.me' in file_link:
-                await callback.answer('❌ Файл в канале найден, но не удалось переслать его. Пожалуйста, свяжитесь с администрацией.')
-                return
-
-            # Иначе — file_link внешняя ссылка: скачиваем и отправляем её пользователю (в ЛС при возможности)
-            tmp_fd, tmp_path = None, None
-            try:
-                tmp_dir = os.path.join('files', 'tmp')
-                os.makedirs(tmp_dir, exist_ok=True)
-                import tempfile
-                fd, tmp_path = tempfile.mkstemp(dir=tmp_dir, prefix=f"app_{app_id}_", suffix=os.path.splitext(file_link)[1] or '')
-                os.close(fd)
-                async with aiohttp.ClientSession() as session:
-                    async with session.get(file_link) as resp:
-                        if resp.status != 200:
-                            await callback.answer(f"❌ Не удалось скачать файл (HTTP {resp.status}).", show_alert=True)
-                            return
-                        # Попытка извлечь имя файла из заголовка Content-Disposition
-                        filename = None
-                        try:
-                            cd = resp.headers.get('content-disposition')
-                            if cd:
-                                import re
-                                m = re.search(r"filename\*?=([^;]+)", cd)
-                                if m:
-                                    fn = m.group(1).strip()
-                                    if fn.lower().startswith("utf-") or "'" in fn:
-                                        # возможно формат filename*=utf-8''name
-                                        parts = fn.split("''")
-                                        if len(parts) > 1:
-                                            fn = parts[-1]
-                                    filename = fn.strip('"')
-                        except Exception:
-                            filename = None
-
-                        if not filename:
-                            filename = os.path.basename(urlparse(file_link).path) or f"app_{app_id}{os.path.splitext(file_link)[1] or ''}"
-
-                        with open(tmp_path, 'wb') as f:
-                            while True:
-                                chunk = await resp.content.read(1024 * 64)
-                                if not chunk:
-                                    break
-                                f.write(chunk)
-
-                # Отправляем только файл (без превью/текста), но только если ранее не переслали его напрямую
-                sent_to_pm = False
-                try:
-                    # Если недавно был переслан тот же файл — пропускаем отправку
-                    recent = recent_sent_files.get(callback.from_user.id)
-                    if recent and (time.time() - recent[1]) < 8:
-                        logger.info(f"Skipping send: recent file sent to user {callback.from_user.id} {recent}")
-                        sent_to_pm = True
-                    elif not already_sent:
-                        logger.info(f"ACTION: sending temp file to user {callback.from_user.id} tmp_path={tmp_path} filename={filename}")
-                        await callback.bot.send_document(callback.from_user.id, FSInputFile(tmp_path, filename=filename))
-                        sent_to_pm = True
-                        already_sent = True
-                except Exception as e:
-                    logger.warning(f"Не удалось отправить внешний файл (file_link) в ЛС: {e}")
-
-                if not sent_to_pm:
-                    try:
-                        if not already_sent:
-                            await callback.message.answer_document(FSInputFile(tmp_path, filename=filename))
-                            already_sent = True
-                    except Exception as e2:
-                        logger.error(f"Ошибка при fallback отправке внешнего файла: {e2}")
-                        await callback.answer("❌ Не удалось отправить файл.")
-
-            finally:
-                try:
-                    if tmp_path and os.path.exists(tmp_path):
-                        os.remove(tmp_path)
-                except Exception:
-                    pass
-            await callback.answer()
+                logger.warning(f"Не удалось отправить превью в ЛС: {e}")
+
+        msg = await delivery_pipeline.deliver(ctx)
+        if msg is None:
+            if is_tme_link(ctx.file_link):
+                await notify_user(callback, '❌ Файл в канале найден, но не удалось переслать его. Пожалуйста, свяжитесь с администрацией.')
+            elif isinstance(ctx.error, DownloadError):
+                await notify_user(callback, f"❌ Не удалось скачать файл (HTTP {ctx.error.status}).")
+            else:
+                await notify_user(callback, "❌ Не удалось отправить файл.")
             return
 
-        # Если file_link не указан — отправляем локальный файл `found` как раньше
-        preview_text = (
-            f"🎮 <b>{app.get('name', 'Без названия')}</b>\n"
-            f"🎮 <b>Жанр:</b> {app.get('genre', 'Не указан')}\n"
-            f"📦 <b>Размер:</b> {app.get('size_category', 'Не указан')}\n\n"
-            f"📄 <b>Описание:</b>\n{app.get('description', 'Нет описания')}\n\n"
-            f"🔗 <b>Ссылка на пост:</b> {app.get('post_link', 'Не указана')}"
-        )
-
-        # Кнопки превью (если есть пост)
-        preview_buttons = []
-        if app.get('post_link'):
-            preview_buttons.append([InlineKeyboardButton(text="📱 Перейти к посту", url=app.get('post_link'))])
-        preview_kb = InlineKeyboardMarkup(inline_keyboard=preview_buttons) if preview_buttons else None
-
-        # Отправляем локальный файл
-        sent_to_pm = False
-        try:
-            msg_preview = await callback.bot.send_message(callback.from_user.id, preview_text, parse_mode='HTML', reply_markup=preview_kb)
-            logger.info(f"ACTION: sending local file to user {callback.from_user.id} path={found}")
-            # Если недавно был переслан тот же файл — пропускаем отправку
-            recent = recent_sent_files.get(callback.from_user.id)
-            if recent and (time.time() - recent[1]) < 8:
-                logger.info(f"Skipping local send: recent file sent to user {callback.from_user.id} {recent}")
-                doc_msg = None
-            else:
-                doc_msg = await callback.bot.send_document(callback.from_user.id, FSInputFile(found))
-            # Сохраним file_unique_id как последнее отправленное пользователю
-            try:
-                if doc_msg and getattr(doc_msg, 'document', None):
-                    recent_sent_files[callback.from_user.id] = (doc_msg.document.file_unique_id, time.time())
-                elif doc_msg and getattr(doc_msg, 'photo', None) and isinstance(doc_msg.photo, list) and doc_msg.photo:
-                    recent_sent_files[callback.from_user.id] = (doc_msg.photo[-1].file_unique_id, time.time())
-                elif doc_msg and getattr(doc_msg, 'video', None):
-                    recent_sent_files[callback.from_user.id] = (doc_msg.video.file_unique_id, time.time())
-            except Exception:
-                pass
-            sent_to_pm = True
+        _remember_delivery(ctx.user_id, msg)
+        if ctx.chat_id != ctx.user_id:
+            await callback.message.answer("⚠️ Не удалось отправить в ЛС; файл отправлен здесь.")
+        elif with_preview:
             try:
                 await callback.message.answer("✅ Описание и файл отправлены вам в личные сообщения.")
             except Exception:
                 pass
-        except Exception as e:
-            logger.warning(f"Не удалось отправить превью/файл в ЛС: {e}")
-
-        if not sent_to_pm:
-            # fallback: отправляем превью и файл в текущий чат
-            try:
-                try:
-                    if preview_kb:
-                        await callback.message.answer(preview_text, parse_mode='HTML', reply_markup=preview_kb)
-                    else:
-                        await callback.message.answer(preview_text, parse_mode='HTML')
-                except Exception:
-                    pass
-                await callback.message.answer_document(FSInputFile(found))
-                await callback.message.answer("⚠️ Не удалось отправить в ЛС; превью и файл отправлены здесь.")
-            except Exception as e2:
-                logger.error(f"Ошибка при fallback отправке превью/файла: {e2}")
-                await callback.answer("❌ Не удалось отправить файл.")
-        await callback.answer()
     except Exception as e:
-        logger.error(f"Ошибка в send_app_file: {e}")
-        await callback.answer("❌ Произошла ошибка при отправке файла.")
-    finally:
-        try:
-            recent_sending[uid] = False
-        except Exception:
-            pass
-
-
-@dp.callback_query(F.data.startswith("get_file_external:"))
-async def send_external_file(callback: types.CallbackQuery):
-    """Скачивает внешний файл по URL и отправляет пользователю (ЛС), с fallback в текущий чат."""
-    try:
-        uid = callback.from_user.id
-        # Блокировка: предотвращаем параллельные/повторные запросы от одного пользователя
-        if recent_sending.get(uid):
-            await callback.answer("⏳ Ваш предыдущий запрос всё ещё обрабатывается.", show_alert=True)
-            return
-        recent_sending[uid] = True
-
-        app_id = int(callback.data.split(":")[1])
-        app = db.get_app_by_id(app_id)
-        if not app:
-            await callback.answer("❌ Приложение не найдено")
-            return
-
-        file_url = app.get('file_link')
-        if not file_url or not file_url.startswith('http'):
-            await callback.answer("❌ Нет корректной внешней ссылки на файл.")
-            return
-
-        logger.debug(f"send_external_file: app_id={app_id} file_link={app.get('file_link')} post_link={app.get('post_link')}")
-
-        # Если file_link указывает на t.me — попробуем переслать медиа сообщением (copy/forward).
-        # Если переслать не удастся — FALLBACK к скачиванию ниже (и пропускаем send by URL).
-        file_link = app.get('file_link', '')
-        post_link = app.get('post_link', '')
-        tried_tme = False
-        sent_via_forward = False
-        skip_send_by_url = False
-        if file_link and ('t.me' in file_link or 'telegram.me' in file_link):
-            tried_tme = True
-            try:
-                parsed = urlparse(file_link)
-                parts = parsed.path.strip('/').split('/')
-                if parts:
-                    if parts[0] == 'c' and len(parts) >= 3:
-                        channel_part = parts[1]
-                        msg_id = int(parts[2])
-                        from_chat_id = int(f"-100{channel_part}")
-                    elif len(parts) >= 2:
-                        username = parts[0]
-                        msg_id = int(parts[1])
-                        from_chat_id = f"@{username.lstrip('@')}"
-                    else:
-                        from_chat_id = None
-                        msg_id = None
-
-                    if from_chat_id and msg_id:
-                        try:
-                            copied_msg = None
-                            sent_via_forward = False
-                            try:
-                                copied_msg = await callback.bot.copy_message(callback.from_user.id, from_chat_id, msg_id)
-                                logger.info(f"File post (msg {msg_id}) from file_link copied to user {callback.from_user.id}")
-                                # Логируем атрибуты скопированного сообщения
-                                try:
-                                    attrs = {k: bool(getattr(copied_msg, k, None)) for k in ['document','photo','video','animation','audio','voice','caption','text']}
-                                    logger.debug(f"copied_msg attrs (file_link): {attrs}")
-                                except Exception:
-                                    logger.debug("copied_msg has no detailed attrs (file_link)")
-                                if copied_msg and (getattr(copied_msg, 'document', None) or getattr(copied_msg, 'photo', None) or getattr(copied_msg, 'video', None) or getattr(copied_msg, 'animation', None) or getattr(copied_msg, 'audio', None) or getattr(copied_msg, 'voice', None)):
-                                    try:
-                                        await callback.bot.edit_message_caption(chat_id=callback.from_user.id, message_id=copied_msg.message_id, caption='')
-                                    except Exception:
-                                        pass
-                                    sent_via_forward = True
-                                    # записываем уникальный id и отметку времени
-                                    try:
-                                        if getattr(copied_msg, 'document', None):
-                                            recent_sent_files[uid] = (copied_msg.document.file_unique_id, time.time())
-                                        elif getattr(copied_msg, 'photo', None) and isinstance(copied_msg.photo, list) and copied_msg.photo:
-                                            recent_sent_files[uid] = (copied_msg.photo[-1].file_unique_id, time.time())
-                                        elif getattr(copied_msg, 'video', None):
-                                            recent_sent_files[uid] = (copied_msg.video.file_unique_id, time.time())
-                                    except Exception:
-                                        pass
-                                    await callback.answer()
-                                    recent_sending[uid] = False
-                                    return
-                            except Exception as e:
-                                logger.info(f"copy_message по file_link не сработал: {e}, попробуем forward_message")
-
-                            if not copied_msg:
-                                try:
-                                    forwarded_msg = await callback.bot.forward_message(callback.from_user.id, from_chat_id, msg_id)
-                                    logger.info(f"File post (msg {msg_id}) forwarded to user {callback.from_user.id}")
-                                    try:
-                                        attrs = {k: bool(getattr(forwarded_msg, k, None)) for k in ['document','photo','video','animation','audio','voice','caption','text']}
-                                        logger.debug(f"forwarded_msg attrs (file_link): {attrs}")
-                                    except Exception:
-                                        logger.debug("forwarded_msg has no detailed attrs (file_link)")
-                                    if forwarded_msg and (getattr(forwarded_msg, 'document', None) or getattr(forwarded_msg, 'photo', None) or getattr(forwarded_msg, 'video', None) or getattr(forwarded_msg, 'animation', None) or getattr(forwarded_msg, 'audio', None) or getattr(forwarded_msg, 'voice', None)):
-                                        try:
-                                            await callback.bot.edit_message_caption(chat_id=callback.from_user.id, message_id=forwarded_msg.message_id, caption='')
-                                        except Exception:
-                                            pass
-                                        sent_via_forward = True
-                                        try:
-                                            if getattr(forwarded_msg, 'document', None):
-                                                recent_sent_files[uid] = (forwarded_msg.document.file_unique_id, time.time())
-                                            elif getattr(forwarded_msg, 'photo', None) and isinstance(forwarded_msg.photo, list) and forwarded_msg.photo:
-                                                recent_sent_files[uid] = (forwarded_msg.photo[-1].file_unique_id, time.time())
-                                            elif getattr(forwarded_msg, 'video', None):
-                                                recent_sent_files[uid] = (forwarded_msg.video.file_unique_id, time.time())
-                                        except Exception:
-                                            pass
-                                        await callback.answer()
-                                        recent_sending[uid] = False
-                                        return
-                                except Exception as e:
-                                    logger.info(f"forward_message по file_link не сработал: {e}")
-                        except Exception as e:
-                            logger.debug(f"Ошибка при попытке переслать файл по file_link: {e}")
-            except Exception as e:
-                logger.debug(f"Не удалось распарсить file_link для пересылки: {e}")
-        # Если link был t.me: если пересылка прошла успешно — выходим.
-        # Если пересылка не прошла — НЕ ДЕЛАЕМ fallback download/send (чтобы не присылать лишний файл),
-        # а сообщаем об ошибке пользователю.
-        if tried_tme:
-            if sent_via_forward:
-                try:
-                    recent_sending[uid] = False
-                except Exception:
-                    pass
-                return
-            else:
-                # Не удалось переслать файл из канала — сообщаем и выходим, без скачивания
-                try:
-                    # Не показываем модальный алерт пользователю, просто снимаем спиннер
-                    await callback.answer()
-                except Exception:
-                    pass
-                try:
-                    recent_sending[uid] = False
-                except Exception:
-                    pass
-                logger.info("t.me link attempted but no media forwarded — aborting without download to avoid duplicates")
-                return
+        logger.error(f"Ошибка в deliver_app_file: {e}")
+        await notify_user(callback, "❌ Произошла ошибка при отправке файла.")
 
-        # Убрана логика пересылки по post_link — пересылаем только файл по file_link (если t.me),
-        # в противном случае продолжаем скачивание по file_link.
 
-        # Сначала пробуем отправить файл по прямой ссылке (Telegram может сам скачать файл).
-        # Это позволяет избежать создания временного `app_*` файла на сервере.
-        try:
-            try:
-                if skip_send_by_url:
-                    raise Exception("skip_send_by_url")
-                # Если недавно был переслан тот же файл — пропускаем отправку по URL
-                recent = recent_sent_files.get(uid)
-                if recent and (time.time() - recent[1]) < 8:
-                    logger.info(f"Skipping URL send: recent file sent to user {uid} {recent}")
-                    await callback.answer()
-                    recent_sending[uid] = False
-                    return
-                doc_msg = await callback.bot.send_document(callback.from_user.id, file_url)
-                # Если файл, отправленный по URL, совпал с недавно пересланным, удалим дубль
-                try:
-                    fid = None
-                    if getattr(doc_msg, 'document', None):
-                        fid = doc_msg.document.file_unique_id
-                    elif getattr(doc_msg, 'video', None):
-                        fid = doc_msg.video.file_unique_id
-                    if fid:
-                        if recent_sent_files.get(callback.from_user.id, (None, 0))[0] == fid:
-                            try:
-                                await callback.bot.delete_message(chat_id=doc_msg.chat.id, message_id=doc_msg.message_id)
-                            except Exception:
-                                pass
-                        else:
-                            recent_sent_files[callback.from_user.id] = (fid, time.time())
-                except Exception:
-                    pass
-                await callback.answer()
-                return
-            except Exception as e_url:
-                logger.info(f"send_external_file: отправка по URL не удалась, перейдём к скачиванию: {e_url}")
-
-            # Скачиваем файл во временный файл и отправляем (fallback)
-            tmp_fd, tmp_path = None, None
-            tmp_dir = os.path.join('files', 'tmp')
-            os.makedirs(tmp_dir, exist_ok=True)
-            import tempfile
-            fd, tmp_path = tempfile.mkstemp(dir=tmp_dir, prefix=f"app_{app_id}_", suffix=os.path.splitext(file_url)[1] or '')
-            os.close(fd)
-            async with aiohttp.ClientSession() as session:
-                async with session.get(file_url) as resp:
-                    if resp.status != 200:
-                        await callback.answer(f"❌ Не удалось скачать файл (HTTP {resp.status}).")
-                        return
-                    # Попытка извлечь имя файла из заголовка Content-Disposition
-                    filename = None
-                    try:
-                        cd = resp.headers.get('content-disposition')
-                        if cd:
-                            import re
-                            m = re.search(r"filename\*?=([^;]+)", cd)
-                            if m:
-                                fn = m.group(1).strip()
-                                if fn.lower().startswith("utf-") or "'" in fn:
-                                    parts = fn.split("''")
-                                    if len(parts) > 1:
-                                        fn = parts[-1]
-                                filename = fn.strip('"')
-                    except Exception:
-                        filename = None
-
-                    if not filename:
-                        filename = os.path.basename(urlparse(file_url).path) or f"app_{app_id}{os.path.splitext(file_url)[1] or ''}"
-
-                    with open(tmp_path, 'wb') as f:
-                        while True:
-                            chunk = await resp.content.read(1024 * 64)
-                            if not chunk:
-                                break
-                            f.write(chunk)
-
-            # Попытка отправки в ЛС из временного файла
-            sent_to_pm = False
-            try:
-                doc_msg = await callback.bot.send_document(callback.from_user.id, FSInputFile(tmp_path, filename=filename))
-                sent_to_pm = True
-                # если этот файл совпадает с недавно пересланным — удалим дубль (новую отправку)
-                try:
-                    fid = None
-                    if getattr(doc_msg, 'document', None):
-                        fid = doc_msg.document.file_unique_id
-                    elif getattr(doc_msg, 'video', None):
-                        fid = doc_msg.video.file_unique_id
-                    if fid and recent_sent_files.get(callback.from_user.id) == fid:
-                        try:
-                            await callback.bot.delete_message(chat_id=doc_msg.chat.id, message_id=doc_msg.message_id)
-                        except Exception:
-                            pass
-                except Exception:
-                    pass
-            except Exception as e:
-                logger.warning(f"Не удалось отправить внешний файл в ЛС: {e}")
+@dp.callback_query(F.data.startswith("get_file:"))
+async def send_app_file(callback: types.CallbackQuery):
+    """Ставит отправку файла приложения (с описанием) в очередь доставки"""
+    app_id = int(callback.data.split(":")[1])
+    if not db.get_app_by_id(app_id):
+        await callback.answer("❌ Приложение не найдено")
+        return
+    await enqueue_delivery(callback, lambda: deliver_app_file(callback, app_id, with_preview=True))
 
-            if not sent_to_pm:
-                try:
-                    ans_msg = await callback.message.answer_document(FSInputFile(tmp_path, filename=filename))
-                    try:
-                        fid = None
-                        if isinstance(ans_msg, types.Message) and getattr(ans_msg, 'document', None):
-                            fid = ans_msg.document.file_unique_id
-                        if fid and recent_sent_files.get(callback.from_user.id, (None, 0))[0] == fid:
-                            try:
-                                await callback.bot.delete_message(chat_id=ans_msg.chat.id, message_id=ans_msg.message_id)
-                            except Exception:
-                                pass
-                    except Exception:
-                        pass
-                except Exception as e2:
-                    logger.error(f"Ошибка при fallback отправке внешнего файла: {e2}")
-                    await callback.answer("❌ Не удалось отправить файл.")
 
-        finally:
-            # удаляем временный файл
-            try:
-                if tmp_path and os.path.exists(tmp_path):
-                    os.remove(tmp_path)
-            except Exception:
-                pass
+@dp.callback_query(F.data.startswith("get_file_external:"))
+async def send_external_file(callback: types.CallbackQuery):
+    """Ставит отправку файла по внешней ссылке в очередь доставки"""
+    app_id = int(callback.data.split(":")[1])
+    app = db.get_app_by_id(app_id)
+    if not app:
+        await callback.answer("❌ Приложение не найдено")
+        return
+    file_url = app.get('file_link') or ''
+    if not file_url.startswith('http'):
+        await callback.answer("❌ Нет корректной внешней ссылки на файл.")
+        return
+    await enqueue_delivery(callback, lambda: deliver_app_file(callback, app_id))
 
-        await callback.answer()
-    except Exception as e:
-        logger.error(f"Ошибка в send_external_file: {e}")
-        await callback.answer("❌ Произошла ошибка при отправке внешнего файла.")
-    finally:
-        try:
-            recent_sending[uid] = False
-        except Exception:
-            pass
 
 @dp.callback_query(F.data.startswith("already_participating:"))
 async def already_participating(callback: types.CallbackQuery):
@@ -2089,6 +4271,11 @@ async def search_by_name_handler(message: types.Message, state: FSMContext):
         return
     
     results = db.search_by_name(search_query)
+    fuzzy = False
+    if not results:
+        # Точных совпадений нет — пробуем найти с учётом опечаток и раскладки
+        results = db.search_fuzzy(search_query)
+        fuzzy = bool(results)
     
     if not results:
         await message.answer(
@@ -2098,20 +4285,9 @@ async def search_by_name_handler(message: types.Message, state: FSMContext):
             reply_markup=get_search_menu()
         )
     else:
-        # Отправляем отдельное сообщение на каждое приложение (чтобы была клавиатура с файлом)
-        await message.answer(f"🔍 <b>Найдено {len(results)} результатов по запросу '{search_query}':</b>", parse_mode='HTML')
-        for app in results[:5]:
-            text = (
-                f"📱 <b>{app.get('name', 'Без названия')}</b>\n"
-                f"🎮 <b>Жанр:</b> {app.get('genre', 'Не указан')}\n"
-                f"📦 <b>Размер:</b> {app.get('size_category', 'Не указан')}\n\n"
-                f"📝 {app.get('description', '')[:300]}\n"
-            )
-            keyboard = build_app_keyboard(app, app.get('id'))
-            await message.answer(text, parse_mode='HTML', reply_markup=keyboard)
-
-        # Навигация обратно
-        await message.answer("Используйте меню для продолжения.", reply_markup=get_search_menu())
+        # Результаты запоминаем, в callback_data кладём только короткий ключ и номер страницы
+        token = remember_search(search_query, [app.get('id') for app in results], fuzzy)
+        await send_search_page(message, 'q', token, 1)
     
     await state.clear()
 
@@ -2132,9 +4308,9 @@ async def search_by_genre_handler(message: types.Message, state: FSMContext):
     if current:
         return
     genre = message.text
-    results = db.search_by_genre(genre)
+    total = db.count_by_genre(genre)
     
-    if not results:
+    if not total:
         await message.answer(
             f"🎮 <b>Игры в жанре '{genre}':</b>\n\n"
             "😔 Пока нет игр в этом жанре. Следите за обновлениями!",
@@ -2142,17 +4318,7 @@ async def search_by_genre_handler(message: types.Message, state: FSMContext):
             reply_markup=get_search_menu()
         )
     else:
-        await message.answer(f"🎮 <b>Найдено {len(results)} игр в жанре '{genre}':</b>", parse_mode='HTML')
-        for app in results[:5]:
-            text = (
-                f"📱 <b>{app.get('name', 'Без названия')}</b>\n"
-                f"📦 Размер: {app.get('size_category', 'Не указан')}\n"
-                f"📝 {app.get('description', '')[:300]}\n"
-            )
-            keyboard = build_app_keyboard(app, app.get('id'))
-            await message.answer(text, parse_mode='HTML', reply_markup=keyboard)
-
-        await message.answer("Используйте меню для продолжения.", reply_markup=get_search_menu())
+        await send_search_page(message, 'g', str(Config.GENRES.index(genre)), 1)
 
 @dp.message(F.text == "📱 По размеру")
 async def search_by_size_start(message: types.Message):
@@ -2171,9 +4337,9 @@ async def search_by_size_handler(message: types.Message, state: FSMContext):
     if current:
         return
     size = message.text
-    results = db.search_by_size(size)
+    total = db.count_by_size(size)
     
-    if not results:
+    if not total:
         await message.answer(
             f"📱 <b>Игры размером '{size}':</b>\n\n"
             "😔 Пока нет игр такого размера. Следите за обновлениями!",
@@ -2181,17 +4347,7 @@ async def search_by_size_handler(message: types.Message, state: FSMContext):
             reply_markup=get_search_menu()
         )
     else:
-        await message.answer(f"📱 <b>Найдено {len(results)} игр размером '{size}':</b>", parse_mode='HTML')
-        for app in results[:5]:
-            text = (
-                f"📱 <b>{app.get('name', 'Без названия')}</b>\n"
-                f"🎮 Жанр: {app.get('genre', 'Не указан')}\n"
-                f"📝 {app.get('description', '')[:300]}\n"
-            )
-            keyboard = build_app_keyboard(app, app.get('id'))
-            await message.answer(text, parse_mode='HTML', reply_markup=keyboard)
-
-        await message.answer("Используйте меню для продолжения.", reply_markup=get_search_menu())
+        await send_search_page(message, 's', str(Config.SIZES.index(size)), 1)
 
 @dp.message(F.text == "📋 Все приложения")
 async def show_all_apps(message: types.Message):
@@ -2259,6 +4415,128 @@ async def apps_page_handler(callback: types.CallbackQuery):
         logger.error(f"Ошибка в apps_page_handler: {e}")
         await callback.answer("❌ Ошибка при загрузке страницы.")
 
+# Результаты поиска по названию: короткий ключ -> (запрос, id приложений, нечёткий ли поиск).
+# Кнопки страниц ссылаются на запись по ключу, а не на весь список id
+search_results = ExpiringCache(Config.SEARCH_RESULTS_CACHE_SIZE, Config.SEARCH_RESULTS_TTL)
+
+
+def remember_search(query: str, app_ids: List[int], fuzzy: bool = False) -> str:
+    """Сохранить результаты поиска и вернуть ключ для callback_data"""
+    token = secrets.token_urlsafe(6)
+    search_results.set(token, (query, app_ids, fuzzy))
+    return token
+
+
+def get_search_page(kind: str, key: str, page: int, per_page: int) -> Optional[Dict]:
+    """Страница результатов поиска по курсору kind:key.
+    kind: g — жанр (key — индекс в Config.GENRES), s — размер (индекс в Config.SIZES),
+    q — поиск по названию (key — ключ в search_results). None, если курсор недействителен.
+    """
+    offset = (page - 1) * per_page
+    if kind == 'g':
+        genre = Config.GENRES[int(key)]
+        title = f"🎮 <b>Игры в жанре '{genre}'</b>"
+        total = db.count_by_genre(genre)
+        apps = db.search_by_genre(genre, offset, per_page)
+    elif kind == 's':
+        size = Config.SIZES[int(key)]
+        title = f"📱 <b>Игры размером '{size}'</b>"
+        total = db.count_by_size(size)
+        apps = db.search_by_size(size, offset, per_page)
+    elif kind == 'q':
+        entry = search_results.get(key)
+        if entry is None:
+            return None
+        query, app_ids, fuzzy = entry
+        best = db.get_app_by_id(app_ids[0]) if fuzzy and app_ids else None
+        if best:
+            title = f"🔍 <b>Точных совпадений нет. Возможно, вы искали «{best.get('name')}»</b>"
+        elif fuzzy:
+            title = f"🔍 <b>Точных совпадений по запросу '{query}' нет</b>"
+        else:
+            title = f"🔍 <b>Результаты по запросу '{query}'</b>"
+        total = len(app_ids)
+        # приложения могли удалить после поиска — такие просто пропускаем
+        apps = [app for app in (db.get_app_by_id(app_id) for app_id in app_ids[offset:offset + per_page]) if app]
+    else:
+        return None
+
+    total_pages = (total + per_page - 1) // per_page if total > 0 else 1
+    return {
+        'title': title,
+        'apps': apps,
+        'page': page,
+        'total': total,
+        'total_pages': total_pages
+    }
+
+
+async def send_search_page(message: types.Message, kind: str, key: str, page: int, edit_message: bool = False) -> bool:
+    """Отправить (или отредактировать) одно сообщение со страницей результатов поиска"""
+    per_page = Config.SEARCH_PAGE_SIZE
+    page_data = get_search_page(kind, key, page, per_page)
+    if page_data is None:
+        return False
+
+    text = f"{page_data['title']}\nНайдено: {page_data['total']} (Страница {page}/{page_data['total_pages']})\n\n"
+    builder = InlineKeyboardBuilder()
+    for i, app in enumerate(page_data['apps'], (page - 1) * per_page + 1):
+        text += (
+            f"{i}. <b>{app.get('name', 'Без названия')}</b>\n"
+            f"   🎮 Жанр: {app.get('genre', 'Не указан')}\n"
+            f"   📦 Размер: {app.get('size_category', 'Не указан')}\n\n"
+        )
+        builder.row(InlineKeyboardButton(text=f"📱 {app.get('name', 'Без названия')}", callback_data=f"srch_app:{app.get('id')}"))
+
+    nav = []
+    if page > 1:
+        nav.append(InlineKeyboardButton(text="◀️ Назад", callback_data=f"srch:{kind}:{key}:{page-1}"))
+    if page < page_data['total_pages']:
+        nav.append(InlineKeyboardButton(text="Вперед ▶️", callback_data=f"srch:{kind}:{key}:{page+1}"))
+    if nav:
+        builder.row(*nav)
+    builder.row(InlineKeyboardButton(text="🔙 Назад", callback_data="back_to_search"))
+
+    if edit_message and message.reply_markup:
+        await message.edit_text(text, parse_mode='HTML', reply_markup=builder.as_markup())
+    else:
+        await message.answer(text, parse_mode='HTML', reply_markup=builder.as_markup())
+    return True
+
+@dp.callback_query(F.data.startswith("srch:"))
+async def search_page_handler(callback: types.CallbackQuery):
+    """Обработчик переключения страниц результатов поиска"""
+    try:
+        _, kind, key, page = callback.data.split(":")
+        if await send_search_page(callback.message, kind, key, int(page), edit_message=True):
+            await callback.answer()
+        else:
+            await callback.answer("⌛ Результаты поиска устарели. Повторите поиск.", show_alert=True)
+    except Exception as e:
+        logger.error(f"Ошибка в search_page_handler: {e}")
+        await callback.answer("❌ Ошибка при загрузке страницы.")
+
+@dp.callback_query(F.data.startswith("srch_app:"))
+async def search_app_view_handler(callback: types.CallbackQuery):
+    """Карточка приложения из результатов поиска"""
+    try:
+        app_id = int(callback.data.split(":")[1])
+        app = db.get_app_by_id(app_id)
+        if not app:
+            await callback.answer("❌ Приложение не найдено.", show_alert=True)
+            return
+        text = (
+            f"📱 <b>{app.get('name', 'Без названия')}</b>\n"
+            f"🎮 <b>Жанр:</b> {app.get('genre', 'Не указан')}\n"
+            f"📦 <b>Размер:</b> {app.get('size_category', 'Не указан')}\n\n"
+            f"📝 {app.get('description', '')[:300]}\n"
+        )
+        await callback.message.answer(text, parse_mode='HTML', reply_markup=build_app_keyboard(app, app_id))
+        await callback.answer()
+    except Exception as e:
+        logger.error(f"Ошибка в search_app_view_handler: {e}")
+        await callback.answer("❌ Ошибка при загрузке приложения.")
+
 @dp.callback_query(F.data == "back_to_search")
 async def back_to_search_handler(callback: types.CallbackQuery):
     """Возврат к меню поиска"""
@@ -2320,12 +4598,10 @@ async def manager_add_id_handler(message: types.Message, state: FSMContext):
             await message.answer("❌ Введите корректный числовой ID пользователя.")
             return
 
-        admins = Config.load_admins()
-        for admin in admins:
-            if admin['id'] == user_id:
-                await message.answer("❌ Этот пользователь уже администратор или менеджер.")
-                await state.clear()
-                return
+        if Config.is_admin(user_id):
+            await message.answer("❌ Этот пользователь уже администратор или менеджер.")
+            await state.clear()
+            return
 
         Config.add_admin(user_id, level=Config.ADMIN_LEVELS['manager'])
         await message.answer(f"✅ Пользователь {user_id} назначен менеджером.")
@@ -2493,8 +4769,8 @@ async def add_app_file_link_handler(message: types.Message, state: FSMContext):
     }
 
     success = db.add_app(app_data)
-
     if success:
+        file_locations.update(app_data)
         await message.answer(
             "✅ <b>Приложение успешно добавлено!</b>\n\n"
             f"📱 <b>Название:</b> {app_data['name']}\n"
@@ -2663,6 +4939,7 @@ async def edit_app_value_handler(message: types.Message, state: FSMContext):
         
         if success:
             app = db.get_app_by_id(app_id)
+            file_locations.update(app)
             await message.answer(
                 f"✅ <b>Приложение успешно обновлено!</b>\n\n"
                 f"📱 <b>Приложение:</b> {app.get('name', 'Без названия')}\n"
@@ -2781,8 +5058,9 @@ async def delete_app_confirm_handler(callback: types.CallbackQuery):
         
         # Удаляем приложение
         success = db.delete_app(app_id)
-        
         if success:
+            file_id_cache.forget(app_id)
+            file_locations.forget(app_id)
             await callback.message.edit_text(
                 f"✅ <b>Приложение успешно удалено!</b>\n\n"
                 f"📱 <b>Удаленное приложение:</b> {app_name}\n"
@@ -3113,15 +5391,11 @@ async def edit_channel_value_handler(message: types.Message, state: FSMContext):
         return
 
     try:
-        channels = db.channels
-        if not 0 <= idx < len(channels):
+        if not db.update_channel(idx, field, message.text):
             await message.answer("❌ Канал не найден.")
             await state.clear()
             return
 
-        channels[idx][field] = message.text
-        db.save_channels()
-
         await message.answer("✅ Поле канала обновлено.", reply_markup=get_admin_menu(message.from_user.id))
     except Exception as e:
         logger.exception(f"Ошибка при сохранении канала: {e}")
@@ -3252,6 +5526,7 @@ async def giveaway_add_end_datetime_handler(message: types.Message, state: FSMCo
     success = db.add_giveaway(giveaway_data)
     
     if success:
+        giveaway_scheduler.schedule(giveaway_data)
         await message.answer(
             "✅ <b>Розыгрыш успешно создан!</b>\n\n"
             f"🎁 <b>Название:</b> {giveaway_data['title']}\n"
@@ -3262,7 +5537,7 @@ async def giveaway_add_end_datetime_handler(message: types.Message, state: FSMCo
             parse_mode='HTML',
             reply_markup=get_admin_menu(message.from_user.id)
         )
-        # Рассылка уведомления о новом розыгрыше всем зарегистрированным пользователям
+        # Рассылка уведомления о новом розыгрыше всем зарегистрированным пользователям (в фоне)
         try:
             notify_text = (
                 f"🎉 <b>Новый розыгрыш!</b>\n\n"
@@ -3272,20 +5547,8 @@ async def giveaway_add_end_datetime_handler(message: types.Message, state: FSMCo
                 f"📅 Окончание: {giveaway_data.get('end_datetime')}\n\n"
                 f"Чтобы участвовать, откройте раздел 'Розыгрыши' в боте."
             )
-
-            sent = 0
-            failed = []
-            for u in list(db.users):
-                uid = u.get('id')
-                try:
-                    await message.bot.send_message(uid, notify_text, parse_mode='HTML')
-                    sent += 1
-                    await asyncio.sleep(0.05)
-                except Exception as e:
-                    logger.warning(f"Не удалось отправить уведомление пользователю {uid}: {e}")
-                    failed.append(uid)
-
-            logger.info(f"Рассылка нового розыгрыша: отправлено={sent}, не доставлено={len(failed)}")
+            job = broadcasts.create(notify_text, db.get_broadcast_audience(), admin_chat_id=message.chat.id)
+            logger.info(f"Рассылка нового розыгрыша поставлена в очередь: #{job['id']}, получателей={job['total']}")
         except Exception as e:
             logger.error(f"Ошибка при рассылке уведомлений о розыгрыше: {e}")
     else:
@@ -3321,7 +5584,7 @@ async def giveaway_list_handler(callback: types.CallbackQuery):
             f"   🆔 ID: {giveaway.get('id')}\n"
             f"   🏆 Приз: {giveaway.get('prize', 'Не указан')}\n"
             f"   📅 Окончание: {giveaway.get('end_datetime', 'Не указано')}\n"
-            f"   👥 Участников: {len(giveaway.get('participants', []))}\n"
+            f"   👥 Участников: {db.get_participant_count(giveaway.get('id'))}\n"
             f"   📊 Статус: {status}\n\n"
         )
     
@@ -3345,7 +5608,8 @@ async def giveaway_edit_select(callback: types.CallbackQuery, state: FSMContext)
         return
 
     builder = InlineKeyboardBuilder()
-    fields = [("Название","title"),("Описание","description"),("Приз","prize"),("Дата окончания","end_datetime")]
+    fields = [("Название","title"),("Описание","description"),("Приз","prize"),("Дата окончания","end_datetime"),
+              ("Количество победителей","winners_count")]
     for name, key in fields:
         builder.add(InlineKeyboardButton(text=f"✏️ {name}", callback_data=f"giveaway_edit_field:{gid}:{key}"))
     builder.adjust(1)
@@ -3386,8 +5650,16 @@ async def giveaway_edit_value_handler(message: types.Message, state: FSMContext)
         await message.answer("❌ Неверный формат даты. Используйте: ДД.MM.ГГГГ ЧЧ:ММ")
         return
 
-    success = db.update_giveaway(gid, field, message.text)
+    value = message.text
+    if field == 'winners_count':
+        if not value.isdigit() or not 1 <= int(value) <= Config.GIVEAWAY_MAX_WINNERS:
+            await message.answer(f"❌ Укажите число от 1 до {Config.GIVEAWAY_MAX_WINNERS}.")
+            return
+        value = int(value)
+
+    success = db.update_giveaway(gid, field, value)
     if success:
+        giveaway_scheduler.schedule(db.get_giveaway_by_id(gid))
         await message.answer("✅ Поле успешно обновлено.", reply_markup=get_admin_menu(message.from_user.id))
     else:
         await message.answer("❌ Не удалось обновить розыгрыш.", reply_markup=get_admin_menu(message.from_user.id))
@@ -3425,6 +5697,7 @@ async def giveaway_delete_confirm(callback: types.CallbackQuery):
     gid = int(callback.data.split(":")[1])
     success = db.delete_giveaway(gid)
     if success:
+        giveaway_scheduler.unschedule(gid)
         await callback.message.edit_text("✅ Розыгрыш удален.")
     else:
         await callback.message.edit_text("❌ Не удалось удалить розыгрыш.")
@@ -3443,21 +5716,22 @@ async def giveaway_end_select(callback: types.CallbackQuery):
         await callback.answer("Розыгрыш не найден")
         return
 
-    participants = giveaway.get('participants', [])
+    participants = giveaway.get('participants') or ()
     if not participants:
         # Просто отмечаем как завершенный
         db.end_giveaway(gid)
+        giveaway_scheduler.unschedule(gid)
         await callback.message.edit_text("✅ Розыгрыш помечен как завершенный (нет участников).")
         await callback.answer()
         return
 
     # Предложим выбрать случайного победителя
     builder = InlineKeyboardBuilder()
-    builder.add(InlineKeyboardButton(text="🎲 Выбрать случайного победителя", callback_data=f"giveaway_end_pick:{gid}"))
+    builder.add(InlineKeyboardButton(text="🎲 Выбрать случайных победителей", callback_data=f"giveaway_end_pick:{gid}"))
     builder.add(InlineKeyboardButton(text="❌ Отмена", callback_data="giveaway_list"))
     builder.adjust(1)
 
-    await callback.message.edit_text(f"🏁 Завершение розыгрыша: <b>{giveaway.get('title')}</b>\nУчастников: {len(participants)}", parse_mode='HTML', reply_markup=builder.as_markup())
+    await callback.message.edit_text(f"🏁 Завершение розыгрыша: <b>{giveaway.get('title')}</b>\nУчастников: {len(participants)}\nПобедителей: {giveaway.get('winners_count') or 1}", parse_mode='HTML', reply_markup=builder.as_markup())
     await callback.answer()
 
 
@@ -3472,17 +5746,30 @@ async def giveaway_end_pick(callback: types.CallbackQuery):
     if not giveaway:
         await callback.answer("Розыгрыш не найден")
         return
+    if not giveaway_needs_draw(giveaway):
+        await callback.message.edit_text(f"ℹ️ Итоги уже подведены. Победители: {format_winners(giveaway)}")
+        await callback.answer()
+        return
 
-    participants = giveaway.get('participants', [])
+    participants = giveaway.get('participants') or ()
     if not participants:
         await callback.message.edit_text("❌ Нет участников для выбора победителя.")
         await callback.answer()
         return
 
-    winner = random.choice(participants)
-    db.end_giveaway(gid, winner_id=winner.get('id'), winner_username=winner.get('username'))
+    winner_ids = await run_giveaway_draw(giveaway)
+    if winner_ids is None:
+        await callback.message.edit_text(f"ℹ️ Итоги уже подведены. Победители: {format_winners(giveaway)}")
+        await callback.answer()
+        return
+    if not winner_ids:
+        await callback.message.edit_text("❌ Среди участников нет тех, кто может выиграть.")
+        await callback.answer()
+        return
+    giveaway_scheduler.unschedule(gid)
 
-    await callback.message.edit_text(f"🏁 Розыгрыш <b>{giveaway.get('title')}</b> завершен!\n\n👑 Победитель: {winner.get('username') or winner.get('first_name')}\n🆔 ID: {winner.get('id')}", parse_mode='HTML')
+    winners_lines = "\n".join(f"👑 {db.get_participant_name(uid)} (🆔 {uid})" for uid in winner_ids)
+    await callback.message.edit_text(f"🏁 Розыгрыш <b>{giveaway.get('title')}</b> завершен!\n\n{winners_lines}", parse_mode='HTML')
     await callback.answer()
 
 @dp.callback_query(F.data == "giveaway_edit")
@@ -4016,6 +6303,7 @@ async def show_stats(message: types.Message):
         stats_text = (
             "📊 <b>Статистика GameHub</b>\n\n"
             f"👤 <b>Ваша роль:</b> {role_name}\n\n"
+            f"👥 <b>Пользователи:</b> {stats['users_count']} (недоступны: {stats['inactive_users']})\n"
             f"📱 <b>Приложения:</b> {stats['apps_count']}\n"
             f"📢 <b>Каналы:</b> {stats['channels_count']}\n"
             f"💡 <b>Предложения всего:</b> {stats['suggestions_count']}\n"
@@ -4023,8 +6311,20 @@ async def show_stats(message: types.Message):
             f"🎁 <b>Розыгрышей всего:</b> {stats['giveaways_count']}\n"
             f"🟢 <b>Активных:</b> {stats['active_giveaways']}\n"
             f"🔴 <b>Завершенных:</b> {stats['ended_giveaways']}\n\n"
-            f"<i>Статистика обновляется в реальном времени</i>"
         )
+        queue = delivery_queue.metrics()
+        stats_text += (
+            f"📤 <b>Очередь файлов:</b> {queue['depth']} ожидают, {queue['busy']}/{queue['workers']} отправляются\n"
+            f"⏱ <b>Ожидание:</b> в среднем {queue['avg_wait']:.1f} с, максимум {queue['max_wait']:.1f} с\n"
+            f"✅ <b>Отправлено:</b> {queue['processed']}, ошибок: {queue['failed']}\n\n"
+        )
+        used = [m for m in delivery_pipeline.metrics() if m['attempts']]
+        if used:
+            stats_text += "🚚 <b>Способы доставки:</b>\n"
+            for m in used:
+                stats_text += f"• {m['title']}: {m['success']}/{m['attempts']} успешно, ~{m['avg_seconds']:.1f} с\n"
+            stats_text += "\n"
+        stats_text += "<i>Статистика обновляется в реальном времени</i>"
         
         await message.answer(stats_text, parse_mode='HTML')
     except Exception as e:
@@ -4258,16 +6558,13 @@ async def suggestion_remove_archive_handler(callback: types.CallbackQuery):
             page = 1
             status = 'all'
 
-    for i, s in enumerate(db.suggestions):
-        if s.get('id') == suggestion_id:
-            db.suggestions.pop(i)
-            db.save_suggestions()
-            await callback.answer("✅ Предложение удалено из архива.")
-            try:
-                await show_archive_page(callback, page=page, status_filter=status)
-            except Exception:
-                pass
-            return
+    if db.delete_suggestion(suggestion_id):
+        await callback.answer("✅ Предложение удалено из архива.")
+        try:
+            await show_archive_page(callback, page=page, status_filter=status)
+        except Exception:
+            pass
+        return
     await callback.answer("❌ Предложение не найдено.", show_alert=True)
 
 
@@ -4874,72 +7171,37 @@ async def main():
         return
 
     bot = Bot(token=token)
-    async def _monitor_giveaways():
-        """Фоновая задача: проверяет истёкшие розыгрыши и выбирает победителя."""
-        while True:
-            try:
-                now = datetime.now()
-                for giveaway in list(db.giveaways):
-                    try:
-                        gid = giveaway.get('id')
-                        if not gid:
-                            continue
-                        # парсим дату окончания
-                        end_str = giveaway.get('end_datetime', '')
-                        if not end_str:
-                            continue
-                        try:
-                            end_dt = datetime.strptime(end_str, "%d.%m.%Y %H:%M")
-                        except Exception:
-                            continue
-
-                        # пропускаем если ещё не время
-                        if now < end_dt:
-                            continue
-
-                        # Если розыгрыш уже помечен завершенным и есть победитель — пропускаем
-                        if giveaway.get('ended') and giveaway.get('winner'):
-                            continue
-
-                        participants = giveaway.get('participants', []) or []
-
-                        if not participants:
-                            # помечаем как завершённый без победителя
-                            db.end_giveaway(gid)
-                            logger.info(f"Giveaway {gid} ended: no participants")
-                            continue
-
-                        # Выбираем случайного победителя
-                        winner = random.choice(participants)
-                        winner_id = winner.get('id')
-                        winner_username = winner.get('username') or winner.get('first_name')
-
-                        # Записываем победителя в базу
-                        db.end_giveaway(gid, winner_id=winner_id, winner_username=winner_username)
-
-                        # Отправляем личное сообщение победителю
-                        try:
-                            await bot.send_message(
-                                winner_id,
-                                f"🎉 Поздравляем! Вы выиграли в розыгрыше: <b>{giveaway.get('title')}</b>!\n\n" \
-                                f"🆔 ID розыгрыша: {gid}\n\n" \
-                                f"Свяжитесь с администрацией для получения приза.",
-                                parse_mode='HTML'
-                            )
-                            logger.info(f"Notified winner {winner_id} for giveaway {gid}")
-                        except Exception as e:
-                            logger.error(f"Не удалось уведомить победителя {winner_id}: {e}")
-                    except Exception as e:
-                        logger.error(f"Error processing giveaway in monitor: {e}")
-            except Exception as e:
-                logger.error(f"Error in giveaway monitor loop: {e}")
-            await asyncio.sleep(30)
-
-    # Запускаем фоновую задачу контроля розыгрышей
-    asyncio.create_task(_monitor_giveaways())
+    # Запускаем отложенную запись базы и планировщик окончания розыгрышей
+    db.start_writer()
+    file_locations.rebuild(db.apps)
+    file_locations.start(Config.FILE_INDEX_POLL_INTERVAL)
+    get_http_session()
+    delivery_queue.start()
+    broadcasts.start(bot)
+    giveaway_scheduler.start(bot, db.giveaways)
     try:
         await dp.start_polling(bot)
     finally:
+        # Сначала останавливаем всё, что меняет базу, затем финальный сброс на диск
+        for component, stop in (('очередь файлов', delivery_queue.stop),
+                                ('индекс файлов', file_locations.stop),
+                                ('кеш загрузок', download_cache.stop),
+                                ('кеш file_id', file_id_cache.stop),
+                                ('рассылки', broadcasts.stop),
+                                ('планировщик розыгрышей', giveaway_scheduler.stop)):
+            try:
+                await stop()
+            except Exception as e:
+                logger.error(f"Ошибка остановки ({component}): {e}")
+        try:
+            await db.stop_writer()
+            db.close()
+        except Exception as e:
+            logger.error(f"Ошибка при финальной записи базы: {e}")
+        try:
+            await close_http_session()
+        except Exception:
+            pass
         try:
             await bot.session.close()
         except Exception:
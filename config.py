@@ -31,6 +31,87 @@ class Config:
     GIVEAWAYS_FILE = "data/giveaways.json"
     JOBS_FILE = "data/jobs.json"
     USERS_FILE = "data/users.json"
+    # Кеш Telegram file_id уже загруженных файлов приложений
+    FILE_IDS_FILE = "data/file_ids.json"
+    # Очередь рассылок с сохранённым прогрессом
+    BROADCASTS_FILE = "data/broadcasts.json"
+    # Журнал аудита розыгрышей (зерно ГСЧ, хеш списка участников, победители)
+    DRAW_AUDIT_FILE = "data/draw_audit.jsonl"
+
+    # Отложенная запись коллекций (write-behind): изменения помечают коллекцию «грязной»,
+    # фоновая задача сбрасывает их на диск раз в DB_FLUSH_INTERVAL секунд
+    # или раньше, если накопилось DB_FLUSH_BATCH_SIZE изменений
+    DB_FLUSH_INTERVAL = float(os.environ.get("DB_FLUSH_INTERVAL", "2"))
+    DB_FLUSH_BATCH_SIZE = int(os.environ.get("DB_FLUSH_BATCH_SIZE", "200"))
+    # Как часто сохранять обновления last_seen пользователей (они не считаются срочными)
+    USERS_SEEN_FLUSH_INTERVAL = float(os.environ.get("USERS_SEEN_FLUSH_INTERVAL", "300"))
+    # Журнал участий в розыгрышах (JSON-хранилище): fsync после стольких новых строк
+    # (иначе при очередном сбросе базы) и перенос журнала в giveaways.json после стольких строк
+    GIVEAWAY_JOURNAL_FSYNC_BATCH = int(os.environ.get("GIVEAWAY_JOURNAL_FSYNC_BATCH", "50"))
+    GIVEAWAY_JOURNAL_COMPACT_LINES = int(os.environ.get("GIVEAWAY_JOURNAL_COMPACT_LINES", "5000"))
+    # Число победителей нового розыгрыша и максимум при редактировании
+    GIVEAWAY_DEFAULT_WINNERS = int(os.environ.get("GIVEAWAY_DEFAULT_WINNERS", "1"))
+    GIVEAWAY_MAX_WINNERS = int(os.environ.get("GIVEAWAY_MAX_WINNERS", "100"))
+
+    # Хранилище данных: "json" (файлы data/*.json) или "sqlite" (один файл SQLITE_FILE).
+    # При первом запуске с sqlite существующие JSON-файлы импортируются автоматически
+    STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "json").lower()
+    SQLITE_FILE = os.environ.get("SQLITE_FILE", "data/gamehub.db")
+
+    # Нечёткий поиск: сколько слов-кандидатов проверять расстоянием Левенштейна на один запрос
+    # и сколько результатов показывать
+    FUZZY_MAX_CANDIDATES = int(os.environ.get("FUZZY_MAX_CANDIDATES", "200"))
+    FUZZY_MAX_RESULTS = int(os.environ.get("FUZZY_MAX_RESULTS", "20"))
+    # Сколько элементов индекса (форм слов по триграммам и записей приложений) просматривать
+    # на одно слово запроса — ограничивает работу для коротких и частых слов
+    FUZZY_MAX_VISITS = int(os.environ.get("FUZZY_MAX_VISITS", "5000"))
+
+    # Постраничный вывод результатов поиска: приложений на странице,
+    # сколько результатов поиска по названию хранить и сколько секунд
+    SEARCH_PAGE_SIZE = int(os.environ.get("SEARCH_PAGE_SIZE", "5"))
+    SEARCH_RESULTS_CACHE_SIZE = int(os.environ.get("SEARCH_RESULTS_CACHE_SIZE", "1000"))
+    SEARCH_RESULTS_TTL = float(os.environ.get("SEARCH_RESULTS_TTL", "1800"))
+
+    # Кеш файлов, скачанных по file_link: папка, общий лимит размера (байт)
+    # и сколько секунд копия считается свежей без перепроверки ETag/Last-Modified
+    DOWNLOAD_CACHE_DIR = os.environ.get("DOWNLOAD_CACHE_DIR", "files/cache")
+    DOWNLOAD_CACHE_MAX_BYTES = int(os.environ.get("DOWNLOAD_CACHE_MAX_BYTES", str(2 * 1024 ** 3)))
+    DOWNLOAD_CACHE_FRESH_SECONDS = float(os.environ.get("DOWNLOAD_CACHE_FRESH_SECONDS", "600"))
+    # Через сколько секунд после изменения записывать индекс кеша загрузок на диск
+    DOWNLOAD_CACHE_SAVE_DELAY = float(os.environ.get("DOWNLOAD_CACHE_SAVE_DELAY", "30"))
+    # Через сколько секунд после изменения записывать кеш file_id (data/file_ids.json)
+    FILE_IDS_SAVE_DELAY = float(os.environ.get("FILE_IDS_SAVE_DELAY", "5"))
+    # Потоковая передача внешних файлов в Telegram: размер куска и сколько байт файла
+    # неизвестного размера можно держать в памяти (больше — сначала скачивается на диск)
+    RELAY_CHUNK_SIZE = int(os.environ.get("RELAY_CHUNK_SIZE", str(64 * 1024)))
+    RELAY_MEMORY_LIMIT = int(os.environ.get("RELAY_MEMORY_LIMIT", str(8 * 1024 * 1024)))
+
+    # Общий HTTP-клиент для скачивания внешних файлов: лимиты соединений (всего и на один хост),
+    # время жизни кеша DNS, keep-alive и таймауты (секунды)
+    HTTP_MAX_CONNECTIONS = int(os.environ.get("HTTP_MAX_CONNECTIONS", "32"))
+    HTTP_MAX_CONNECTIONS_PER_HOST = int(os.environ.get("HTTP_MAX_CONNECTIONS_PER_HOST", "8"))
+    HTTP_DNS_CACHE_TTL = int(os.environ.get("HTTP_DNS_CACHE_TTL", "300"))
+    HTTP_KEEPALIVE_TIMEOUT = float(os.environ.get("HTTP_KEEPALIVE_TIMEOUT", "30"))
+    HTTP_CONNECT_TIMEOUT = float(os.environ.get("HTTP_CONNECT_TIMEOUT", "15"))
+    HTTP_READ_TIMEOUT = float(os.environ.get("HTTP_READ_TIMEOUT", "60"))
+
+    # Очередь отправки файлов: число одновременных отправок и максимум ожидающих запросов
+    DELIVERY_WORKERS = int(os.environ.get("DELIVERY_WORKERS", "4"))
+    DELIVERY_QUEUE_MAX = int(os.environ.get("DELIVERY_QUEUE_MAX", "200"))
+    # Подавление повторной отправки файла тому же пользователю (секунды; 0 — выключено),
+    # сколько пользователей помнить и через сколько секунд снимать зависшую блокировку доставки
+    DELIVERY_DEDUP_WINDOW = float(os.environ.get("DELIVERY_DEDUP_WINDOW", "8"))
+    DELIVERY_DEDUP_MAX_USERS = int(os.environ.get("DELIVERY_DEDUP_MAX_USERS", "10000"))
+    DELIVERY_LOCK_TTL = float(os.environ.get("DELIVERY_LOCK_TTL", "900"))
+    # Через сколько секунд снова пробовать отправку по URL, которую Telegram отклонил
+    DELIVERY_URL_RETRY_AFTER = float(os.environ.get("DELIVERY_URL_RETRY_AFTER", "86400"))
+    # Как часто (секунды) перепроверять каталог files/ для индекса локальных файлов
+    FILE_INDEX_POLL_INTERVAL = float(os.environ.get("FILE_INDEX_POLL_INTERVAL", "30"))
+    # Рассылки: сообщений в секунду (лимит Telegram ~30), число воркеров
+    # и как часто (секунды) сохранять прогресс и обновлять сообщение администратору
+    BROADCAST_RATE = float(os.environ.get("BROADCAST_RATE", "25"))
+    BROADCAST_WORKERS = int(os.environ.get("BROADCAST_WORKERS", "8"))
+    BROADCAST_CHECKPOINT_INTERVAL = float(os.environ.get("BROADCAST_CHECKPOINT_INTERVAL", "3"))
 
     # Создаем папку data если ее нет
     os.makedirs("data", exist_ok=True)
@@ -91,8 +172,20 @@ class Config:
         return default_value
     
     @staticmethod
-    def save_json_file(filename: str, data) -> bool:
-        """Безопасное сохранение в JSON файл"""
+    def dump_json(data) -> str:
+        """Сериализация данных в JSON в формате файлов базы"""
+        return json.dumps(data, ensure_ascii=False, indent=2, default=Config._json_default)
+
+    @staticmethod
+    def _json_default(value):
+        """Объекты с методом to_json (например, компактный список участников) сохраняются через него"""
+        if hasattr(value, 'to_json'):
+            return value.to_json()
+        raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+    @staticmethod
+    def write_text_atomic(filename: str, text: str) -> bool:
+        """Атомарная запись текста в файл: временный файл + os.replace"""
         try:
             # Создаем папку если ее нет
             dirpath = os.path.dirname(filename)
@@ -103,7 +196,7 @@ class Config:
             fd, tmp_path = tempfile.mkstemp(dir=dirpath or None, prefix="tmp", text=True)
             try:
                 with os.fdopen(fd, 'w', encoding='utf-8') as tf:
-                    json.dump(data, tf, ensure_ascii=False, indent=2)
+                    tf.write(text)
                 os.replace(tmp_path, filename)
             finally:
                 # Если временный файл остался, попробуем удалить
@@ -118,8 +211,32 @@ class Config:
             return False
     
     @staticmethod
-    def load_admins() -> List[Dict]:
-        """Загрузка списка администраторов"""
+    def save_json_file(filename: str, data) -> bool:
+        """Безопасное сохранение в JSON файл"""
+        try:
+            text = Config.dump_json(data)
+        except Exception as e:
+            print(f"Ошибка сохранения {filename}: {e}")
+            return False
+        return Config.write_text_atomic(filename, text)
+    
+    # Реестр администраторов в памяти: id -> запись. Перечитывается с диска
+    # только если файл изменился (mtime/размер), поэтому проверка прав не делает файлового I/O.
+    _admins_by_id: Dict[int, Dict] = {}
+    _admins_stamp: Optional[tuple] = None
+
+    @staticmethod
+    def _admins_file_stamp() -> Optional[tuple]:
+        """Отпечаток файла администраторов (mtime, размер) или None, если файла нет"""
+        try:
+            st = os.stat(Config.ADMINS_FILE)
+            return (st.st_mtime_ns, st.st_size)
+        except OSError:
+            return None
+
+    @staticmethod
+    def _read_admins() -> List[Dict]:
+        """Чтение списка администраторов с диска"""
         default_admin = [{
             "id": Config.DEFAULT_OWNER_ID,
             "username": "owner",
@@ -136,26 +253,50 @@ class Config:
                 admin['level'] = Config.ADMIN_LEVELS['owner'] if admin.get('id') == Config.DEFAULT_OWNER_ID else Config.ADMIN_LEVELS['moderator']
         
         return admins
+
+    @staticmethod
+    def _admin_registry() -> Dict[int, Dict]:
+        """Реестр администраторов; перечитывает файл только при изменении его mtime"""
+        stamp = Config._admins_file_stamp()
+        if stamp is None or stamp != Config._admins_stamp:
+            admins = Config._read_admins()
+            Config._admins_by_id = {admin.get('id'): admin for admin in admins}
+            # отпечаток до чтения: изменение файла во время чтения подхватится при следующей проверке
+            Config._admins_stamp = stamp
+        return Config._admins_by_id
+
+    @staticmethod
+    def load_admins() -> List[Dict]:
+        """Загрузка списка администраторов (копии записей из реестра)"""
+        return [dict(admin) for admin in Config._admin_registry().values()]
     
     @staticmethod
-    def _save_admins(admins: List[Dict]):
+    def _save_admins(admins: List[Dict]) -> bool:
         """Сохранение списка администраторов"""
-        Config.save_json_file(Config.ADMINS_FILE, admins)
+        return Config.save_json_file(Config.ADMINS_FILE, admins)
+
+    @staticmethod
+    def _commit_admins(registry: Dict[int, Dict]) -> bool:
+        """Сохранить изменённую копию реестра на диск и только после успешной записи сделать её текущей
+        (отпечаток файла запоминаем, чтобы не перечитывать свою же запись)"""
+        if not Config._save_admins(list(registry.values())):
+            return False
+        Config._admins_by_id = registry
+        Config._admins_stamp = Config._admins_file_stamp()
+        return True
     
     @staticmethod
     def is_admin(user_id: int) -> bool:
         """Проверка, является ли пользователь администратором любого уровня"""
-        admins = Config.load_admins()
-        return any(admin['id'] == user_id for admin in admins)
+        return user_id in Config._admin_registry()
     
     @staticmethod
     def get_admin_level(user_id: int) -> int:
         """Получение уровня администратора"""
-        admins = Config.load_admins()
-        for admin in admins:
-            if admin['id'] == user_id:
-                return admin.get('level', 0)
-        return 0
+        admin = Config._admin_registry().get(user_id)
+        if admin is None:
+            return 0
+        return admin.get('level', 0)
     
     @staticmethod
     def add_admin(user_id: int, username: str = "", first_name: str = "", level: int = None) -> bool:
@@ -163,12 +304,11 @@ class Config:
         if user_id == Config.DEFAULT_OWNER_ID:
             return False  # Владелец уже есть
         
-        admins = Config.load_admins()
+        registry = dict(Config._admin_registry())
         
         # Проверяем, нет ли уже такого админа
-        for admin in admins:
-            if admin['id'] == user_id:
-                return False
+        if user_id in registry:
+            return False
         
         if level is None:
             level = Config.ADMIN_LEVELS['moderator']
@@ -178,16 +318,15 @@ class Config:
         if level not in valid_levels:
             level = Config.ADMIN_LEVELS['moderator']
         
-        admins.append({
+        registry[user_id] = {
             "id": user_id,
             "username": username or f"user_{user_id}",
             "first_name": first_name or "Пользователь",
             "level": level,
             "added_date": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        })
+        }
         
-        Config._save_admins(admins)
-        return True
+        return Config._commit_admins(registry)
     
     @staticmethod
     def remove_admin(user_id: int) -> bool:
@@ -195,13 +334,9 @@ class Config:
         if user_id == Config.DEFAULT_OWNER_ID:
             return False
         
-        admins = Config.load_admins()
-        initial_len = len(admins)
-        admins = [admin for admin in admins if admin['id'] != user_id]
-        
-        if len(admins) < initial_len:
-            Config._save_admins(admins)
-            return True
+        registry = dict(Config._admin_registry())
+        if registry.pop(user_id, None) is not None:
+            return Config._commit_admins(registry)
         return False
     
     @staticmethod
@@ -214,14 +349,13 @@ class Config:
         if level not in valid_levels:
             return False
         
-        admins = Config.load_admins()
-        for admin in admins:
-            if admin['id'] == user_id:
-                admin['level'] = level
-                admin['modified_date'] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                Config._save_admins(admins)
-                return True
-        return False
+        registry = dict(Config._admin_registry())
+        if user_id not in registry:
+            return False
+        admin = registry[user_id] = dict(registry[user_id])
+        admin['level'] = level
+        admin['modified_date'] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        return Config._commit_admins(registry)
     
     @staticmethod
     def has_access(user_id: int, required_level: int) -> bool:
@@ -268,9 +402,6 @@ class Config:
     
     @staticmethod
     def get_admin_by_id(user_id: int) -> Optional[Dict]:
-        """Получить информацию об администраторе по ID"""
-        admins = Config.load_admins()
-        for admin in admins:
-            if admin['id'] == user_id:
-                return admin
-        return None
+        """Получить информацию об администраторе по ID (копия записи)"""
+        admin = Config._admin_registry().get(user_id)
+        return dict(admin) if admin is not None else None
@@ -1,3 +1,10 @@
+import asyncio
+import hashlib
+import json
+import os
+import time
+import types
+
 import pytest
 from datetime import datetime, timedelta
 
@@ -5,6 +12,14 @@ import bot
 from config import Config
 
 
+@pytest.fixture
+def tmp_db(tmp_path, monkeypatch):
+    """Database, файлы которой лежат во временной папке"""
+    for attr in bot.COLLECTION_FILES.values():
+        monkeypatch.setattr(Config, attr, str(tmp_path / f"{attr.lower()}.json"))
+    return bot.Database()
+
+
 def test_validate_url():
     assert bot.validate_url('https://example.com')
     assert bot.validate_url('http://127.0.0.1:8080/path')
@@ -29,3 +44,846 @@ def test_config_and_db_loads():
 
     db = bot.Database()
     assert isinstance(db.apps, list)
+
+
+
+def test_admin_registry_cache(tmp_path, monkeypatch):
+    admins_file = tmp_path / 'admins.json'
+    monkeypatch.setattr(Config, 'ADMINS_FILE', str(admins_file))
+    monkeypatch.setattr(Config, '_admins_by_id', {})
+    monkeypatch.setattr(Config, '_admins_stamp', None)
+
+    assert Config.is_admin(Config.DEFAULT_OWNER_ID)
+    assert Config.add_admin(42, level=Config.ADMIN_LEVELS['editor'])
+    assert Config.is_editor(42) and not Config.is_moderator(42)
+
+    # Изменение файла извне подхватывается при следующей проверке
+    admins_file.write_text(json.dumps([{'id': 7, 'level': 80}, {'id': 42, 'level': 40}]), encoding='utf-8')
+    assert Config.is_full_admin(7)
+
+    # Пока файл не менялся, проверки прав его не перечитывают
+    monkeypatch.setattr(Config, '_read_admins', lambda: pytest.fail('admins.json перечитан без изменений'))
+    assert Config.update_admin_level(42, Config.ADMIN_LEVELS['admin'])
+    assert Config.is_full_admin(42)
+    assert Config.get_admin_level(100500) == 0
+
+    # Если запись не удалась, реестр в памяти не меняется
+    monkeypatch.setattr(Config, '_save_admins', lambda admins: False)
+    assert not Config.update_admin_level(42, Config.ADMIN_LEVELS['editor'])
+    assert not Config.add_admin(43) and not Config.remove_admin(42)
+    assert Config.is_full_admin(42) and not Config.is_admin(43)
+
+    # Изменение файла во время чтения подхватывается при следующей проверке
+    admins_file.write_text(json.dumps([{'id': 7, 'level': 80}]), encoding='utf-8')
+    reads = []
+
+    def read_admins():
+        admins = json.loads(admins_file.read_text(encoding='utf-8'))
+        if not reads:
+            admins_file.write_text(json.dumps([{'id': 7, 'level': 80}, {'id': 55, 'level': 40}]), encoding='utf-8')
+        reads.append(len(admins))
+        return admins
+
+    monkeypatch.setattr(Config, '_read_admins', read_admins)
+    assert not Config.is_admin(55)
+    assert Config.is_admin(55) and reads == [1, 2]
+
+
+def test_write_behind_batches_saves(tmp_db):
+    async def scenario():
+        tmp_db.start_writer()
+        tmp_db.add_giveaway({'title': 'Тест', 'end_datetime': '01.01.2099 12:00'})
+        for uid in range(1, 51):
+            tmp_db.add_participant(1, uid, f'user{uid}', 'Имя')
+        # Пока фоновая запись не сработала, файл не переписывается на каждое изменение
+        assert Config.load_json_file(Config.GIVEAWAYS_FILE, []) == []
+        await tmp_db.stop_writer()
+
+    asyncio.run(scenario())
+    saved = Config.load_json_file(Config.GIVEAWAYS_FILE, [])
+    assert len(bot.ParticipantList.coerce(saved[0]['participants'])) == 50
+
+
+def test_stop_writer_during_flush_keeps_pending_collections(tmp_db):
+    async def scenario():
+        tmp_db.start_writer()
+        tmp_db.add_app({'name': 'Игра'})
+        tmp_db.add_suggestion({'name': 'Идея'})
+        tmp_db.add_channel({'name': 'Канал'})
+        flush = asyncio.ensure_future(tmp_db.storage.flush_async())
+        await asyncio.sleep(0)
+        flush.cancel()
+        await asyncio.gather(flush, return_exceptions=True)
+        await tmp_db.stop_writer()
+
+    asyncio.run(scenario())
+    assert Config.load_json_file(Config.APPS_FILE, [])[0]['name'] == 'Игра'
+    assert Config.load_json_file(Config.SUGGESTIONS_FILE, [])[0]['name'] == 'Идея'
+    assert Config.load_json_file(Config.CHANNELS_FILE, [])[0]['name'] == 'Канал'
+
+
+def test_add_user_coalesces_last_seen(tmp_db):
+    tmp_db.add_user(1, 'alice', 'Алиса')
+    assert Config.load_json_file(Config.USERS_FILE, [])[0]['id'] == 1
+
+    # Повторное обращение не переписывает users.json, только обновляет запись в памяти
+    tmp_db.add_user(1, 'alice_new', '')
+    assert tmp_db.get_user(1)['username'] == 'alice_new'
+    assert Config.load_json_file(Config.USERS_FILE, [])[0]['username'] == 'alice'
+
+    tmp_db.flush()
+    assert Config.load_json_file(Config.USERS_FILE, [])[0]['username'] == 'alice_new'
+
+    # Свёртка пачки обращений пишет users.json один раз, а не по разу на пользователя
+    tmp_db.add_user(2, 'bob', 'Боб')
+    writes = []
+    write = tmp_db.storage._write
+    tmp_db.storage._write = lambda collection: writes.append(collection) or write(collection)
+    tmp_db.add_user(1, 'alice', 'Алиса')
+    tmp_db.add_user(2, 'bob', 'Боб')
+    tmp_db.flush()
+    assert writes == ['users']
+
+
+def test_sqlite_storage_imports_json_and_persists_rows(tmp_db, tmp_path):
+    tmp_db.add_app({'name': 'Игра', 'genre': 'RPG', 'size_category': 'small'})
+    tmp_db.add_giveaway({'title': 'Тест', 'end_datetime': '01.01.2099 12:00'})
+    tmp_db.add_participant(1, 7, 'user7', 'Имя')
+
+    # Первый запуск на SQLite импортирует существующие JSON-файлы
+    db = bot.Database(storage=bot.SqliteStorage(str(tmp_path / 'gamehub.db')))
+    assert db.apps[0]['name'] == 'Игра'
+    assert list(db.giveaways[0]['participants']) == [7]
+
+    db.add_participant(1, 8, 'user8', 'Имя')
+    db.update_app(1, 'genre', 'Action')
+    db.add_suggestion({'name': 'Новая игра'})
+    assert db.delete_suggestion(1)
+    db.close()
+
+    db = bot.Database(storage=bot.SqliteStorage(str(tmp_path / 'gamehub.db')))
+    assert list(db.giveaways[0]['participants']) == [7, 8]
+    assert db.apps[0]['genre'] == 'Action'
+    assert db.suggestions == []
+
+    # Массовое сохранение обновляет строки по id, не трогая таблицу участников
+    db.storage.deferred = True
+    db.giveaways[0]['title'] = 'Новое название'
+    db.save_giveaways()
+    assert db.storage.has_pending()
+    asyncio.run(db.storage.flush_async())
+    assert not db.storage.has_pending()
+    db.close()
+
+    db = bot.Database(storage=bot.SqliteStorage(str(tmp_path / 'gamehub.db')))
+    assert db.giveaways[0]['title'] == 'Новое название'
+    assert list(db.giveaways[0]['participants']) == [7, 8]
+    db.close()
+
+
+def test_participation_journal_replay_and_fold(tmp_db, tmp_path):
+    tmp_db.add_giveaway({'title': 'Тест', 'end_datetime': '01.01.2099 12:00'})
+    snapshot = open(Config.GIVEAWAYS_FILE, encoding='utf-8').read()
+    for uid in (7, 8):
+        assert tmp_db.add_participant(1, uid, f'user{uid}', 'Имя')
+
+    # Участие — строка в журнале, снимок розыгрышей не переписывается
+    journal = tmp_path / 'giveaway_journal' / '1.jsonl'
+    assert open(Config.GIVEAWAYS_FILE, encoding='utf-8').read() == snapshot
+    assert [json.loads(line)['id'] for line in journal.read_text(encoding='utf-8').splitlines()] == [7, 8]
+    # Недописанная строка после сбоя пропускается
+    with open(journal, 'a', encoding='utf-8') as f:
+        f.write('{"id": 9, "userna')
+
+    db = bot.Database()
+    assert list(db.giveaways[0]['participants']) == [7, 8]
+    assert db.is_participant(1, 8)
+
+    async def scenario():
+        db.start_writer()
+        db.add_participant(1, 10, 'user10', 'Имя')
+        db.update_giveaway(1, 'prize', 'Игра')
+        await db.stop_writer()
+
+    asyncio.run(scenario())
+    # Снимок записан вместе с журналом, журналы удалены
+    assert not os.listdir(tmp_path / 'giveaway_journal')
+    saved = json.load(open(Config.GIVEAWAYS_FILE, encoding='utf-8'))[0]
+    assert list(bot.ParticipantList.coerce(saved['participants'])) == [7, 8, 10]
+
+
+def test_id_indexes_survive_delete(tmp_db):
+    for name in ('A', 'B', 'C'):
+        assert tmp_db.add_app({'name': name})
+    assert tmp_db.delete_app(2)
+    assert tmp_db.get_app_by_id(2) == {}
+
+    # Новый id не совпадает с уже существующим после удаления
+    tmp_db.add_app({'name': 'D'})
+    assert [a['id'] for a in tmp_db.apps] == [1, 3, 4]
+    assert tmp_db.get_app_by_id(3)['name'] == 'C'
+    assert tmp_db.update_app(4, 'genre', 'RPG')
+    assert tmp_db.get_app_by_id(4)['genre'] == 'RPG'
+    # Удалённый последний id повторно не выдаётся
+    assert tmp_db.delete_app(4)
+    tmp_db.add_app({'name': 'E'})
+    assert tmp_db.apps[-1]['id'] == 5
+
+    tmp_db.add_giveaway({'title': 'Г', 'end_datetime': '01.01.2099 12:00'})
+    assert tmp_db.get_giveaway_by_id(1)['title'] == 'Г'
+    tmp_db.load()
+    assert tmp_db.get_app_by_id(3)['name'] == 'C' and tmp_db.get_app_by_id(5)['name'] == 'E'
+    assert tmp_db.get_giveaway_by_id(1) is tmp_db.giveaways[0]
+
+
+def test_participant_membership_set(tmp_db):
+    tmp_db.add_giveaway({'title': 'Г', 'end_datetime': '01.01.2099 12:00'})
+    assert tmp_db.add_participant(1, 10, 'u10', 'Имя')
+    assert not tmp_db.add_participant(1, 10, 'u10', 'Имя')
+    assert tmp_db.add_participant(1, 11, 'u11', 'Имя')
+    assert tmp_db.is_participant(1, 10)
+    assert not tmp_db.is_participant(1, 12)
+    assert tmp_db.get_participant_count(1) == 2
+
+    # После перезагрузки множества строятся заново из списка участников
+    tmp_db.load()
+    assert tmp_db.is_participant(1, 11)
+    assert tmp_db.get_participant_count(1) == 2
+    assert tmp_db.delete_giveaway(1)
+    assert tmp_db.get_participant_count(1) == 0
+
+
+def test_participant_list_compact_format(tmp_db):
+    # Старый формат: участники — словари с именами
+    legacy = [{'id': 1, 'title': 'Старый', 'end_datetime': '01.01.2099 12:00', 'participants': [
+        {'id': 5, 'username': 'five', 'first_name': 'Пять', 'joined_date': '2024-05-01 10:00:00'},
+        {'id': 6, 'username': '', 'first_name': 'Шесть', 'joined_date': '2024-05-02 10:00:00'},
+    ]}]
+    Config.save_json_file(Config.GIVEAWAYS_FILE, legacy)
+    # Первый запуск после обновления: новая база поверх файла старого формата
+    tmp_db = bot.Database()
+    assert Config.load_json_file(Config.USERS_FILE, [])[0]['id'] == 5
+    participants = tmp_db.get_giveaway_by_id(1)['participants']
+    assert isinstance(participants, bot.ParticipantList) and list(participants) == [5, 6]
+    assert participants.joined[0] == int(datetime(2024, 5, 1, 10).timestamp())
+    # Имена переехали в реестр пользователей
+    assert tmp_db.get_participant_name(5) == 'five' and tmp_db.get_user(6)['first_name'] == 'Шесть'
+
+    assert tmp_db.add_participant(1, 7, 'seven', 'Семь')
+    tmp_db.save_giveaways()
+    saved = Config.load_json_file(Config.GIVEAWAYS_FILE, [])[0]['participants']
+    assert set(saved) == {'ids', 'joined'} and isinstance(saved['ids'], str)
+    restored = bot.ParticipantList.coerce(saved)
+    assert list(restored) == [5, 6, 7] and list(restored.joined) == list(participants.joined)
+    assert bot.random.choice(restored.ids) in (5, 6, 7)
+
+
+def test_search_index_ranking_and_updates(tmp_db):
+    tmp_db.add_app({'name': 'Minecraft', 'description': 'Песочница с кубами'})
+    tmp_db.add_app({'name': 'Minecraft Dungeons', 'description': 'Экшен'})
+    tmp_db.add_app({'name': 'Terraria', 'description': 'Похожа на minecraft, но в 2D'})
+
+    assert [a['name'] for a in tmp_db.search_by_name('minecraft')] == ['Minecraft', 'Minecraft Dungeons', 'Terraria']
+    assert [a['name'] for a in tmp_db.search_by_name('CRAFT')][:2] == ['Minecraft', 'Minecraft Dungeons']
+    assert [a['id'] for a in tmp_db.search_by_name('кубам')] == [1]
+    assert tmp_db.search_by_name('minecraft ёлка') == []
+
+    tmp_db.update_app(3, 'description', 'Песочница в 2D')
+    assert [a['id'] for a in tmp_db.search_by_name('minecraft')] == [1, 2]
+    tmp_db.delete_app(1)
+    assert [a['id'] for a in tmp_db.search_by_name('песочница')] == [3]
+
+
+def test_fuzzy_search_typos_and_translit(tmp_db):
+    tmp_db.add_app({'name': 'Minecraft', 'description': ''})
+    tmp_db.add_app({'name': 'Майнкрафт Классик', 'description': ''})
+    tmp_db.add_app({'name': 'Terraria', 'description': ''})
+
+    assert tmp_db.search_by_name('minecarft') == []
+    assert [a['id'] for a in tmp_db.search_fuzzy('minecarft')][0] == 1
+    assert {a['id'] for a in tmp_db.search_fuzzy('майнкрафт')} == {1, 2}
+    assert [a['id'] for a in tmp_db.search_fuzzy('terraira')] == [3]
+    assert tmp_db.search_fuzzy('qwerty') == []
+    assert bot.SearchIndex.edit_distance('abcdef', 'uvwxyz', 2) == 3
+
+    # После полной перестройки индекса нечёткий поиск не находит удалённые слова
+    tmp_db.search_index.rebuild([tmp_db.get_app_by_id(3)])
+    assert tmp_db.search_fuzzy('minecarft') == []
+
+    # Частые триграммы не обходятся целиком: редкие триграммы запроса находят слово и при малом бюджете
+    index = bot.SearchIndex()
+    index.rebuild([{'id': i, 'name': f'mega{i:03d}'} for i in range(300)] + [{'id': 1000, 'name': 'Megaman'}])
+    checked = []
+    index.edit_distance = lambda a, b, limit: checked.append(b) or bot.SearchIndex.edit_distance(a, b, limit)
+    assert index.search_fuzzy('megamn', limit=5, max_candidates=10, max_visits=50) == [1000]
+    assert len(checked) <= 10
+
+
+def test_genre_and_size_buckets(tmp_db):
+    tmp_db.add_app({'name': 'A', 'genre': 'RPG', 'size_category': '<10 МБ'})
+    tmp_db.add_app({'name': 'B', 'genre': 'rpg', 'size_category': '500+ МБ'})
+    tmp_db.add_app({'name': 'C', 'genre': 'Шутер', 'size_category': '<10 МБ'})
+
+    assert [a['id'] for a in tmp_db.search_by_genre('RPG')] == [1, 2]
+    assert tmp_db.count_by_size('<10 МБ') == 2
+
+    tmp_db.update_app(2, 'genre', 'Шутер')
+    tmp_db.delete_app(3)
+    assert [a['id'] for a in tmp_db.search_by_genre('Шутер')] == [2]
+    assert tmp_db.count_by_genre('RPG') == 1
+    assert tmp_db.count_by_size('<10 МБ') == 1
+    assert tmp_db.search_by_size('10-50 МБ') == []
+
+
+def test_search_pages_use_cursor(tmp_db, monkeypatch):
+    monkeypatch.setattr(bot, 'db', tmp_db)
+    genre = Config.GENRES[0]
+    for i in range(7):
+        tmp_db.add_app({'name': f'Игра {i}', 'genre': genre})
+
+    page = bot.get_search_page('g', '0', 2, 5)
+    assert page['total'] == 7 and page['total_pages'] == 2
+    assert [a['name'] for a in page['apps']] == ['Игра 5', 'Игра 6']
+
+    monkeypatch.setattr(bot, 'search_results', bot.ExpiringCache(maxsize=1, ttl=60))
+    token = bot.remember_search('игра', [1, 2, 3])
+    tmp_db.delete_app(2)
+    assert [a['id'] for a in bot.get_search_page('q', token, 1, 5)['apps']] == [1, 3]
+    # Старый ключ вытесняется новым (размер кеша ограничен)
+    bot.remember_search('другое', [4])
+    assert bot.get_search_page('q', token, 1, 5) is None
+    # Для нечёткого поиска в заголовке — найденное название, а не запрос пользователя
+    token = bot.remember_search('игар', [5], fuzzy=True)
+    assert 'Игра 4' in bot.get_search_page('q', token, 1, 5)['title']
+
+
+def test_send_cached_document_reuses_file_id(tmp_path):
+    class Document:
+        file_id = 'FILE_ID_1'
+
+    class Msg:
+        document = Document()
+
+    sent = []
+
+    async def send(document):
+        sent.append(document)
+        return Msg()
+
+    async def scenario():
+        bot.file_id_cache = bot.FileIdCache(str(tmp_path / 'file_ids.json'))
+        path = tmp_path / '1.apk'
+        path.write_bytes(b'apk v1')
+        await bot.send_cached_document(send, 1, str(path))
+        await bot.send_cached_document(send, 1, str(path))
+        # Содержимое изменилось — файл загружается заново
+        path.write_bytes(b'apk v2 longer')
+        await bot.send_cached_document(send, 1, str(path))
+        # file_ids.json пишется отложенно (при остановке — сразу)
+        assert Config.load_json_file(bot.file_id_cache.filename, []) == []
+        await bot.file_id_cache.stop()
+
+    original = bot.file_id_cache
+    try:
+        asyncio.run(scenario())
+    finally:
+        bot.file_id_cache = original
+    assert isinstance(sent[0], bot.FSInputFile)
+    assert sent[1] == 'FILE_ID_1'
+    assert isinstance(sent[2], bot.FSInputFile)
+    assert bot.FileIdCache(str(tmp_path / 'file_ids.json')).get(1, bot.FileIdCache._hash_file(str(tmp_path / '1.apk'))) == 'FILE_ID_1'
+
+
+def test_download_cache_revalidates_and_coalesces(tmp_path):
+    from aiohttp import web
+
+    hits = []
+
+    async def handler(request):
+        hits.append(request.headers.get('If-None-Match'))
+        await asyncio.sleep(0.05)
+        if request.headers.get('If-None-Match') == '"v1"':
+            return web.Response(status=304)
+        return web.Response(body=b'x' * 100, headers={'ETag': '"v1"'})
+
+    async def scenario():
+        app = web.Application()
+        app.router.add_get('/{name}', handler)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+        port = runner.addresses[0][1]
+        try:
+            cache = bot.DownloadCache(str(tmp_path / 'cache'), max_bytes=150, fresh_for=0)
+            url = f'http://127.0.0.1:{port}/game.apk'
+            first, second = await asyncio.gather(cache.fetch(url), cache.fetch(url))
+            assert first is second and first['filename'] == 'game.apk'
+            assert len(hits) == 1
+
+            # Повторный запрос перепроверяется по ETag без повторного скачивания
+            again = await cache.fetch(url)
+            assert hits[-1] == '"v1"' and again['path'] == first['path']
+
+            # Лимит размера: старый файл вытесняется новым
+            other = await cache.fetch(f'http://127.0.0.1:{port}/other.zip')
+            assert os.path.exists(other['path']) and not os.path.exists(first['path'])
+            # Индекс пишется отложенно, а при остановке — сразу
+            assert Config.load_json_file(cache.index_file, []) == []
+            await cache.stop()
+            assert [e['url'] for e in Config.load_json_file(cache.index_file, [])] == [other['url']]
+            # Все запросы шли через один общий HTTP-клиент
+            assert bot.http_session is not None and not bot.http_session.closed
+        finally:
+            await bot.close_http_session()
+            await runner.cleanup()
+
+    asyncio.run(scenario())
+
+
+def test_download_cache_relays_stream_to_telegram(tmp_path, monkeypatch):
+    from aiohttp import web
+
+    body = bytes(range(256)) * 40
+    monkeypatch.setattr(Config, 'RELAY_CHUNK_SIZE', 1024)
+    monkeypatch.setattr(Config, 'RELAY_MEMORY_LIMIT', 4096)
+
+    async def sized(request):
+        return web.Response(body=body, headers={'ETag': '"s1"'})
+
+    async def chunked(request):
+        resp = web.StreamResponse()
+        resp.enable_chunked_encoding()
+        await resp.prepare(request)
+        size = int(request.match_info['size'])
+        for i in range(0, size, 1000):
+            await resp.write(body[i:min(i + 1000, size)])
+        await resp.write_eof()
+        return resp
+
+    async def scenario():
+        app = web.Application()
+        app.router.add_get('/sized/{name}', sized)
+        app.router.add_get('/chunked/{size}/{name}', chunked)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+        port = runner.addresses[0][1]
+        sent = []
+
+        async def send(document):
+            data = b''.join([chunk async for chunk in document.read(None)])
+            sent.append((type(document), document.filename, data))
+            return 'MSG'
+
+        try:
+            cache = bot.DownloadCache(str(tmp_path / 'cache'), max_bytes=10 ** 6, fresh_for=600)
+            base = f'http://127.0.0.1:{port}'
+            # Известный размер: файл уходит в Telegram прямо из ответа и параллельно попадает в кеш
+            msg, entry = await cache.relay(f'{base}/sized/game.apk', 1, send)
+            assert msg == 'MSG' and sent[-1] == (bot.RelayInputFile, 'game.apk', body)
+            assert entry['sha256'] == hashlib.sha256(body).hexdigest()
+            assert open(entry['path'], 'rb').read() == body
+            # Повторная отправка берётся из кеша
+            await cache.relay(f'{base}/sized/game.apk', 1, send)
+            assert sent[-1][0] is bot.FSInputFile and sent[-1][2] == body
+
+            # Неизвестный размер в пределах лимита памяти — тоже потоково
+            await cache.relay(f'{base}/chunked/3000/small.zip', 2, send)
+            assert sent[-1][0] is bot.RelayInputFile and sent[-1][2] == body[:3000]
+            # Больше лимита — сначала на диск, потом загрузка из файла
+            msg, entry = await cache.relay(f'{base}/chunked/{len(body)}/big.zip', 3, send)
+            assert sent[-1][0] is bot.FSInputFile and sent[-1][2] == body
+            assert entry['size'] == len(body)
+            assert not [n for n in os.listdir(tmp_path / 'cache') if n.startswith('part_')]
+        finally:
+            await bot.close_http_session()
+            await runner.cleanup()
+
+    asyncio.run(scenario())
+
+
+def test_delivery_strategies_reuse_file_ids(tmp_path, monkeypatch):
+    from aiohttp import web
+    from aiogram.exceptions import TelegramBadRequest
+
+    hits = []
+
+    async def handler(request):
+        hits.append(request.headers.get('If-None-Match'))
+        if request.headers.get('If-None-Match') == '"v1"':
+            return web.Response(status=304)
+        return web.Response(body=b'apk', headers={'ETag': '"v1"'})
+
+    monkeypatch.setattr(bot, 'file_id_cache', bot.FileIdCache(str(tmp_path / 'file_ids.json')))
+    monkeypatch.setattr(bot, 'download_cache', bot.DownloadCache(str(tmp_path / 'cache'), 10 ** 6, fresh_for=0))
+    sent = []
+
+    class Ctx:
+        app_id = 1
+        local_path = None
+
+        def __init__(self, link):
+            self.file_link = link
+
+        async def send_document(self, document):
+            sent.append(document)
+            if document.endswith('broken.zip'):
+                raise TelegramBadRequest(method=None, message='Bad Request: failed to get HTTP URL content')
+            return types.SimpleNamespace(document=types.SimpleNamespace(file_id=f'id-{len(sent)}'))
+
+    async def scenario():
+        app = web.Application()
+        app.router.add_get('/{name}', handler)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+        base = f'http://127.0.0.1:{runner.addresses[0][1]}'
+        by_file_id, by_url = bot.FileIdStrategy(), bot.SendByUrlStrategy()
+        try:
+            # По URL Telegram отправляет только GIF/PDF/ZIP; file_id такой отправки запоминается
+            assert not by_url.applicable(Ctx(f'{base}/game.apk'))
+            pdf = Ctx(f'{base}/manual.pdf')
+            assert await by_file_id.deliver(pdf) is None
+            assert by_url.applicable(pdf) and (await by_url.deliver(pdf)).document.file_id == 'id-1'
+            assert (await by_file_id.deliver(pdf)).document.file_id == 'id-2' and sent[-1] == 'id-1'
+
+            # Отклонённая ссылка больше не пробуется
+            broken = Ctx(f'{base}/broken.zip')
+            with pytest.raises(TelegramBadRequest):
+                await by_url.deliver(broken)
+            assert not by_url.applicable(broken)
+
+            # Устаревшая запись кеша перепроверяется; при 304 file_id используется повторно
+            apk = Ctx(f'{base}/game.apk')
+            entry = await bot.download_cache.fetch(apk.file_link)
+            bot.file_id_cache.put(1, entry['sha256'], 'apk-file-id')
+            assert (await by_file_id.deliver(apk)) is not None and sent[-1] == 'apk-file-id'
+            assert hits == [None, '"v1"']
+        finally:
+            await bot.close_http_session()
+            await runner.cleanup()
+
+    asyncio.run(scenario())
+
+
+def test_delivery_queue_round_robin_and_limits():
+    order = []
+
+    def job(name):
+        async def run():
+            order.append(name)
+        return run
+
+    async def scenario():
+        queue = bot.DeliveryQueue(workers=1, max_size=4)
+        for i in range(3):
+            queue.submit(1, job(f'a{i}'))
+        # Пользователь 2 обслуживается после первой задачи пользователя 1, а не после всех трёх
+        assert queue.submit(2, job('b0')) == 2
+        with pytest.raises(bot.DeliveryQueueFull):
+            queue.submit(3, job('c0'))
+        queue.start()
+        while len(queue) or queue.metrics()['busy']:
+            await asyncio.sleep(0.01)
+        await queue.stop()
+        return queue.metrics()
+
+    metrics = asyncio.run(scenario())
+    assert order == ['a0', 'b0', 'a1', 'a2']
+    assert metrics['processed'] == 4 and metrics['depth'] == 0
+
+
+def test_keyed_locks_and_expiring_cache(monkeypatch):
+    clock = [1000.0]
+    monkeypatch.setattr(bot.time, 'monotonic', lambda: clock[0])
+
+    locks = bot.KeyedLocks(ttl=60)
+    first = locks.try_acquire(1)
+    assert first and locks.try_acquire(1) is None
+    locks.release(2, locks.try_acquire(2))
+    assert len(locks) == 1
+    # Зависшая блокировка снимается по истечении ttl
+    clock[0] += 61
+    second = locks.try_acquire(1)
+    assert second
+    # Завершившийся после ttl первый владелец не снимает чужую блокировку
+    locks.release(1, first)
+    assert locks.locked(1)
+    locks.release(1, second)
+    assert len(locks) == 0
+
+    cache = bot.ExpiringCache(maxsize=2, ttl=8)
+    cache.set(1, 'a')
+    cache.set(2, 'b')
+    cache.set(3, 'c')
+    assert 1 not in cache and cache.get(3) == 'c' and len(cache) == 2
+    clock[0] += 8
+    cache.set(4, 'd')
+    assert len(cache) == 1 and 2 not in cache and cache.get(4) == 'd'
+
+
+def test_file_location_index(tmp_path, monkeypatch):
+    files = tmp_path / 'files'
+    (files / 'cache').mkdir(parents=True)
+    (files / '1.apk').write_bytes(b'x' * 10)
+    (files / 'cache' / '2.apk').write_bytes(b'y')
+    (files / 'game.zip').write_bytes(b'z' * 3)
+    monkeypatch.chdir(tmp_path)
+
+    index = bot.FileLocationIndex('files', [os.path.join('files', 'cache')])
+    apps = [{'id': 1}, {'id': 2}, {'id': 3, 'file_name': 'game.zip'}]
+    index.rebuild(apps)
+    assert index.get(1)['size'] == 10 and index.path(1) == os.path.join('files', '1.apk')
+    # Каталог кеша не сканируется
+    assert index.get(2) is None
+    assert index.path(3) == os.path.join('files', 'game.zip')
+
+    # Клавиатура строится по индексу, без обращений к диску
+    monkeypatch.setattr(bot, 'file_locations', index)
+    with monkeypatch.context() as m:
+        m.setattr(bot.os.path, 'exists', lambda path: pytest.fail('unexpected syscall'))
+        m.setattr(bot.os, 'stat', lambda path: pytest.fail('unexpected syscall'))
+        keyboard = bot.build_app_keyboard(apps[0], 1)
+        assert bot.build_app_keyboard(apps[1], 2) is None
+    assert keyboard.inline_keyboard[0][0].callback_data == 'get_file:1'
+
+    (files / '2.apk').write_bytes(b'new')
+    index.forget(3)
+    index.rebuild(list(index._apps.values()))
+    assert index.path(2) == os.path.join('files', '2.apk') and index.get(3) is None
+
+
+def test_broadcast_manager_resumes_and_retries(tmp_path):
+    from aiogram.exceptions import TelegramRetryAfter
+
+    class FakeBot:
+        def __init__(self):
+            self.sent = []
+            self.edits = 0
+            self.limited = False
+
+        async def send_message(self, chat_id, text, parse_mode=None):
+            if chat_id == 5 and not self.limited:
+                self.limited = True
+                raise TelegramRetryAfter(method=None, message='Too Many Requests', retry_after=0)
+            if chat_id == 7:
+                raise RuntimeError('blocked')
+            self.sent.append(chat_id)
+            return types.SimpleNamespace(message_id=100)
+
+        async def edit_message_text(self, text, chat_id=None, message_id=None):
+            self.edits += 1
+
+    filename = str(tmp_path / 'broadcasts.json')
+    manager = bot.BroadcastManager(filename, rate=1000, workers=3, checkpoint_interval=0)
+    job = manager.create('hi', list(range(1, 11)), admin_chat_id=999)
+    # Получатели хранятся отдельно, в broadcasts.json — только позиция и счётчики
+    audience_file = tmp_path / f"broadcasts_{job['id']}_audience.json"
+    assert json.load(open(audience_file, encoding='utf-8')) == list(range(1, 11))
+    assert 'audience' not in json.load(open(filename, encoding='utf-8'))[0]
+    # Имитируем перезапуск после того, как первые три получателя уже обработаны
+    job['cursor'] = 3
+    job['sent'] = 3
+    manager._save()
+
+    restarted = bot.BroadcastManager(filename, rate=1000, workers=3, checkpoint_interval=0)
+    fake = FakeBot()
+    restarted.bot = fake
+    asyncio.run(restarted.run_job(restarted.pending()[0]))
+
+    assert sorted(u for u in fake.sent if u != 999) == [4, 5, 6, 8, 9, 10]
+    saved = json.load(open(filename, encoding='utf-8'))[0]
+    assert saved['status'] == 'done' and saved['cursor'] == 10
+    assert saved['sent'] == 9 and saved['failed'] == 1 and not audience_file.exists()
+    assert saved['progress_message_id'] == 100 and fake.edits > 0
+
+
+def test_broadcast_prunes_unreachable_users(tmp_db, tmp_path, monkeypatch):
+    from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError
+
+    for uid in (1, 2, 3, 4):
+        tmp_db.add_user(uid, f'u{uid}')
+    monkeypatch.setattr(bot, 'db', tmp_db)
+
+    class FakeBot:
+        sent = []
+
+        async def send_message(self, chat_id, text, parse_mode=None):
+            if chat_id == 2:
+                raise TelegramForbiddenError(method=None, message='Forbidden: bot was blocked by the user')
+            if chat_id == 3:
+                raise TelegramBadRequest(method=None, message='Bad Request: chat not found')
+            if chat_id == 4:
+                raise RuntimeError('network is down')
+            self.sent.append(chat_id)
+
+    manager = bot.BroadcastManager(str(tmp_path / 'broadcasts.json'), rate=1000, workers=2, checkpoint_interval=60)
+    manager.bot = FakeBot()
+    job = manager.create('hi', tmp_db.get_broadcast_audience())
+    asyncio.run(manager.run_job(job))
+
+    assert job['sent'] == 1 and job['failed'] == 3 and job['pruned'] == 2
+    assert tmp_db.get_user(2)['inactive_reason'] == 'blocked'
+    assert tmp_db.get_user(3)['inactive_reason'] == 'not_found'
+    # Временная ошибка не исключает пользователя
+    assert tmp_db.get_broadcast_audience() == [1, 4]
+
+    # Пользователь снова написал боту — он возвращается в рассылки
+    tmp_db.add_user(2, 'u2')
+    assert tmp_db.get_broadcast_audience() == [1, 2, 4]
+    assert 'inactive_reason' not in tmp_db.get_user(2)
+
+
+def test_giveaway_scheduler_fires_on_deadlines():
+    fired = []
+
+    async def on_due(bot_, gid):
+        fired.append(gid)
+
+    def giveaway(gid, offset):
+        end = datetime.fromtimestamp(start + offset).strftime("%d.%m.%Y %H:%M")
+        return {'id': gid, 'end_datetime': end}
+
+    async def scenario():
+        scheduler = bot.GiveawayScheduler(on_due)
+        past = giveaway(1, -120)
+        future = giveaway(2, 3600)
+        done = dict(giveaway(3, -120), winner={'id': 5})
+        scheduler.start(None, [past, future, done])
+        assert len(scheduler) == 2
+        await asyncio.sleep(0.05)
+        assert fired == [1]
+
+        # Перенос даты в прошлое будит планировщик сразу
+        future['end_datetime'] = giveaway(2, -60)['end_datetime']
+        scheduler.schedule(future)
+        scheduler.schedule(giveaway(4, 7200))
+        scheduler.unschedule(4)
+        await asyncio.sleep(0.05)
+        assert fired == [1, 2]
+        assert len(scheduler) == 0 and scheduler.next_deadline() is None
+        await scheduler.stop()
+
+    start = time.time()
+    asyncio.run(scenario())
+
+
+def test_giveaway_deadlines_parsed_once(tmp_db, monkeypatch):
+    past = (datetime.now() - timedelta(hours=1)).strftime("%d.%m.%Y %H:%M")
+    future = (datetime.now() + timedelta(hours=1)).strftime("%d.%m.%Y %H:%M")
+    for title, end in (('old', past), ('new', future), ('broken', 'когда-нибудь')):
+        tmp_db.add_giveaway({'title': title, 'end_datetime': end})
+    assert tmp_db.get_giveaway_by_id(2)['end_ts'] == datetime.strptime(future, "%d.%m.%Y %H:%M").timestamp()
+
+    # Списки строятся без разбора дат и без записи на диск
+    with monkeypatch.context() as m:
+        m.setattr(bot, 'parse_end_datetime', lambda value: pytest.fail('unexpected parse'))
+        m.setattr(tmp_db, '_upsert', lambda *args: pytest.fail('unexpected write'))
+        assert [g['title'] for g in tmp_db.get_active_giveaways()] == ['new', 'broken']
+        assert [g['title'] for g in tmp_db.get_ended_giveaways()] == ['old']
+        assert tmp_db.get_stats()['active_giveaways'] == 2
+
+    tmp_db.update_giveaway(2, 'end_datetime', past)
+    tmp_db.end_giveaway(1)
+    assert [g['title'] for g in tmp_db.get_active_giveaways()] == ['broken']
+    assert [g['title'] for g in tmp_db.get_ended_giveaways()] == ['old', 'new']
+    tmp_db.delete_giveaway(1)
+    assert [g['title'] for g in tmp_db.get_ended_giveaways()] == ['new']
+
+
+def test_draw_winners_and_audit(tmp_db, tmp_path, monkeypatch):
+    ids = bot.array('q', range(1, 1001))
+    winners = bot.draw_winners(ids, 5, exclude={1, 2, 3}, rng=bot.random.Random(42))
+    assert len(set(winners)) == 5 and not {1, 2, 3} & set(winners)
+    # Одинаковое зерно — одинаковый результат
+    assert winners == bot.draw_winners(ids, 5, exclude={1, 2, 3}, rng=bot.random.Random(42))
+    assert sorted(bot.draw_winners([1, 2, 3], 10, exclude={2})) == [1, 3]
+    # Каждый участник выигрывает примерно одинаково часто
+    counts = {uid: 0 for uid in range(10)}
+    rng = bot.random.Random(7)
+    for _ in range(3000):
+        for uid in bot.draw_winners(range(10), 2, rng=rng):
+            counts[uid] += 1
+    assert min(counts.values()) > 450 and max(counts.values()) < 750
+
+    monkeypatch.setattr(bot, 'db', tmp_db)
+    monkeypatch.setattr(Config, 'DRAW_AUDIT_FILE', str(tmp_path / 'draw_audit.jsonl'))
+    tmp_db.add_giveaway({'title': 'Г', 'end_datetime': '01.01.2000 12:00', 'winners_count': 2})
+    for uid in (10, 11, 12):
+        tmp_db.add_participant(1, uid, f'u{uid}', 'Имя')
+    tmp_db.mark_user_inactive(12, 'blocked')
+    tmp_db.add_user(13, 'u13')
+    tmp_db.mark_user_inactive(13, 'blocked')
+    tmp_db.add_user(13, 'u13')
+    assert tmp_db.get_draw_exclusions() == {12}
+
+    class FakeBot:
+        notified = []
+
+        async def send_message(self, chat_id, text, parse_mode=None):
+            self.notified.append(chat_id)
+
+    asyncio.run(bot.finish_giveaway(FakeBot(), 1))
+    giveaway = tmp_db.get_giveaway_by_id(1)
+    assert sorted(w['id'] for w in giveaway['winners']) == [10, 11] == sorted(FakeBot.notified)
+    assert giveaway['winner'] == giveaway['winners'][0] and bot.format_winners(giveaway) in ('u10, u11', 'u11, u10')
+
+    audit = json.loads(open(tmp_path / 'draw_audit.jsonl', encoding='utf-8').read())
+    assert audit['giveaway_id'] == 1 and audit['entrants'] == 3 and audit['excluded'] == [12]
+    # По зерну из аудита розыгрыш воспроизводится
+    replay = bot.draw_winners(tmp_db.get_giveaway_by_id(1)['participants'].ids, 2, {12}, bot.random.Random(int(audit['seed'], 16)))
+    assert replay == audit['winners']
+
+    # Одновременное завершение (планировщик и администратор) разыгрывает итоги один раз
+    tmp_db.add_giveaway({'title': 'Г2', 'end_datetime': '01.01.2000 12:00'})
+    tmp_db.add_participant(2, 10, 'u10', 'Имя')
+    FakeBot.notified.clear()
+
+    async def race():
+        await asyncio.gather(bot.finish_giveaway(FakeBot(), 2), bot.finish_giveaway(FakeBot(), 2))
+
+    asyncio.run(race())
+    assert FakeBot.notified == [10]
+    assert len(open(tmp_path / 'draw_audit.jsonl', encoding='utf-8').readlines()) == 2
+
+
+def test_delivery_pipeline_tries_strategies_by_cost():
+    calls = []
+
+    def strategy(name, cost, result, applicable=True):
+        class Strategy(bot.DeliveryStrategy):
+            async def deliver(self, ctx):
+                calls.append(name)
+                if isinstance(result, Exception):
+                    raise result
+                return result
+
+        Strategy.name, Strategy.cost = name, cost
+        Strategy.applicable = lambda self, ctx: applicable
+        return Strategy()
+
+    pipeline = bot.DeliveryPipeline([
+        strategy('upload', 4, 'sent'),
+        strategy('url', 2, RuntimeError('too big')),
+        strategy('file_id', 0, None),
+        strategy('copy', 1, 'never', applicable=False),
+    ])
+
+    class Ctx:
+        app_id = 1
+        chat_id = 10
+        error = None
+
+    ctx = Ctx()
+    assert asyncio.run(pipeline.deliver(ctx)) == 'sent'
+    assert calls == ['file_id', 'url', 'upload']
+    assert isinstance(ctx.error, RuntimeError)
+    metrics = {m['name']: m for m in pipeline.metrics()}
+    assert metrics['url']['attempts'] == 1 and metrics['url']['success'] == 0
+    assert metrics['upload']['success'] == 1 and metrics['copy']['attempts'] == 0
+
+    assert bot.parse_tme_link('https://t.me/gamehub/15') == ('@gamehub', 15)
+    assert bot.parse_tme_link('https://t.me/c/12345/7') == (-10012345, 7)